@@ -1,74 +1,203 @@
 import discord
 from discord.ext import commands
 import asyncio
+import io
+import json
 import os
+import time
 from dotenv import load_dotenv
-import dateparser
-from datetime import datetime, timezone
-import pytz
+from datetime import datetime
 import openai
-import pymongo
 from pymongo import MongoClient
-
-# set timezone to PST for alarm functionality
-pacific_tz = pytz.timezone('America/Los_Angeles')
+from cache import SubscriptionCache
+from coordination import Lease
+from database import Repository
+from llm import LLMClient
+from message_buffer import MessageBuffer
+from metrics import MetricsServer, monitor_event_loop, registry
+from notifications import DigestBuffer, NotificationDispatcher, UserCache
+from pipeline import QUEUE_LAG, MessageEvent, MessagePipeline
+from scheduler import ReminderScheduler
+from summarizer import ProgressMessage, SummaryCache, Summarizer, split_message
+from timeparse import DEFAULT_TIMEZONE, TimeParser, get_timezone
+from topics import HashingVectorizer, match_batch
 
 # loading our environment variables
 load_dotenv()
 token = os.getenv('DISCORD_BOT_TOKEN')
 openai.api_key = os.getenv("OPENAI_API_KEY")
+# point this at another OpenAI-compatible server (e.g. a local stub) if you want to
+openai.api_base = os.getenv("OPENAI_API_BASE") or openai.api_base
 mongo_url = os.getenv('MONGODB_URL')
+mongo_workers = int(os.getenv('MONGODB_WORKERS', '8'))
+# how often (in seconds) to reload the subscription cache from Mongo, 0 turns it off
+cache_refresh_seconds = float(os.getenv('CACHE_REFRESH_SECONDS', '0'))
+# how many DMs we send at once, and how many can wait in line before new ones get dropped
+notify_workers = int(os.getenv('NOTIFY_WORKERS', '8'))
+notify_queue_size = int(os.getenv('NOTIFY_QUEUE_SIZE', '10000'))
+# users in digest mode get one DM per window (or once this many messages piled up) instead of one per message
+digest_window_seconds = float(os.getenv('DIGEST_WINDOW_SECONDS', '300'))
+digest_max_items = int(os.getenv('DIGEST_MAX_ITEMS', '10'))
+# /summarize splits long histories into chunks of about this many tokens and summarizes a few of them at once
+summary_chunk_tokens = int(os.getenv('SUMMARY_CHUNK_TOKENS', '3000'))
+summary_concurrency = int(os.getenv('SUMMARY_CONCURRENCY', '4'))
+# recent summaries are reused (and only extended with newer messages) for this long, optionally kept in Mongo too
+summary_cache_seconds = float(os.getenv('SUMMARY_CACHE_SECONDS', '3600'))
+summary_cache_size = int(os.getenv('SUMMARY_CACHE_SIZE', '256'))
+summary_cache_persist = os.getenv('SUMMARY_CACHE_PERSIST', '0') == '1'
+# recent messages kept in memory per channel (and in total, in MB) so /summarize rarely has to fetch history
+message_buffer_per_channel = int(os.getenv('MESSAGE_BUFFER_PER_CHANNEL', '2000'))
+message_buffer_mb = float(os.getenv('MESSAGE_BUFFER_MB', '64'))
+# OpenAI requests in flight for the whole bot / for one server, and how long to wait for one
+openai_concurrency = int(os.getenv('OPENAI_CONCURRENCY', '4'))
+openai_per_guild = int(os.getenv('OPENAI_PER_GUILD', '2'))
+openai_timeout = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '60'))
+# with several bot processes on one database, LEADER_ELECTION=1 makes sure only one of them delivers reminders:
+# whoever holds the lease (renewed every LEASE_SECONDS / 3) does, and picks up other processes' reminders every few seconds
+leader_election = os.getenv('LEADER_ELECTION', '0') == '1'
+lease_seconds = float(os.getenv('LEASE_SECONDS', '30'))
+reminder_sync_seconds = float(os.getenv('REMINDER_SYNC_SECONDS', '10'))
+# the other processes change subscriptions (and the leader deletes the reminders it sent), so their caches need refreshing
+if leader_election and cache_refresh_seconds <= 0:
+    cache_refresh_seconds = 60.0
+# topic subscriptions: how similar a message must be to a topic (0 to 1), and the vector size
+topic_threshold = float(os.getenv('TOPIC_THRESHOLD', '0.4'))
+topic_dimensions = int(os.getenv('TOPIC_DIMENSIONS', '256'))
+# on_message only queues messages, this many workers match them (up to PIPELINE_BATCH_SIZE at a time) and run commands;
+# past PIPELINE_QUEUE_SIZE waiting messages the oldest (or newest, PIPELINE_DROP=newest) are dropped
+pipeline_workers = int(os.getenv('PIPELINE_WORKERS', '4'))
+pipeline_queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', '10000'))
+pipeline_batch_size = int(os.getenv('PIPELINE_BATCH_SIZE', '64'))
+pipeline_commands = int(os.getenv('PIPELINE_COMMANDS', '32'))
+pipeline_drop = os.getenv('PIPELINE_DROP', 'oldest')
+# serve Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics, 0 turns it off
+metrics_port = int(os.getenv('METRICS_PORT', '0'))
+metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+# sharding: AUTO_SHARD=1 lets Discord pick the shard count, or run this process as SHARD_IDS (e.g. "0,1") of SHARD_COUNT
+auto_shard = os.getenv('AUTO_SHARD', '0') == '1'
+shard_count = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+shard_ids = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
 
 # configure bot intents and instance
 intents = discord.Intents.default() 
 intents.message_content = True 
-bot = commands.Bot(command_prefix="/", intents=intents)
-
-# temporary storages
-user_keywords = {}
-user_bookmarks = {}
-user_reminders = {}
-user_private_channels = {}
+if auto_shard or shard_count or shard_ids:
+    # each shard keeps its own gateway connection, and we only load subscriptions for the guilds it's in
+    bot = commands.AutoShardedBot(command_prefix="/", intents=intents, shard_count=shard_count, shard_ids=shard_ids)
+else:
+    bot = commands.Bot(command_prefix="/", intents=intents)
 
 # navigating to cluster
-cluster = MongoClient(mongo_url)
+cluster = MongoClient(mongo_url, tz_aware=True)
 # connecting to database
 db = cluster["prioritize_bot"]
-# connecting to collection
-keyword_collection = db["keywords"]
-bookmarks_collection = db["bookmarks"]
-reminders_collection = db["reminders"]
-private_channels_collection = db["private_channels"]
+# connecting to collection (every call goes through a thread pool so the event loop never waits on Mongo)
+repository = Repository(db, max_workers=mongo_workers)
+keyword_collection = repository.keywords
+bookmarks_collection = repository.bookmarks
+reminders_collection = repository.reminders
+private_channels_collection = repository.private_channels
+
+# temporary storages: every command writes through this cache, and reads (including on_message) come from it
+topic_vectorizer = HashingVectorizer(dimensions=topic_dimensions)
+subscriptions = SubscriptionCache(repository, vectorizer=topic_vectorizer, topic_threshold=topic_threshold)
+cache_refresh_task = None
+# on_ready runs again after every reconnect, but loading and starting background tasks must only happen once
+startup_lock = asyncio.Lock()
+startup_complete = False
+
+# every message we see is kept here for a while, /summarize reads from it before asking Discord for history
+message_buffer = MessageBuffer(per_channel=message_buffer_per_channel, max_bytes=int(message_buffer_mb * 1024 * 1024))
+
+# every DM goes through this queue, so handlers never wait on Discord to deliver notifications
+user_cache = UserCache(bot)
+notifier = NotificationDispatcher(user_cache, workers=notify_workers, max_queue=notify_queue_size)
+digests = DigestBuffer(notifier, window=digest_window_seconds, max_items=digest_max_items)
+
+
+# latency histograms and counters, see /botstats or the metrics endpoint
+EVENT_SECONDS = registry.histogram("discord_event_seconds", "Time our event handlers took (not counting the commands they run)", ("event",))
+COMMAND_SECONDS = registry.histogram("command_seconds", "Time commands took", ("command", "status"))
+NOTIFICATIONS_MATCHED = registry.counter("notifications_matched_total", "Messages that matched someone's subscriptions", ("kind",))
+LOOP_LAG = registry.histogram("event_loop_lag_seconds", "How late the event loop woke up from a sleep")
+started_at = time.time()
+background_tasks = []
 
 @bot.event
 async def on_ready():
     """
-    Initializes bot, clearing any existing user-specific data and repopulating it from the database.
-    This includes user keywords, bookmarks, reminders, and now private channels, so that our bot starts with the current data
-    when logging in.
+    Initializes bot, loading user-specific data from the database the first time we log in.
+    This includes user keywords, bookmarks, reminders, and private channels, so that our bot starts with the current data.
+    Discord calls this again after every reconnect; since every change is written through our cache,
+    there's nothing to reload then.
     """
     print(f'Logged in as {bot.user.name}')
-    bot.loop.create_task(reminder_task())
-    global user_keywords, user_bookmarks, user_reminders, user_private_channels
-    user_keywords.clear()
-    user_bookmarks.clear()
-    user_reminders.clear()
-    user_private_channels.clear() 
-    for doc in keyword_collection.find({}):
-        user_keywords[doc["user_id"]] = set(doc["keywords"])
-    for doc in bookmarks_collection.find({}): 
-        user_bookmarks[doc["user_id"]] = set(doc.get("bookmarks", []))
-    for doc in db["reminders"].find({}):
-        user_reminders[doc["user_id"]] = doc.get("reminders", [])
-    for doc in db["private_channels"].find({}):
-        user_private_channels[doc["user_id"]] = doc["channel_id"]
+    # a fresh session means we may have missed messages, so the buffered ones are no longer an unbroken run
+    message_buffer.clear()
+    await startup()
+
+async def startup():
+    """Loads everything from the database and starts our background tasks, exactly once.
+
+    If loading fails (e.g. MongoDB is unreachable), the next on_ready tries again.
+    """
+    global startup_complete, reminder_scheduler_task, reminder_lease_task, cache_refresh_task
+    async with startup_lock:
+        if startup_complete:
+            return
+        started_at = time.perf_counter()
+        notifier.start()
+        pipeline.start()
+        await repository.ensure_indexes()
+        converted = await repository.migrate_ids()
+        if converted:
+            print(f"Converted {converted} documents to int ids")
+        await subscriptions.load([guild.id for guild in bot.guilds])
+        if reminder_lease is None:
+            await reminder_scheduler.load()
+        elif reminder_lease_task is None:
+            # the scheduler loads reminders itself once this process becomes the leader
+            reminder_lease_task = bot.loop.create_task(reminder_lease.run())
+        if reminder_scheduler_task is None:
+            reminder_scheduler_task = bot.loop.create_task(reminder_scheduler.run())
+        if cache_refresh_seconds > 0 and cache_refresh_task is None:
+            cache_refresh_task = bot.loop.create_task(subscriptions.refresh_periodically(cache_refresh_seconds))
+        if not background_tasks:
+            background_tasks.append(bot.loop.create_task(monitor_event_loop(LOOP_LAG)))
+            if metrics_port:
+                try:
+                    await MetricsServer(registry, metrics_port, host=metrics_host).start()
+                except OSError as e:
+                    print(f"Could not serve metrics on port {metrics_port}: {e}")
+        startup_complete = True
+        stats = subscriptions.stats()
+        print(f"Loaded {stats['keywords']} keywords, {stats['bookmarks']} bookmarks (in {stats['guilds']} guilds), "
+              f"{len(reminder_scheduler)} reminders and {stats['private_channels']} private channels "
+              f"in {time.perf_counter() - started_at:.2f}s")
+
+@bot.event
+async def on_guild_join(guild):
+    """Loads the subscriptions people made in a guild we (re)joined."""
+    try:
+        await subscriptions.load_guild(guild.id)
+    except Exception as e:
+        print(f"Error loading subscriptions for guild {guild.id}: {e}")
+
+@bot.event
+async def on_guild_remove(guild):
+    """Frees the memory used by a guild's subscriptions once we're no longer in it."""
+    subscriptions.drop_guild(guild.id)
+
+def guild_key(ctx):
+    """The id subscriptions made with this command are stored under: the guild's, or None in DMs (global ones)."""
+    return ctx.guild.id if ctx.guild is not None else None
 
 @bot.command(name='create_private_channel')
 async def create_private_channel(ctx):
     guild = ctx.guild
     member = ctx.author
 
-    if str(member.id) in user_private_channels:
+    if subscriptions.private_channel_for(member.id):
         await ctx.send(f"{member.mention}, you already have a private channel.")
         return
 
@@ -81,12 +210,7 @@ async def create_private_channel(ctx):
     channel_name = f"private-{member.display_name}"
     private_channel = await guild.create_text_channel(channel_name, overwrites=overwrites)
 
-    private_channels_collection.insert_one({
-        "user_id": str(member.id),
-        "channel_id": str(private_channel.id)
-    })
-
-    user_private_channels[str(member.id)] = str(private_channel.id)
+    await subscriptions.set_private_channel(member.id, private_channel.id)
 
     await ctx.send(f"{member.mention}, your private channel has been created!")
     await private_channel.send(f"Welcome, {member.mention}! This is your private channel with me.")
@@ -118,32 +242,76 @@ async def create_private_channel(ctx):
 @bot.event
 async def on_message(message):
     """
-    Handles our incoming messages and checks them for user-specified keywords ;)
+    Handles our incoming messages: they're only queued here, the pipeline's workers check them for
+    user-specified keywords ;) and run commands, so a burst of messages never holds up the gateway.
     
     :param message: discord.Message object which represents the received message.
     """
+    handler_started = time.perf_counter()
+    message_buffer.record(message)
     if message.author == bot.user:
         return
-    
-    # Keyword notification
-    for user_id, keywords in user_keywords.items():
-        for keyword in keywords:
-            if keyword.lower() in message.content.lower():
-                user = await bot.fetch_user(user_id)
-                if user:
-                    await user.send(f'Keyword "{keyword}" found in message from {message.author.display_name}: "{message.content}"\nChannel: {message.channel.name}')
-                    print(f"Keyword '{keyword}' message sent to {user.name}'s DM")
-    
-    # Bookmark notification
-    for user_id, bookmarks in user_bookmarks.items():
-        for bookmark in bookmarks:
-            if str(message.author.id) == bookmark:
-                user = await bot.fetch_user(user_id)
-                if user:
-                    await user.send(f'Bookmark notification from {message.author.display_name}:\n{message.content}')
-                    print("Bookmark message sent to dm")
-    
-    await bot.process_commands(message)
+    if message.content.startswith(bot.command_prefix):
+        pipeline.submit_command(message)
+    # DMs to the bot are commands, nobody else should be notified about them
+    if message.guild is not None:
+        pipeline.submit(MessageEvent.from_message(message))
+    EVENT_SECONDS.observe(time.perf_counter() - handler_started, 'on_message')
+
+def notify_matches(events):
+    """Checks a batch of queued messages for keywords, bookmarks and topics and queues the notifications.
+
+    :param events: A list of pipeline.MessageEvent.
+    """
+    for event in events:
+        # Keyword notification (one DM per message, even if it has several of the user's keywords)
+        for user_id, keywords in subscriptions.match_keywords(event.content, event.guild_id).items():
+            NOTIFICATIONS_MATCHED.inc("keyword")
+            if subscriptions.setting_for(user_id, 'digest'):
+                for keyword in keywords:
+                    digests.add(user_id, event.message_id, f'keyword "{keyword}"', event.author_name, event.channel_name, event.content, event.jump_url)
+            elif len(keywords) == 1:
+                notifier.notify(user_id, f'Keyword "{keywords[0]}" found in message from {event.author_name}: "{event.content}"\nChannel: {event.channel_name}')
+            else:
+                found = ', '.join(f'"{keyword}"' for keyword in keywords)
+                notifier.notify(user_id, f'Keywords {found} found in message from {event.author_name}: "{event.content}"\nChannel: {event.channel_name}')
+
+        # Bookmark notification
+        for user_id in subscriptions.bookmark_subscribers_for(event.author_id, event.guild_id):
+            NOTIFICATIONS_MATCHED.inc("bookmark")
+            if subscriptions.setting_for(user_id, 'digest'):
+                digests.add(user_id, event.message_id, 'bookmark', event.author_name, event.channel_name, event.content, event.jump_url)
+            else:
+                notifier.notify(user_id, f'Bookmark notification from {event.author_name}:\n{event.content}')
+
+    # Topic notification, the whole batch is scored with one matrix multiply per guild
+    topical = [event for event in events if event.content and subscriptions.has_topics(event.guild_id)]
+    if not topical:
+        return
+    for event, matches in zip(topical, match_batch(topic_vectorizer, subscriptions.match_topics,
+                                                   [(event.guild_id, event.content) for event in topical])):
+        for user_id, topics in matches.items():
+            NOTIFICATIONS_MATCHED.inc("topic")
+            if subscriptions.setting_for(user_id, 'digest'):
+                for topic in topics:
+                    digests.add(user_id, event.message_id, f'topic "{topic}"', event.author_name, event.channel_name, event.content, event.jump_url)
+            else:
+                found = ', '.join(f'"{topic}"' for topic in topics)
+                notifier.notify(user_id, f'Topic {found} matched a message from {event.author_name}: "{event.content}"\nChannel: {event.channel_name}')
+
+pipeline = MessagePipeline(bot.process_commands, notify_matches, workers=pipeline_workers, max_queue=pipeline_queue_size,
+                           max_batch=pipeline_batch_size, max_commands=pipeline_commands, drop=pipeline_drop)
+
+@bot.event
+async def on_raw_message_edit(payload):
+    """Keeps the message buffer in sync when someone edits a message."""
+    if 'content' in payload.data:
+        message_buffer.edit(payload.channel_id, payload.message_id, payload.data['content'])
+
+@bot.event
+async def on_raw_message_delete(payload):
+    """Keeps the message buffer in sync when someone deletes a message."""
+    message_buffer.discard(payload.channel_id, payload.message_id)
 
 @bot.event
 async def on_member_join(member):
@@ -195,20 +363,17 @@ async def add_keyword(ctx, *, keyword):
     :param keyword: The keyword that the user wants to track.
     :return: None. It''ll send a confirmation message to the user's channel.
     """
-    user_id = str(ctx.author.id)
+    user_id = ctx.author.id
     # Check if the user already has keywords stored
-    user_doc = keyword_collection.find_one({"user_id": user_id})
-    if user_doc:
-        # If the user exists, add the new keyword to their list (if it's not already there!)
-        if keyword not in user_doc['keywords']:
-            keyword_collection.update_one({"user_id": user_id}, {"$push": {"keywords": keyword}})
-            await ctx.send(f'Keyword "{keyword}" added to your notifications list!')
+    first_keyword = not subscriptions.keywords_for(user_id, guild_key(ctx))
+    # Add the new keyword to their list (if it's not already there!), creating their document if needed
+    if await subscriptions.add_keyword(user_id, guild_key(ctx), keyword):
+        if first_keyword:
+            await ctx.send(f'Keyword "{keyword}" added to your notifications list! You will now receive alerts whenever "{keyword}" is mentioned.')
         else:
-            await ctx.send(f'Keyword "{keyword}" is already in your notifications list.')
+            await ctx.send(f'Keyword "{keyword}" added to your notifications list!')
     else:
-        # If the user doesn't exist, create a new document for them
-        keyword_collection.insert_one({"user_id": user_id, "keywords": [keyword]})
-        await ctx.send(f'Keyword "{keyword}" added to your notifications list! You will now receive alerts whenever "{keyword}" is mentioned.')
+        await ctx.send(f'Keyword "{keyword}" is already in your notifications list.')
 
 @bot.command(name='remove')
 async def remove_keyword(ctx, *, keyword):
@@ -222,16 +387,11 @@ async def remove_keyword(ctx, *, keyword):
     :param keyword: The keyword that the user wants to stop tracking.
     :return: None. It sends a confirmation or error message to the user's channel.
     """
-    user_id = str(ctx.author.id)
-    result = keyword_collection.find_one_and_update(
-        {"user_id": user_id},
-        {"$pull": {"keywords": keyword}},
-        return_document=pymongo.ReturnDocument.AFTER
-    )
-    if result and keyword in result.get('keywords', []):
-        await ctx.send(f'Keyword "{keyword}" was not found in your notifications list.')
-    else:
+    user_id = ctx.author.id
+    if await subscriptions.remove_keyword(user_id, guild_key(ctx), keyword):
         await ctx.send(f'Keyword "{keyword}" removed from your notifications list.')
+    else:
+        await ctx.send(f'Keyword "{keyword}" was not found in your notifications list.')
 
 @bot.command(name='list')
 async def list_keywords(ctx):
@@ -242,16 +402,211 @@ async def list_keywords(ctx):
             that "invoked" the command.
     :return: None. Just sends a message to the user's channel with all their tracked keywords.
     """
-    user_id = str(ctx.author.id)
+    user_id = ctx.author.id
 
-    user_doc = keyword_collection.find_one({"user_id": user_id})
+    user_keywords = subscriptions.keywords_for(user_id, guild_key(ctx))
 
-    if user_doc and user_doc.get("keywords"):
-        keywords = ', '.join(user_doc["keywords"])
+    if user_keywords:
+        keywords = ', '.join(sorted(user_keywords))
         await ctx.send(f'Your tracked keywords: {keywords}')
     else:
         await ctx.send('You are not tracking any keywords.')
 
+@bot.command(name='add_topic')
+async def add_topic(ctx, *, topic):
+    """Allows a user to follow a topic, like "deploying the backend".
+
+    Unlike keywords, topics don't have to appear word for word: messages that are similar enough to the
+    topic (sharing words or parts of words with it) trigger a notification too.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :param topic: A short phrase describing the topic.
+    :return: None. It sends a confirmation message to the user's channel.
+    """
+    user_id = ctx.author.id
+    topic = ' '.join(topic.split())
+    if not topic_vectorizer.transform_one(topic).any():
+        await ctx.send('Please describe the topic with a few words, e.g. `/add_topic deploying the backend`.')
+        return
+    if await subscriptions.add_topic(user_id, guild_key(ctx), topic):
+        await ctx.send(f'Topic "{topic}" added! You will now receive alerts for messages about it.')
+    else:
+        await ctx.send(f'Topic "{topic}" is already in your topics.')
+
+@bot.command(name='remove_topic')
+async def remove_topic(ctx, *, topic):
+    """Allows a user to stop following a topic.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :param topic: The topic the user no longer wants notifications for.
+    :return: None. It sends a confirmation or error message to the user's channel.
+    """
+    user_id = ctx.author.id
+    topic = ' '.join(topic.split())
+    if await subscriptions.remove_topic(user_id, guild_key(ctx), topic):
+        await ctx.send(f'Topic "{topic}" removed from your topics.')
+    else:
+        await ctx.send(f'Topic "{topic}" was not found in your topics.')
+
+@bot.command(name='list_topics')
+async def list_topics(ctx):
+    """Lists all the topics a user is following.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :return: None. It sends a message to the user's channel with all their topics.
+    """
+    user_topics = subscriptions.topics_for(ctx.author.id, guild_key(ctx))
+    if user_topics:
+        await ctx.send(f'Your topics: {", ".join(sorted(user_topics))}')
+    else:
+        await ctx.send('You are not following any topics.')
+
+def split_keywords(text):
+    """Splits a comma separated list of keywords, dropping empty entries."""
+    return [keyword.strip() for keyword in text.split(',') if keyword.strip()]
+
+@bot.command(name='add_many')
+async def add_keywords(ctx, *, keywords):
+    """Adds several keywords at once, separated by commas.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :param keywords: The keywords to track, e.g. "exam, homework, deadline".
+    :return: None. It sends a confirmation message to the user's channel.
+    """
+    user_id = ctx.author.id
+    keywords = split_keywords(keywords)
+    if not keywords:
+        await ctx.send('Please give me some keywords, separated by commas.')
+        return
+    added = await subscriptions.add_keywords(user_id, guild_key(ctx), keywords)
+    if added:
+        await ctx.send(f'Added {len(added)} keyword(s) to your notifications list: {", ".join(added)}')
+    else:
+        await ctx.send('All of these keywords are already in your notifications list.')
+
+@bot.command(name='remove_many')
+async def remove_keywords(ctx, *, keywords):
+    """Removes several keywords at once, separated by commas.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :param keywords: The keywords to stop tracking, e.g. "exam, homework".
+    :return: None. It sends a confirmation message to the user's channel.
+    """
+    user_id = ctx.author.id
+    keywords = split_keywords(keywords)
+    if not keywords:
+        await ctx.send('Please give me some keywords, separated by commas.')
+        return
+    removed = await subscriptions.remove_keywords(user_id, guild_key(ctx), keywords)
+    if removed:
+        await ctx.send(f'Removed {len(removed)} keyword(s) from your notifications list: {", ".join(removed)}')
+    else:
+        await ctx.send('None of these keywords were in your notifications list.')
+
+@bot.command(name='export')
+async def export_subscriptions(ctx):
+    """Sends the user a JSON file with their keywords, topics, bookmarks, reminders and settings.
+
+    The file can be loaded again (e.g. on another server running the bot) with `/import`.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :return: None. It sends the file to the user's channel.
+    """
+    user_id = ctx.author.id
+    data = {
+        "keywords": sorted(subscriptions.keywords_for(user_id, guild_key(ctx))),
+        "topics": sorted(subscriptions.topics_for(user_id, guild_key(ctx))),
+        "bookmarks": sorted(subscriptions.bookmarks_for(user_id, guild_key(ctx))),
+        "reminders": [
+            {"label": label, "time": reminder_time.isoformat()}
+            for label, reminder_time in sorted(subscriptions.reminders_for(user_id).items(), key=lambda item: item[1])
+        ],
+        "settings": subscriptions.settings.get(user_id, {}),
+    }
+    exported = io.BytesIO(json.dumps(data, indent=2).encode())
+    await ctx.send('Here are your subscriptions! Use `/import` with this file attached to load them again.',
+                   file=discord.File(exported, filename='subscriptions.json'))
+
+@bot.command(name='import')
+async def import_subscriptions(ctx):
+    """Loads keywords, topics, bookmarks, reminders and settings from a file made by `/export` (attached to the command).
+
+    Everything is added on top of what the user already has, existing entries are left alone.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :return: None. It sends a message to the user's channel saying what was imported.
+    """
+    user_id = ctx.author.id
+    if not ctx.message.attachments:
+        await ctx.send('Please attach the file you got from `/export`.')
+        return
+    attachment = ctx.message.attachments[0]
+    if attachment.size > 1024 * 1024:
+        await ctx.send('That file is too big to be an export.')
+        return
+
+    try:
+        data = json.loads(await attachment.read())
+        keywords = [str(keyword) for keyword in data.get("keywords", []) if str(keyword).strip()]
+        topics = [' '.join(str(topic).split()) for topic in data.get("topics", []) if str(topic).strip()]
+        bookmarks = [int(bookmark) for bookmark in data.get("bookmarks", [])]
+        settings = dict(data.get("settings", {}))
+        imported_tz = get_timezone(str(settings["timezone"])) if "timezone" in settings else None
+        user_tz = imported_tz or timezone_for(user_id)
+        reminders = []
+        for reminder in data.get("reminders", []):
+            reminder_time = datetime.fromisoformat(reminder["time"])
+            if reminder_time.tzinfo is None:
+                reminder_time = user_tz.localize(reminder_time)
+            reminders.append((str(reminder["label"]), reminder_time))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        await ctx.send("That doesn't look like a file from `/export`.")
+        return
+
+    added_keywords = await subscriptions.add_keywords(user_id, guild_key(ctx), keywords) if keywords else []
+    added_topics = [topic for topic in topics if await subscriptions.add_topic(user_id, guild_key(ctx), topic)]
+    added_bookmarks = await subscriptions.add_bookmarks(user_id, guild_key(ctx), bookmarks) if bookmarks else []
+    added_reminders = await subscriptions.add_reminders(user_id, reminders) if reminders else []
+    for reminder_id, label, reminder_time in added_reminders:
+        reminder_scheduler.schedule(reminder_id, user_id, label, reminder_time)
+    for name in ('digest',):
+        if name in settings:
+            await subscriptions.set_setting(user_id, name, bool(settings[name]))
+    if imported_tz is not None:
+        await subscriptions.set_setting(user_id, 'timezone', imported_tz.zone)
+
+    await ctx.send(f'Imported {len(added_keywords)} keyword(s), {len(added_topics)} topic(s), {len(added_bookmarks)} bookmark(s) and {len(added_reminders)} reminder(s).')
+
+@bot.command(name='digest')
+async def digest(ctx, mode=None):
+    """Turns digest mode on or off for the user's keyword, topic and bookmark notifications.
+
+    In digest mode, instead of one DM per matching message, matches are collected and sent together
+    as one message every few minutes (or sooner, once enough of them piled up).
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :param mode: "on" or "off". Leave it out to see whether digest mode is on.
+    :return: None. It sends a confirmation message to the user's channel.
+    """
+    user_id = ctx.author.id
+    if mode is None:
+        state = 'on' if subscriptions.setting_for(user_id, 'digest') else 'off'
+        await ctx.send(f'Digest mode is {state}. Use `/digest on` or `/digest off` to change it.')
+        return
+    if mode.lower() not in ('on', 'off'):
+        await ctx.send('Please use `/digest on` or `/digest off`.')
+        return
+
+    enabled = mode.lower() == 'on'
+    await subscriptions.set_setting(user_id, 'digest', enabled)
+    if enabled:
+        minutes = max(1, round(digest_window_seconds / 60))
+        await ctx.send(f'Digest mode is on! Your keyword and bookmark notifications will be bundled into one message every {minutes} minute(s).')
+    else:
+        # send whatever was already collected so nothing gets lost
+        digests.flush(user_id)
+        await ctx.send('Digest mode is off. You will get a message for every notification again.')
+
 @bot.command(name='showhelp')
 async def show_help(ctx):
     """Displays a help message listing all available bot commands and their descriptions.
@@ -286,11 +641,38 @@ async def show_help(ctx):
 
     await ctx.send(embed = embed)
 
+# reminder times are parsed with a few cached regexes, dateparser is only imported for unusual formats
+time_parser = TimeParser()
+
+def timezone_for(user_id):
+    """The timezone a user's reminder times are in, set with /timezone."""
+    return get_timezone(subscriptions.setting_for(user_id, 'timezone', DEFAULT_TIMEZONE)) or get_timezone(DEFAULT_TIMEZONE)
+
+@bot.command(name='timezone')
+async def set_timezone(ctx, name=None):
+    """Shows or changes the timezone the user's reminder times are in.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :param name: A timezone name like "Europe/Berlin" or "America/New_York". Leave it out to see the current one.
+    :return: None. It sends a confirmation message to the user's channel.
+    """
+    user_id = ctx.author.id
+    if name is None:
+        await ctx.send(f'Your reminders use the {timezone_for(user_id).zone} timezone. Use `/timezone <name>` (e.g. `/timezone Europe/Berlin`) to change it.')
+        return
+    tz = get_timezone(name)
+    if tz is None:
+        await ctx.send(f'"{name}" is not a timezone I know. Try a name like `America/New_York` or `Europe/Berlin`.')
+        return
+    await subscriptions.set_setting(user_id, 'timezone', tz.zone)
+    await ctx.send(f'Your reminders now use the {tz.zone} timezone.')
+
 @bot.command(name='add_reminder')
 async def add_reminder(ctx, time, *, label):
     """Adds a reminder for the user at a specified time with a given label.
 
-    We parse the provided time in PST and schedule a reminder!
+    We parse the provided time in the user's timezone (see `/timezone`) and schedule a reminder!
+    Common forms like "in 1 hour" or "tomorrow 9am" are parsed right away, anything else goes through dateparser.
     When the time arrives, we sends a message to the user with the reminder's label.
     User's can use the label to describe what the reminder will contain.
 
@@ -301,24 +683,18 @@ async def add_reminder(ctx, time, *, label):
     :param label: The label or message associated with the reminder.
     :return: None. Just sends a confirmation message to the invoking channel about the scheduled reminder.
     """
-    reminder_time = dateparser.parse(time, settings={'TIMEZONE': 'America/Los_Angeles'})
+    user_id = ctx.author.id
+    reminder_time = await time_parser.parse(time, timezone_for(user_id).zone)
     if reminder_time is None:
         await ctx.send('Invalid time format. Please try again.')
         return
-    reminder_time = reminder_time.astimezone(pacific_tz)
-    user_id = str(ctx.author.id)
     
     # Check if the reminder label already exists for the user
-    existing_reminder = reminders_collection.find_one({"user_id": user_id, "label": label})
-    if existing_reminder:
+    reminder_id = await subscriptions.add_reminder(user_id, label, reminder_time)
+    if reminder_id is None:
         await ctx.send('You already have a reminder with this label.')
         return
-    
-    reminders_collection.insert_one({
-        "user_id": user_id,
-        "reminder_time": reminder_time,
-        "label": label
-    })
+    reminder_scheduler.schedule(reminder_id, user_id, label, reminder_time)
     await ctx.send(f'Reminder set for {reminder_time.strftime("%Y-%m-%d %H:%M:%S %Z")} with label "{label}".')
 
 @bot.command(name='remove_reminder')
@@ -333,34 +709,31 @@ async def remove_reminder(ctx, label):
     :param label: The label of the reminder to remove.
     :return: None. Just sends a confirmation or error message to the user's channel.
     """
-    user_id = str(ctx.author.id)
-    result = reminders_collection.delete_one({"user_id": user_id, "label": label})
-    if result.deleted_count > 0:
+    user_id = ctx.author.id
+    reminder_scheduler.cancel(user_id, label)
+    if await subscriptions.remove_reminder(user_id, label):
         await ctx.send(f'Reminder with label "{label}" removed.')
     else:
         await ctx.send('No such reminder found.')
 
-async def reminder_task():
-    """This is our background task that checks for and sends our reminders every minute.
+async def send_reminder(user_id, label):
+    """Sends one due reminder to its user, called by the reminder scheduler.
 
-    This task runs indefinitely once the bot is ready, checking if there are any reminders
-    set for the current time or earlier, and then sends them to the appropriate users via private messages.
+    The scheduler sleeps until exactly the next reminder is due (instead of checking every minute),
+    and deletes sent reminders from the database in batches.
 
-    :return: None. It just sends reminders directly to users :D
+    :param user_id: The user who set the reminder.
+    :param label: The reminder's label, which is what we send them.
+    :return: None. It just sends the reminder directly to the user :D
     """
-    while True:
-        now = datetime.now(pacific_tz)
-        due_reminders = reminders_collection.find({"reminder_time": {"$lte": now}})
-        
-        for reminder in due_reminders:
-            user_id = reminder["user_id"]
-            label = reminder["label"]
-            user = await bot.fetch_user(int(user_id))
-            if user:
-                await user.send(f'Reminder: {label}')
-                reminders_collection.delete_one({"_id": reminder["_id"]})
-        
-        await asyncio.sleep(60)
+    await notifier.send(user_id, f'Reminder: {label}')
+    subscriptions.forget_reminder(user_id, label)
+
+# pending reminders live in a heap in memory, woken up early when the earliest one changes
+reminder_lease = Lease(repository.leases, 'reminders', ttl=lease_seconds, renew_interval=lease_seconds / 3) if leader_election else None
+reminder_lease_task = None
+reminder_scheduler = ReminderScheduler(reminders_collection, send_reminder, lease=reminder_lease, sync_interval=reminder_sync_seconds)
+reminder_scheduler_task = None
 
 @bot.command(name='list_reminders')
 async def list_reminders(ctx):
@@ -373,13 +746,13 @@ async def list_reminders(ctx):
                 that "invoked" the command.
     :return: None. It just sends a message to the user's channel with all their upcoming reminders.
     """
-    user_id = str(ctx.author.id)
-    user_reminders = reminders_collection.find({"user_id": user_id})
+    user_id = ctx.author.id
+    user_reminders = subscriptions.reminders_for(user_id)
+    user_tz = timezone_for(user_id)
     
     reminders_list = []
-    for reminder in user_reminders: 
-        reminder_time = reminder["reminder_time"].astimezone(pacific_tz)
-        label = reminder["label"]
+    for label, reminder_time in sorted(user_reminders.items(), key=lambda item: item[1]):
+        reminder_time = reminder_time.astimezone(user_tz)
         reminder_time_str = reminder_time.strftime('%Y-%m-%d %H:%M:%S %Z')
         reminders_list.append(f'{reminder_time_str}: {label}')
     
@@ -389,11 +762,23 @@ async def list_reminders(ctx):
     else:
         await ctx.send('You have no reminders set.')
 
+# the OpenAI client runs on its own threads so a slow summary never freezes the bot
+llm = LLMClient(max_concurrency=openai_concurrency, per_guild=openai_per_guild, timeout=openai_timeout)
+# our own messages and commands (like /summarize itself) would only add noise to a summary
+summarizer = Summarizer(llm.complete, chunk_tokens=summary_chunk_tokens, max_concurrency=summary_concurrency,
+                        ignore=lambda message: message.author_id == bot.user.id or message.content.startswith(bot.command_prefix))
+summary_cache = SummaryCache(max_entries=summary_cache_size, ttl=summary_cache_seconds,
+                             collection=repository.summaries if summary_cache_persist else None)
+
 @bot.command(name='summarize')
 async def summarize(ctx, channel: discord.TextChannel, num_messages: int = 50):
     """
     Summarizes the specified number of the latest messages in the given channel.
 
+    Messages are streamed in and summarized in chunks, so any number of messages fits in the model's context.
+    Progress shows up in one message that gets edited, and ends up holding the summary.
+    If the channel was summarized recently, only the messages since then are fetched and folded in.
+
     :param ctx: The context under which the command is executed.
     :param channel: The Discord TextChannel to summarize messages from.
     :param num_messages: The number of messages to fetch and summarize. Defaults to 50 if not specified.
@@ -402,29 +787,31 @@ async def summarize(ctx, channel: discord.TextChannel, num_messages: int = 50):
         await ctx.send("Channel not found.")
         return
 
-    messages = []
-    async for message in channel.history(limit=num_messages):
-        messages.append(message.content)
-
-    text = " ".join(messages)
+    status = await ctx.send(f"Summarizing the last {num_messages} messages in {channel.mention}...")
+    progress = ProgressMessage(status)
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Summarize the following messages:"},
-                {"role": "user", "content": text}
-            ],
-            temperature=0.5,
-            max_tokens=1024,
-            top_p=1.0,
-            frequency_penalty=0.0,
-            presence_penalty=0.0
-        )
-        summary = response.choices[0].message['content']
-        await ctx.send(f"Summary of the last {num_messages} messages in {channel.mention}:\n\n{summary}")
+        cached = await summary_cache.get(channel.id, num_messages)
+        if cached and cached["last_message_id"] == channel.last_message_id:
+            # nothing new was posted since the last summary
+            summary = cached["summary"]
+        else:
+            history = message_buffer.history(channel, num_messages, after_id=cached["last_message_id"] if cached else None)
+            summary, newest_id = await summarizer.summarize(history, progress=progress.update, guild_id=ctx.guild.id if ctx.guild else None,
+                                                            previous=cached["summary"] if cached else None, limit=num_messages)
+            if summary is not None and newest_id is not None:
+                await summary_cache.put(channel.id, num_messages, summary, newest_id, created_at=cached["created_at"] if cached else None)
+        if summary is None:
+            await status.edit(content=f"There are no messages to summarize in {channel.mention}.")
+            return
+        pieces = split_message(f"Summary of the last {num_messages} messages in {channel.mention}:\n\n{summary}")
+        await status.edit(content=pieces[0])
+        for piece in pieces[1:]:
+            await ctx.send(piece)
+    except asyncio.TimeoutError:
+        await status.edit(content="Summarizing took too long, please try again with fewer messages.")
     except Exception as e:
-        await ctx.send(f"Error summarizing messages: {str(e)}")
+        await status.edit(content=f"Error summarizing messages: {str(e)}")
 
 @bot.command(name='bookmark')
 async def add_bookmark(ctx, user: discord.Member):
@@ -441,29 +828,20 @@ async def add_bookmark(ctx, user: discord.Member):
     :return: None. It'll send a confirmation message to the user's channel.
     """
 
-    user_id = str(ctx.author.id)
+    user_id = ctx.author.id
     # user ID of mentioned user to bookmark
-    user_id_bookmark = str(user.id)
+    user_id_bookmark = user.id
 
     try:
-        # If the user exists, add the new bookmark to their list (if it's not already there!)
-        user_doc = bookmarks_collection.find_one({"user_id": user_id})
-
-        if user_doc:
-            # If the mentioned user is not bookmarked, add new bookmark to document
-            if user_id_bookmark not in user_doc.get('bookmarks', []):
-                bookmarks_collection.update_one(
-                    {"user_id": user_id},
-                    {"$push": {"bookmarks": user_id_bookmark}}
-                )
-                await ctx.send(f'{user.display_name} has been added to your bookmarks!')
-            else:
-                # If the mentioned user is already bookmarked
-                await ctx.send(f'{user.display_name} is already in your bookmarks.')
-        else:
-            # If the user doesn't exist, create a new document for them
-            bookmarks_collection.insert_one({"user_id": user_id, "bookmarks": [user_id_bookmark]})
+        first_bookmark = not subscriptions.bookmarks_for(user_id, guild_key(ctx))
+        # If the mentioned user is not bookmarked, add new bookmark (creating the user's document if needed)
+        if not await subscriptions.add_bookmark(user_id, guild_key(ctx), user_id_bookmark):
+            # If the mentioned user is already bookmarked
+            await ctx.send(f'{user.display_name} is already in your bookmarks.')
+        elif first_bookmark:
             await ctx.send(f'{user.mention} is added to your bookmarks! You will receive notifications when {user.mention} sends messages.')
+        else:
+            await ctx.send(f'{user.display_name} has been added to your bookmarks!')
 
     except Exception as e:
         print(f"Error adding a bookmark: {e}")
@@ -481,19 +859,14 @@ async def remove_bookmark(ctx, user: discord.Member):
     :param user:discord.Member: The mentioned user to add a bookmark for.
     :return: None. It sends a confirmation or error message to the user's channel.
     """
-    user_id = str(ctx.author.id)
+    user_id = ctx.author.id
     # user ID of mentioned user to bookmark
-    user_id_bookmark = str(user.id)
+    user_id_bookmark = user.id
 
     try:
         # Remove user bookmark from list of bookmarks
-        result = bookmarks_collection.update_one(
-            {"user_id": user_id},
-            {"$pull": {"bookmarks": user_id_bookmark}}
-        )
-        
         # Successfully removed user bookmark
-        if result.modified_count > 0:
+        if await subscriptions.remove_bookmark(user_id, guild_key(ctx), user_id_bookmark):
             await ctx.send(f'{user.mention} has been removed from your bookmarks.')
         else:
             await ctx.send('No such bookmark found.')
@@ -507,21 +880,16 @@ async def list_bookmarks(ctx):
     :param ctx: Discord bot commands represents the "context" of the command.
     :return: None. It sends a message to the user's channel with all their bookmarks.
     """
-    user_id = str(ctx.author.id)
+    user_id = ctx.author.id
     
     try:
         # Retrieve the user's bookmarks
-        user_bookmarks = bookmarks_collection.find_one({"user_id": user_id})
+        user_bookmarks = subscriptions.bookmarks_for(user_id, guild_key(ctx))
 
         if user_bookmarks:
-            bookmarks_list = user_bookmarks.get("bookmarks", [])
-            if bookmarks_list:
-                unique_bookmarks = list(set(bookmarks_list))
-                bookmark_mentions = [f"<@{bookmark}>" for bookmark in unique_bookmarks]
-                bookmarks_text = '\n'.join(bookmark_mentions)
-                await ctx.send(f'Your bookmarks:\n{bookmarks_text}')
-            else:
-                await ctx.send('You do not have any bookmarks.')
+            bookmark_mentions = [f"<@{bookmark}>" for bookmark in user_bookmarks]
+            bookmarks_text = '\n'.join(bookmark_mentions)
+            await ctx.send(f'Your bookmarks:\n{bookmarks_text}')
         else:
             await ctx.send('You do not have any bookmarks.')
 
@@ -537,11 +905,13 @@ async def examples(ctx):
     :return: None. It sends a message to the user's channel with example commands they can enter.
     """
     embed = discord.Embed(title="Examples of Commands", color=discord.Color.purple())
-    embed.add_field(name="🔑 Keyword Tracking", value="• `/add keyword` - Adds a keyword to track\n• `/remove keyword` - Removes a keyword from tracking", inline=False)
+    embed.add_field(name="🔑 Keyword Tracking", value="• `/add keyword` - Adds a keyword to track\n• `/remove keyword` - Removes a keyword from tracking\n• `/digest on` - Bundles your keyword and bookmark notifications into one message every few minutes", inline=False)
+    embed.add_field(name="🧭 Topic Tracking", value="• `/add_topic deploying the backend` - Notifies you about messages on a topic, even without an exact keyword\n• `/remove_topic deploying the backend` - Stops following a topic\n• `/list_topics` - Lists the topics you follow", inline=False)
     embed.add_field(name="🔖 Bookmarking Messages", value="• `/bookmark discorduser1` - Bookmark messages from discorduser1\n• `/remove_bookmark discorduser1` - Removes a bookmark", inline=False)
-    embed.add_field(name="🔔 Setting Reminders", value="• `/add_reminder \"2023-01-01 12:00\" \"New Year\"` - Sets a reminder for a specific time.\n• `/add_reminder \"in 1 hour\" \"Quick Meeting\"` - Sets a reminder for 1 hour from now.\n• `/remove_reminder \"New Year\"` - Removes a reminder with the label 'New Year'.", inline=False)
+    embed.add_field(name="🔔 Setting Reminders", value="• `/add_reminder \"2023-01-01 12:00\" \"New Year\"` - Sets a reminder for a specific time.\n• `/add_reminder \"in 1 hour\" \"Quick Meeting\"` - Sets a reminder for 1 hour from now.\n• `/remove_reminder \"New Year\"` - Removes a reminder with the label 'New Year'.\n• `/timezone Europe/Berlin` - Sets the timezone your reminder times are in.", inline=False)
     embed.add_field(name="📩 Summarizing Messages", value="• `/summarize #general 100` - Summarizes the last 100 messages in the general channel", inline=False)
     embed.add_field(name="🖨️ Listing Commands", value="• `/list` - Lists all keywords you are tracking\n• `/list_bookmarks` - Lists all your bookmarks\n• `/list_reminders` - Lists all your reminders", inline=False)
+    embed.add_field(name="📦 Bulk Commands", value="• `/add_many exam, homework, deadline` - Adds several keywords at once\n• `/remove_many exam, homework` - Removes several keywords at once\n• `/export` - Sends you a file with all your subscriptions\n• `/import` (with that file attached) - Loads your subscriptions from a file", inline=False)
     await ctx.send(embed=embed)
 
 @bot.command(name='onboard_user')
@@ -550,7 +920,7 @@ async def onboard_user(ctx):
     Onboards a new user by guiding them through setting up a private channel and introducing other bot features!
     """
     member = ctx.author
-    if str(member.id) in user_private_channels:
+    if subscriptions.private_channel_for(member.id):
         await ctx.send(f"{member.mention}, you already have a private channel set up! Feel free to enter /showhelp to see all commands available to use.")
     else:
         await ctx.send(f"{member.mention}, welcome! Before you can use the full features of this bot, you need to set up a private channel. Please enter `/create_private_channel` to do this.")
@@ -563,5 +933,111 @@ async def onboard_user(ctx):
     embed.set_footer(text="Start by creating your private channel to make the most out of these features!")
 
     await ctx.send(embed=embed)
-    
-bot.run(token)
\ No newline at end of file
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    COMMAND_SECONDS.observe(time.perf_counter() - ctx.started_at, ctx.command.name, 'error' if ctx.command_failed else 'ok')
+
+# everything the other components already count is read when the metrics are scraped, so it costs nothing until then
+registry.gauge("notification_queue_size", "DMs waiting to be sent", lambda: notifier.queue.qsize())
+registry.gauge("notifications_total", "DMs by outcome", lambda: {("sent",): notifier.sent, ("failed",): notifier.failed, ("dropped",): notifier.dropped},
+               labels=("outcome",), kind="counter")
+registry.gauge("pipeline_queue_size", "Messages and commands waiting for a pipeline worker", lambda: len(pipeline))
+registry.gauge("digest_pending_messages", "Messages waiting in digests", lambda: len(digests))
+registry.gauge("user_cache_lookups_total", "User and DM channel lookups by result",
+               lambda: {("user", "hit"): user_cache.user_hits, ("user", "miss"): user_cache.user_misses,
+                        ("channel", "hit"): user_cache.channel_hits, ("channel", "miss"): user_cache.channel_misses},
+               labels=("kind", "result"), kind="counter")
+registry.gauge("openai_requests", "OpenAI requests waiting for a slot / in flight",
+               lambda: {("waiting",): llm.waiting, ("in_flight",): llm.in_flight}, labels=("state",))
+registry.gauge("openai_timeouts_total", "OpenAI requests that timed out", lambda: llm.timeouts, kind="counter")
+registry.gauge("summary_cache_lookups_total", "Summary cache lookups by result",
+               lambda: {("hit",): summary_cache.hits, ("miss",): summary_cache.misses}, labels=("result",), kind="counter")
+registry.gauge("message_buffer_messages", "Messages kept in memory for /summarize", lambda: message_buffer.count)
+registry.gauge("message_buffer_bytes", "Rough memory used by the message buffer", lambda: message_buffer.size)
+registry.gauge("subscriptions_cached", "Subscriptions held in memory by kind",
+               lambda: {(kind,): count for kind, count in subscriptions.stats().items()}, labels=("kind",))
+registry.gauge("reminders_pending", "Reminders waiting in the scheduler", lambda: len(reminder_scheduler))
+registry.gauge("mongo_executor_queue", "MongoDB calls waiting for a worker thread", lambda: repository.executor._work_queue.qsize())
+registry.gauge("discord_latency_seconds", "Gateway heartbeat latency", lambda: bot.latency if bot.latency == bot.latency else 0.0)
+registry.gauge("guilds", "Guilds the bot is in", lambda: len(bot.guilds))
+
+def format_seconds(seconds):
+    """Formats a latency for /botstats, e.g. 3.2ms."""
+    if seconds is None:
+        return 'n/a'
+    return f'{seconds * 1000:.1f}ms' if seconds < 1 else f'{seconds:.2f}s'
+
+@bot.command(name='botstats')
+@commands.has_permissions(administrator=True)
+async def bot_stats(ctx):
+    """Shows server admins how the bot is doing: latencies, queues and cache hit rates.
+
+    :param ctx: Discord bot commands represents the "context" of the command.
+    :return: None. It sends an embed with the numbers to the channel.
+    """
+    uptime = int(time.time() - started_at)
+    embed = discord.Embed(title="Bot Stats", color=discord.Color.purple())
+    embed.add_field(name="General", value=f"Uptime: {uptime // 3600}h {uptime % 3600 // 60}m\nGuilds: {len(bot.guilds)}\n"
+                                          f"Gateway latency: {format_seconds(bot.latency)}\n"
+                                          f"Event loop lag p99: {format_seconds(LOOP_LAG.quantile(0.99))}", inline=False)
+    messages = EVENT_SECONDS.count('on_message')
+    embed.add_field(name="Messages", value=f"Handled: {messages}\n"
+                                           f"p50 / p99: {format_seconds(EVENT_SECONDS.quantile(0.5, 'on_message'))} / "
+                                           f"{format_seconds(EVENT_SECONDS.quantile(0.99, 'on_message'))}\n"
+                                           f"Waiting: {len(pipeline)}, dropped: {pipeline.dropped}\n"
+                                           f"Queue lag p99: {format_seconds(QUEUE_LAG.quantile(0.99, 'message'))} "
+                                           f"(commands {format_seconds(QUEUE_LAG.quantile(0.99, 'command'))})", inline=False)
+    embed.add_field(name="Notifications", value=f"Queued: {notifier.queue.qsize()}\nSent: {notifier.sent}, failed: {notifier.failed}, "
+                                                f"dropped: {notifier.dropped}\nDigests pending: {len(digests)}", inline=False)
+    lookups = user_cache.user_hits + user_cache.user_misses
+    hit_rate = f"{100 * user_cache.user_hits / lookups:.1f}%" if lookups else 'n/a'
+    embed.add_field(name="Caches", value=f"User cache hit rate: {hit_rate}\nSummary cache: {summary_cache.hits} hits, {summary_cache.misses} misses\n"
+                                         f"Message buffer: {message_buffer.count} messages, {message_buffer.size // 1024} KB", inline=False)
+    embed.add_field(name="OpenAI", value=f"Waiting: {llm.waiting}, in flight: {llm.in_flight}, timeouts: {llm.timeouts}", inline=False)
+    slowest = sorted(((COMMAND_SECONDS.quantile(0.99, name, 'ok'), name) for name in (command.name for command in bot.commands)
+                      if COMMAND_SECONDS.count(name, 'ok')), reverse=True)[:5]
+    if slowest:
+        embed.add_field(name="Slowest commands (p99)", value='\n'.join(f"/{name}: {format_seconds(p99)}" for p99, name in slowest), inline=False)
+    await ctx.send(embed=embed)
+
+@bot_stats.error
+async def bot_stats_error(ctx, error):
+    if isinstance(error, (commands.MissingPermissions, commands.NoPrivateMessage)):
+        await ctx.send('Only server administrators can use `/botstats`.')
+    else:
+        print(f"Error showing bot stats: {error}")
+
+# on shutdown (ctrl+c, or anything calling bot.close()) send what's still waiting before disconnecting
+discord_close = bot.close
+SHUTDOWN_SECONDS = 10
+
+async def close():
+    """Sends pending digests and queued DMs (waiting up to SHUTDOWN_SECONDS for them), hands the reminders lease
+    to another process right away instead of after LEASE_SECONDS, then disconnects."""
+    digests.flush_all()
+    try:
+        await asyncio.wait_for(notifier.join(), SHUTDOWN_SECONDS)
+    except asyncio.TimeoutError:
+        print(f"Shutting down with {notifier.queue.qsize()} notifications still queued")
+    if reminder_lease is not None:
+        if reminder_lease_task is not None:
+            # or it would just take the lease again
+            reminder_lease_task.cancel()
+        try:
+            await reminder_scheduler.flush()
+            if reminder_lease.held:
+                await reminder_lease.release()
+        except Exception as e:
+            print(f"Error releasing the reminders lease: {e}")
+    await discord_close()
+
+bot.close = close
+
+# guarded so the load test can import this module and drive the handlers without connecting to Discord
+if __name__ == "__main__":
+    bot.run(token)
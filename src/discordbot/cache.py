@@ -0,0 +1,639 @@
+import asyncio
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from database import to_id
+from keyword_index import Automaton, KeywordIndex, KeywordTable
+from topics import HashingVectorizer, TopicIndex
+
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl=None):
+        """:param ttl: Overrides the cache's ttl for this entry."""
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+
+def _add_id(arrays, key, value):
+    """Adds an id to the ids stored under `key`, unless it's already in there.
+
+    Most keys only ever get one id, which is stored as a plain int. From the second one on it's a sorted array.
+    """
+    ids = arrays.get(key)
+    if ids is None:
+        arrays[key] = value
+    elif type(ids) is int:
+        if ids != value:
+            arrays[key] = array('Q', sorted((ids, value)))
+    else:
+        position = bisect_left(ids, value)
+        if position == len(ids) or ids[position] != value:
+            ids.insert(position, value)
+
+
+def _remove_id(arrays, key, value):
+    ids = arrays.get(key)
+    if ids is None:
+        return
+    if type(ids) is int:
+        if ids == value:
+            del arrays[key]
+        return
+    position = bisect_left(ids, value)
+    if position == len(ids) or ids[position] != value:
+        return
+    del ids[position]
+    if not ids:
+        del arrays[key]
+
+
+def _ids(arrays, key):
+    """:return: The ids stored under `key` by `_add_id`, as something to iterate over even if it's a single one."""
+    ids = arrays.get(key, ())
+    return (ids,) if type(ids) is int else ids
+
+
+def _count(ids):
+    return 1 if type(ids) is int else len(ids)
+
+
+class GuildSubscriptions:
+    """Keyword, topic and bookmark subscriptions of one guild (or the global ones, stored under guild id None).
+
+    Ids are ints and the per-user lists are arrays (of keyword ids from the cache's KeywordTable, or sorted arrays
+    of user ids), an array of n ids takes 8n bytes where a set of strings takes several times that. A bookmark
+    list with a single id in it (the most common kind) is just that int, see `_add_id`.
+    """
+
+    __slots__ = ("keywords", "keyword_index", "topics", "topic_index", "bookmarks", "bookmark_subscribers")
+
+    def __init__(self, keyword_table):
+        # user id -> array of keyword ids
+        self.keywords = {}
+        self.keyword_index = KeywordIndex(keyword_table)
+        # user id -> topics, the TopicIndex is only made once someone in the guild adds a topic
+        self.topics = {}
+        self.topic_index = None
+        # user id -> bookmarked author ids, and the reverse: author id -> the users who bookmarked them (see _add_id)
+        self.bookmarks = {}
+        self.bookmark_subscribers = {}
+
+
+class SubscriptionCache:
+    """In-memory copy of everyone's keywords, topics, bookmarks, reminders, private channels and settings.
+
+    Every mutating command goes through here: the change is written to Mongo first and then applied to
+    memory, so on_message and the list commands can read from memory and never see stale data.
+    If other processes write to the same database, `refresh_periodically` reloads everything and swaps it in.
+
+    Keywords, topics and bookmarks are partitioned by guild, so a message only gets checked against the subscriptions
+    made in its own guild (plus the global ones, made in DMs or before subscriptions were per guild).
+    A shard only loads the partitions of the guilds it's in.
+
+    User and guild ids are ints everywhere, and every keyword string is stored once in `keyword_table`.
+
+    :param repository: The database.Repository to write through to.
+    :param batch_size: How many documents to read per round trip when loading.
+    :param vectorizer: The topics.HashingVectorizer topics are embedded with.
+    :param topic_threshold: Similarity from which a message counts as being about a topic.
+    """
+
+    def __init__(self, repository, batch_size=1000, vectorizer=None, topic_threshold=0.4):
+        self.repository = repository
+        self.batch_size = batch_size
+        self.vectorizer = vectorizer or HashingVectorizer()
+        self.topic_threshold = topic_threshold
+        # shared by every partition (including ones loaded later), so keyword ids mean the same thing everywhere
+        self.keyword_table = KeywordTable()
+        # the guilds we load partitions for, None means all of them
+        self.guild_ids = None
+        self._set_state(self._empty_state())
+        # while a load is running, mutations are also recorded in its journal and replayed on the fresh state
+        self._journals = []
+        # keyword index -> the task building its new automaton
+        self._index_builds = {}
+
+    @staticmethod
+    def _empty_state():
+        return {
+            "guilds": {},
+            "reminders": {},
+            "private_channels": {},
+            "settings": {},
+        }
+
+    def _set_state(self, state):
+        self.guilds = state["guilds"]
+        self.reminders = state["reminders"]
+        self.private_channels = state["private_channels"]
+        self.settings = state["settings"]
+
+    def _current_state(self):
+        return {
+            "guilds": self.guilds,
+            "reminders": self.reminders,
+            "private_channels": self.private_channels,
+            "settings": self.settings,
+        }
+
+    def _mutate(self, mutation):
+        mutation(self._current_state())
+        for journal in self._journals:
+            journal.append(mutation)
+
+    @staticmethod
+    def _partition_filter(guild_ids):
+        # documents without a guild_id are the global partition, {"guild_id": None} matches those too
+        return {} if guild_ids is None else {"guild_id": {"$in": list(guild_ids) + [None]}}
+
+    @staticmethod
+    async def _build_keyword_indexes(state):
+        """Builds the automaton of every keyword index in a freshly loaded state, in an executor."""
+        loop = asyncio.get_running_loop()
+        for partition in state["guilds"].values():
+            index = partition.keyword_index
+            index.install(await loop.run_in_executor(None, Automaton, index.table, index.pattern_ids()))
+
+    def _rebuild_keyword_index_soon(self, guild_id):
+        """Rebuilds a partition's keyword automaton in the background once enough keywords changed.
+
+        Until the new one is swapped in, searches use the old automaton plus the pending keywords.
+        """
+        partition = self.guilds.get(guild_id)
+        if partition is None or not partition.keyword_index.needs_rebuild or partition.keyword_index in self._index_builds:
+            return
+        index = partition.keyword_index
+        self._index_builds[index] = asyncio.ensure_future(self._rebuild_keyword_index(index))
+
+    async def _rebuild_keyword_index(self, index):
+        try:
+            automaton = await asyncio.get_running_loop().run_in_executor(None, Automaton, index.table, index.pattern_ids())
+            index.install(automaton)
+        except Exception as e:
+            print(f"Error rebuilding a keyword index: {e}")
+        finally:
+            del self._index_builds[index]
+
+    async def _load_partitions(self, state, query):
+        # in user id order, so the sorted subscriber arrays only ever get appended to while loading
+        by_user = [("user_id", ASCENDING)]
+        async for batch in self.repository.keywords.find_batches(query, {"_id": 0, "user_id": 1, "guild_id": 1, "keywords": 1}, self.batch_size, by_user):
+            for doc in batch:
+                for keyword in doc.get("keywords", []):
+                    self._apply_add_keyword(state, to_id(doc["user_id"]), to_id(doc.get("guild_id")), keyword)
+        async for batch in self.repository.topics.find_batches(query, {"_id": 0, "user_id": 1, "guild_id": 1, "topics": 1}, self.batch_size, by_user):
+            for doc in batch:
+                for topic in doc.get("topics", []):
+                    self._apply_add_topic(state, to_id(doc["user_id"]), to_id(doc.get("guild_id")), topic)
+        async for batch in self.repository.bookmarks.find_batches(query, {"_id": 0, "user_id": 1, "guild_id": 1, "bookmarks": 1}, self.batch_size, by_user):
+            for doc in batch:
+                for bookmark in doc.get("bookmarks", []):
+                    self._apply_add_bookmark(state, to_id(doc["user_id"]), to_id(doc.get("guild_id")), to_id(bookmark))
+        await self._build_keyword_indexes(state)
+
+    async def load(self, guild_ids=None):
+        """Replaces the cached data with whatever is in Mongo right now.
+
+        :param guild_ids: Only load keyword/bookmark partitions of these guilds, None loads every guild.
+        """
+        journal = []
+        self._journals.append(journal)
+        try:
+            state = self._empty_state()
+            await self._load_partitions(state, self._partition_filter(guild_ids))
+            async for batch in self.repository.reminders.find_batches({}, {"_id": 0, "user_id": 1, "label": 1, "reminder_time": 1}, self.batch_size):
+                for doc in batch:
+                    self._apply_add_reminder(state, to_id(doc["user_id"]), doc["label"], doc["reminder_time"])
+            async for batch in self.repository.private_channels.find_batches({}, {"_id": 0, "user_id": 1, "channel_id": 1}, self.batch_size):
+                for doc in batch:
+                    state["private_channels"][to_id(doc["user_id"])] = to_id(doc["channel_id"])
+            async for batch in self.repository.settings.find_batches({}, {"_id": 0}, self.batch_size):
+                for doc in batch:
+                    state["settings"][to_id(doc.pop("user_id"))] = doc
+            for mutation in journal:
+                mutation(state)
+            if guild_ids is not None:
+                # partitions of guilds we joined while loading were loaded on their own, keep them
+                for guild_id in set(self.guild_ids or ()) - set(guild_ids):
+                    if guild_id in self.guilds:
+                        state["guilds"][guild_id] = self.guilds[guild_id]
+                guild_ids = set(guild_ids) | set(self.guild_ids or ())
+            self.guild_ids = None if guild_ids is None else set(guild_ids)
+            self._set_state(state)
+        finally:
+            self._journals.remove(journal)
+
+    async def load_guild(self, guild_id):
+        """Loads the partition of a guild we just joined."""
+        if self.guild_ids is not None:
+            self.guild_ids.add(guild_id)
+        journal = []
+        self._journals.append(journal)
+        try:
+            state = self._empty_state()
+            await self._load_partitions(state, {"guild_id": guild_id})
+            for mutation in journal:
+                mutation(state)
+            self.guilds[guild_id] = state["guilds"].get(guild_id) or GuildSubscriptions(self.keyword_table)
+        finally:
+            self._journals.remove(journal)
+
+    def drop_guild(self, guild_id):
+        """Forgets the partition of a guild we left (the subscriptions stay in Mongo)."""
+        if self.guild_ids is not None:
+            self.guild_ids.discard(guild_id)
+        self.guilds.pop(guild_id, None)
+
+    async def refresh_periodically(self, interval):
+        """Background task reloading the cache from Mongo every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load(self.guild_ids)
+            except Exception as e:
+                print(f"Error refreshing subscription cache: {e}")
+
+    def stats(self):
+        """:return: A dict with how many of each kind of subscription are cached."""
+        partitions = self.guilds.values()
+        return {
+            "guilds": len(self.guilds),
+            "keywords": sum(len(keywords) for partition in partitions for keywords in partition.keywords.values()),
+            "topics": sum(len(partition.topic_index) for partition in partitions if partition.topic_index is not None),
+            "bookmarks": sum(_count(bookmarks) for partition in partitions for bookmarks in partition.bookmarks.values()),
+            "reminders": sum(len(reminders) for reminders in self.reminders.values()),
+            "private_channels": len(self.private_channels),
+        }
+
+    def _partitions(self, guild_id):
+        """The partitions that apply to a guild: its own and the global one."""
+        partitions = []
+        for key in (guild_id, None) if guild_id is not None else (None,):
+            partition = self.guilds.get(key)
+            if partition is not None:
+                partitions.append(partition)
+        return partitions
+
+    def _partition(self, state, guild_id):
+        partition = state["guilds"].get(guild_id)
+        if partition is None:
+            partition = state["guilds"][guild_id] = GuildSubscriptions(self.keyword_table)
+        return partition
+
+    # keywords
+
+    def keywords_for(self, user_id, guild_id):
+        """:return: The keywords the user tracks in this guild (including their global ones)."""
+        strings = self.keyword_table
+        keywords = set()
+        for partition in self._partitions(guild_id):
+            keywords.update(strings[keyword_id] for keyword_id in partition.keywords.get(user_id, ()))
+        return keywords
+
+    def match_keywords(self, text, guild_id):
+        """:return: A dict of user_id -> keywords of that user found in a message from this guild."""
+        partitions = self._partitions(guild_id)
+        if len(partitions) == 1:
+            return partitions[0].keyword_index.match(text)
+        matches = {}
+        # a keyword tracked in the guild and globally (maybe spelled "Foo" in one and "foo" in the other) is one match
+        seen = {}
+        for partition in partitions:
+            for user_id, keywords in partition.keyword_index.match(text).items():
+                lowered = seen.setdefault(user_id, set())
+                for keyword in keywords:
+                    if keyword.lower() not in lowered:
+                        lowered.add(keyword.lower())
+                        matches.setdefault(user_id, []).append(keyword)
+        return matches
+
+    async def add_keyword(self, user_id, guild_id, keyword):
+        """:return: True if the keyword was added, False if the user already tracks it."""
+        return bool(await self.add_keywords(user_id, guild_id, [keyword]))
+
+    async def add_keywords(self, user_id, guild_id, keywords):
+        """Adds several keywords to a user's subscriptions in a guild, in one atomic upsert.
+
+        :param guild_id: The guild id, or None for keywords that apply everywhere.
+        :return: The keywords that were actually added (the rest were already tracked).
+        """
+        tracked = self.keywords_for(user_id, guild_id)
+        keywords = [k for k in dict.fromkeys(keywords) if k not in tracked]
+        if not keywords:
+            return []
+        before = await self.repository.keywords.find_one_and_update(
+            {"user_id": user_id, "guild_id": guild_id},
+            {"$addToSet": {"keywords": {"$each": keywords}}},
+            projection={"_id": 0, "keywords": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        existing = set(before.get("keywords", [])) if before else set()
+        added = [k for k in keywords if k not in existing]
+        self._mutate(lambda state: [self._apply_add_keyword(state, user_id, guild_id, k) for k in keywords])
+        self._rebuild_keyword_index_soon(guild_id)
+        return added
+
+    async def remove_keyword(self, user_id, guild_id, keyword):
+        """:return: True if the user was tracking the keyword."""
+        return bool(await self.remove_keywords(user_id, guild_id, [keyword]))
+
+    async def remove_keywords(self, user_id, guild_id, keywords):
+        """Removes keywords from a user's subscriptions in a guild and from their global ones.
+
+        :return: The keywords the user was actually tracking.
+        """
+        tracked = self.keywords_for(user_id, guild_id)
+        keywords = list(dict.fromkeys(keywords))
+        await self.repository.keywords.update_many(
+            {"user_id": user_id, "guild_id": {"$in": [guild_id, None]}},
+            {"$pull": {"keywords": {"$in": keywords}}}
+        )
+        self._mutate(lambda state: [self._apply_remove_keyword(state, user_id, partition_id, k)
+                                    for partition_id in {guild_id, None} for k in keywords])
+        for partition_id in {guild_id, None}:
+            self._rebuild_keyword_index_soon(partition_id)
+        return [k for k in keywords if k in tracked]
+
+    def _apply_add_keyword(self, state, user_id, guild_id, keyword):
+        partition = self._partition(state, guild_id)
+        keyword_id = self.keyword_table.intern(keyword)
+        keywords = partition.keywords.get(user_id)
+        if keywords is None:
+            keywords = partition.keywords[user_id] = array('I')
+        if keyword_id not in keywords:
+            keywords.append(keyword_id)
+        partition.keyword_index.add(user_id, keyword)
+
+    def _apply_remove_keyword(self, state, user_id, guild_id, keyword):
+        partition = state["guilds"].get(guild_id)
+        keywords = partition.keywords.get(user_id) if partition else None
+        keyword_id = self.keyword_table.get(keyword)
+        if keywords is None or keyword_id is None or keyword_id not in keywords:
+            return
+        keywords.remove(keyword_id)
+        if not keywords:
+            del partition.keywords[user_id]
+        # another spelling of the same keyword (e.g. "Foo" and "foo") keeps the index entry alive
+        lowered = keyword.lower()
+        remaining = next((self.keyword_table[k] for k in keywords if self.keyword_table[k].lower() == lowered), None)
+        if remaining is None:
+            partition.keyword_index.remove(user_id, keyword)
+        else:
+            partition.keyword_index.add(user_id, remaining)
+
+    # topics
+
+    def topics_for(self, user_id, guild_id):
+        """:return: The topics the user follows in this guild (including their global ones)."""
+        topics = set()
+        for partition in self._partitions(guild_id):
+            topics.update(partition.topics.get(user_id, ()))
+        return topics
+
+    def has_topics(self, guild_id):
+        """:return: True if anyone follows a topic that applies to messages from this guild."""
+        return any(partition.topic_index for partition in self._partitions(guild_id))
+
+    def match_topics(self, vectors, guild_id):
+        """Scores a batch of message vectors against the topics that apply to a guild.
+
+        :param vectors: A (B, dimensions) matrix from `self.vectorizer.transform`.
+        :return: One dict per message: user_id -> topics of that user the message is about.
+        """
+        results = [{} for _ in range(len(vectors))]
+        for partition in self._partitions(guild_id):
+            if not partition.topic_index:
+                continue
+            for merged, matches in zip(results, partition.topic_index.match(vectors)):
+                for user_id, topics in matches.items():
+                    merged.setdefault(user_id, []).extend(t for t in topics if t not in merged.get(user_id, ()))
+        return results
+
+    async def add_topic(self, user_id, guild_id, topic):
+        """:return: True if the topic was added, False if the user already follows it."""
+        if topic in self.topics_for(user_id, guild_id):
+            return False
+        before = await self.repository.topics.find_one_and_update(
+            {"user_id": user_id, "guild_id": guild_id},
+            {"$addToSet": {"topics": topic}},
+            projection={"_id": 0, "topics": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        self._mutate(lambda state: self._apply_add_topic(state, user_id, guild_id, topic))
+        return not before or topic not in before.get("topics", [])
+
+    async def remove_topic(self, user_id, guild_id, topic):
+        """Removes a topic from a user's subscriptions in a guild and from their global ones.
+
+        :return: True if the user was following the topic.
+        """
+        followed = topic in self.topics_for(user_id, guild_id)
+        result = await self.repository.topics.update_many(
+            {"user_id": user_id, "guild_id": {"$in": [guild_id, None]}},
+            {"$pull": {"topics": topic}}
+        )
+        self._mutate(lambda state: [self._apply_remove_topic(state, user_id, partition_id, topic)
+                                    for partition_id in {guild_id, None}])
+        return followed or result.modified_count > 0
+
+    def _apply_add_topic(self, state, user_id, guild_id, topic):
+        partition = self._partition(state, guild_id)
+        if partition.topic_index is None:
+            partition.topic_index = TopicIndex(self.vectorizer, self.topic_threshold)
+        partition.topics.setdefault(user_id, set()).add(topic)
+        partition.topic_index.add(user_id, topic)
+
+    @staticmethod
+    def _apply_remove_topic(state, user_id, guild_id, topic):
+        partition = state["guilds"].get(guild_id)
+        topics = partition.topics.get(user_id) if partition else None
+        if topics is None or topic not in topics:
+            return
+        topics.discard(topic)
+        if not topics:
+            del partition.topics[user_id]
+        partition.topic_index.remove(user_id, topic)
+
+    # bookmarks
+
+    def bookmarks_for(self, user_id, guild_id):
+        """:return: The author ids the user bookmarked in this guild (including their global bookmarks)."""
+        bookmarks = set()
+        for partition in self._partitions(guild_id):
+            bookmarks.update(_ids(partition.bookmarks, user_id))
+        return bookmarks
+
+    def bookmark_subscribers_for(self, author_id, guild_id):
+        """:return: The ids of the users who bookmarked this author, for a message from this guild."""
+        partitions = self._partitions(guild_id)
+        if len(partitions) == 1:
+            return _ids(partitions[0].bookmark_subscribers, author_id)
+        subscribers = set()
+        for partition in partitions:
+            subscribers.update(_ids(partition.bookmark_subscribers, author_id))
+        return subscribers
+
+    async def add_bookmark(self, user_id, guild_id, user_id_bookmark):
+        """:return: True if the bookmark was added, False if it already existed."""
+        return bool(await self.add_bookmarks(user_id, guild_id, [user_id_bookmark]))
+
+    async def add_bookmarks(self, user_id, guild_id, user_id_bookmarks):
+        """Adds several bookmarks to a user's subscriptions in a guild, in one atomic upsert.
+
+        :return: The bookmarks that were actually added.
+        """
+        tracked = self.bookmarks_for(user_id, guild_id)
+        user_id_bookmarks = [b for b in dict.fromkeys(user_id_bookmarks) if b not in tracked]
+        if not user_id_bookmarks:
+            return []
+        before = await self.repository.bookmarks.find_one_and_update(
+            {"user_id": user_id, "guild_id": guild_id},
+            {"$addToSet": {"bookmarks": {"$each": user_id_bookmarks}}},
+            projection={"_id": 0, "bookmarks": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        existing = set(before.get("bookmarks", [])) if before else set()
+        self._mutate(lambda state: [self._apply_add_bookmark(state, user_id, guild_id, b) for b in user_id_bookmarks])
+        return [b for b in user_id_bookmarks if b not in existing]
+
+    async def remove_bookmark(self, user_id, guild_id, user_id_bookmark):
+        """Removes a bookmark from a user's subscriptions in a guild and from their global ones.
+
+        :return: True if the bookmark existed.
+        """
+        tracked = user_id_bookmark in self.bookmarks_for(user_id, guild_id)
+        result = await self.repository.bookmarks.update_many(
+            {"user_id": user_id, "guild_id": {"$in": [guild_id, None]}},
+            {"$pull": {"bookmarks": user_id_bookmark}}
+        )
+        self._mutate(lambda state: [self._apply_remove_bookmark(state, user_id, partition_id, user_id_bookmark)
+                                    for partition_id in {guild_id, None}])
+        return tracked or result.modified_count > 0
+
+    def _apply_add_bookmark(self, state, user_id, guild_id, user_id_bookmark):
+        partition = self._partition(state, guild_id)
+        _add_id(partition.bookmarks, user_id, user_id_bookmark)
+        _add_id(partition.bookmark_subscribers, user_id_bookmark, user_id)
+
+    @staticmethod
+    def _apply_remove_bookmark(state, user_id, guild_id, user_id_bookmark):
+        partition = state["guilds"].get(guild_id)
+        if partition is None:
+            return
+        _remove_id(partition.bookmarks, user_id, user_id_bookmark)
+        _remove_id(partition.bookmark_subscribers, user_id_bookmark, user_id)
+
+    # reminders
+
+    def reminders_for(self, user_id):
+        """:return: A dict of label -> reminder time for the user."""
+        return self.reminders.get(user_id, {})
+
+    async def add_reminder(self, user_id, label, reminder_time):
+        """:return: The new reminder's _id, or None if the user already has a reminder with this label."""
+        # only inserts if there's no reminder with this label yet, in a single round trip. the cache isn't asked
+        # first, with several processes it can still list a reminder that was sent (and deleted) elsewhere
+        result = await self.repository.reminders.update_one(
+            {"user_id": user_id, "label": label},
+            {"$setOnInsert": {"reminder_time": reminder_time}},
+            upsert=True
+        )
+        if result.upserted_id is None:
+            return None
+        self._mutate(lambda state: self._apply_add_reminder(state, user_id, label, reminder_time))
+        return result.upserted_id
+
+    async def add_reminders(self, user_id, reminders):
+        """Adds several reminders with one bulk write, skipping labels the user already has.
+
+        :param reminders: A list of (label, reminder_time) tuples.
+        :return: A list of (reminder _id, label, reminder_time) for the reminders that were added.
+        """
+        reminders = list(dict(reminders).items())
+        if not reminders:
+            return []
+        result = await self.repository.reminders.bulk_write([
+            UpdateOne({"user_id": user_id, "label": label}, {"$setOnInsert": {"reminder_time": reminder_time}}, upsert=True)
+            for label, reminder_time in reminders
+        ], ordered=False)
+        added = [(reminder_id, *reminders[index]) for index, reminder_id in result.upserted_ids.items()]
+        self._mutate(lambda state: [self._apply_add_reminder(state, user_id, label, reminder_time)
+                                    for _, label, reminder_time in added])
+        return added
+
+    async def remove_reminder(self, user_id, label):
+        """:return: True if the reminder existed."""
+        result = await self.repository.reminders.delete_one({"user_id": user_id, "label": label})
+        self.forget_reminder(user_id, label)
+        return result.deleted_count > 0
+
+    def forget_reminder(self, user_id, label):
+        """Drops a reminder from memory only, for when it was already deleted from Mongo (e.g. after sending it)."""
+        self._mutate(lambda state: self._apply_remove_reminder(state, user_id, label))
+
+    @staticmethod
+    def _apply_add_reminder(state, user_id, label, reminder_time):
+        state["reminders"].setdefault(user_id, {})[label] = reminder_time
+
+    @staticmethod
+    def _apply_remove_reminder(state, user_id, label):
+        reminders = state["reminders"].get(user_id)
+        if reminders is not None:
+            reminders.pop(label, None)
+            if not reminders:
+                del state["reminders"][user_id]
+
+    # private channels
+
+    def private_channel_for(self, user_id):
+        return self.private_channels.get(user_id)
+
+    async def set_private_channel(self, user_id, channel_id):
+        await self.repository.private_channels.insert_one({
+            "user_id": user_id,
+            "channel_id": channel_id
+        })
+        self._mutate(lambda state: state["private_channels"].__setitem__(user_id, channel_id))
+
+    # per-user settings
+
+    def setting_for(self, user_id, name, default=None):
+        return self.settings.get(user_id, {}).get(name, default)
+
+    async def set_setting(self, user_id, name, value):
+        await self.repository.settings.update_one({"user_id": user_id}, {"$set": {name: value}}, upsert=True)
+        self._mutate(lambda state: state["settings"].setdefault(user_id, {}).__setitem__(name, value))
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+def process_id():
+    """A name for this process that's unique across machines and restarts, e.g. "host:1234:9f2c01ab"."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def to_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+class Lease:
+    """Leader election between bot processes sharing one database, using a lease document in Mongo.
+
+    The lease is a document {_id: name, owner, expires_at}. Whoever holds it renews it every `renew_interval`
+    seconds (the heartbeat), and anyone may take it over once it's expired, so if the holder dies another
+    process becomes leader within `ttl` seconds. Taking and renewing are one atomic find_one_and_update,
+    so two processes can never both get it.
+
+    We consider the lease lost as soon as `ttl` seconds passed since we last renewed it (counted from before
+    the request went out), so with clocks roughly in sync there's never a moment where two processes think
+    they hold it.
+
+    :param collection: The AsyncCollection lease documents live in.
+    :param name: What the lease is for, e.g. "reminders".
+    :param owner: This process's id, defaults to `process_id()`.
+    :param ttl: Seconds a lease stays valid without being renewed.
+    :param renew_interval: Seconds between heartbeats (and between attempts to take the lease over).
+    :param clock: Returns the current time in epoch seconds.
+    """
+
+    def __init__(self, collection, name, owner=None, ttl=30.0, renew_interval=10.0, clock=time.time):
+        self.collection = collection
+        self.name = name
+        self.owner = owner or process_id()
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.clock = clock
+        self._expires_at = None
+        self._elected = asyncio.Event()
+        self.elections = 0
+
+    @property
+    def held(self):
+        """True while we hold the lease."""
+        return self._expires_at is not None and self.clock() < self._expires_at
+
+    async def wait_elected(self):
+        """Waits until we hold the lease."""
+        while not self.held:
+            self._elected.clear()
+            await self._elected.wait()
+
+    async def acquire(self):
+        """Takes the lease if it's free or expired, or renews it if it's ours.
+
+        :return: True if we hold the lease now.
+        """
+        now = self.clock()
+        try:
+            doc = await self.collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": to_datetime(now)}}]},
+                {"$set": {"owner": self.owner, "expires_at": to_datetime(now + self.ttl), "renewed_at": to_datetime(now)}},
+                projection={"_id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # the lease exists and someone else holds it, so our upsert tried to create a second one
+            doc = None
+        was_held = self.held
+        self._expires_at = now + self.ttl if doc is not None else None
+        if self.held and not was_held:
+            self.elections += 1
+            print(f"{self.owner} now holds the {self.name} lease")
+            self._elected.set()
+        elif was_held and not self.held:
+            print(f"{self.owner} lost the {self.name} lease")
+        return self.held
+
+    async def release(self):
+        """Gives the lease up right away (e.g. when shutting down), so another process can take over."""
+        self._expires_at = None
+        await self.collection.update_one(
+            {"_id": self.name, "owner": self.owner},
+            {"$set": {"expires_at": to_datetime(0)}}
+        )
+
+    async def run(self):
+        """Background task: takes the lease whenever it's free and keeps renewing it. Runs forever."""
+        while True:
+            try:
+                await self.acquire()
+            except Exception as e:
+                print(f"Error renewing the {self.name} lease: {e}")
+            await asyncio.sleep(self.renew_interval)
@@ -0,0 +1,220 @@
+import asyncio
+import functools
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from metrics import registry
+
+MONGO_SECONDS = registry.histogram("mongo_call_seconds", "Time MongoDB calls took, including the wait for a worker thread",
+                                   ("collection", "operation"))
+MONGO_ERRORS = registry.counter("mongo_errors_total", "MongoDB calls that raised", ("collection", "operation"))
+
+# error code of a write that would break a unique index
+DUPLICATE_KEY = 11000
+
+
+def to_id(value):
+    """Converts a Discord id from Mongo (an int, or a string in documents from before ids were ints) to an int."""
+    return None if value is None else int(value)
+
+
+def _int_ids(doc):
+    """:return: The id fields of a document from before ids were ints, converted."""
+    converted = {}
+    for field in ("user_id", "guild_id", "channel_id"):
+        if field in doc:
+            converted[field] = to_id(doc[field])
+    if "bookmarks" in doc:
+        converted["bookmarks"] = [to_id(value) for value in doc["bookmarks"]]
+    return converted
+
+
+class AsyncCollection:
+    """Async wrapper around a pymongo collection.
+
+    pymongo blocks, so every call is handed to a small thread pool and awaited. That way a slow Mongo round
+    trip only holds up the command that made it instead of every event the bot is handling.
+    """
+
+    def __init__(self, collection, executor):
+        self.collection = collection
+        self._executor = executor
+
+    @property
+    def name(self):
+        return self.collection.name
+
+    async def _run(self, operation, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+        except Exception:
+            MONGO_ERRORS.inc(self.collection.name, operation)
+            raise
+        finally:
+            MONGO_SECONDS.observe(time.perf_counter() - started, self.collection.name, operation)
+
+    async def find_one(self, *args, **kwargs):
+        return await self._run("find_one", self.collection.find_one, *args, **kwargs)
+
+    async def find(self, *args, **kwargs):
+        """Runs a find and reads the whole cursor in the worker thread.
+
+        :return: A list with every matching document.
+        """
+        return await self._run("find", lambda: list(self.collection.find(*args, **kwargs)))
+
+    async def find_batches(self, filter, projection=None, batch_size=1000, sort=None):
+        """Runs a find and yields the documents in lists of up to `batch_size`.
+
+        Each batch is read in the worker thread, and other events get handled between batches,
+        so loading a big collection neither blocks the bot nor needs the whole result in memory at once.
+
+        :param sort: Optional list of (key, direction) pairs to sort by.
+        """
+        # creating the cursor doesn't talk to the server yet, only iterating it does
+        cursor = self.collection.find(filter, projection, batch_size=batch_size, sort=sort)
+        try:
+            while True:
+                batch = await self._run("find", lambda: list(itertools.islice(cursor, batch_size)))
+                if not batch:
+                    return
+                yield batch
+        finally:
+            cursor.close()
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run("insert_one", self.collection.insert_one, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run("update_one", self.collection.update_one, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self._run("update_many", self.collection.update_many, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._run("delete_one", self.collection.delete_one, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self._run("delete_many", self.collection.delete_many, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await self._run("find_one_and_update", self.collection.find_one_and_update, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self._run("bulk_write", self.collection.bulk_write, *args, **kwargs)
+
+    async def create_index(self, *args, **kwargs):
+        return await self._run("create_index", self.collection.create_index, *args, **kwargs)
+
+    async def drop_index(self, *args, **kwargs):
+        return await self._run("drop_index", self.collection.drop_index, *args, **kwargs)
+
+
+class Repository:
+    """The bot's data layer: one AsyncCollection per collection, all sharing one bounded thread pool.
+
+    :param db: The pymongo database.
+    :param max_workers: How many Mongo calls may be in flight at once.
+    """
+
+    def __init__(self, db, max_workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mongo")
+        self.keywords = AsyncCollection(db["keywords"], self.executor)
+        self.bookmarks = AsyncCollection(db["bookmarks"], self.executor)
+        self.topics = AsyncCollection(db["topics"], self.executor)
+        self.reminders = AsyncCollection(db["reminders"], self.executor)
+        self.private_channels = AsyncCollection(db["private_channels"], self.executor)
+        self.settings = AsyncCollection(db["settings"], self.executor)
+        self.summaries = AsyncCollection(db["summaries"], self.executor)
+        self.leases = AsyncCollection(db["leases"], self.executor)
+        self.migrations = AsyncCollection(db["migrations"], self.executor)
+
+    async def ensure_indexes(self):
+        """Creates the indexes every lookup relies on (creating an index that already exists is a no-op).
+
+        An index that can't be built (e.g. a unique one over data that has duplicates) is reported and skipped
+        so the bot still starts.
+        """
+        # keywords and bookmarks used to be one document per user, now it's one per user and guild
+        for collection in (self.keywords, self.bookmarks):
+            try:
+                await collection.drop_index("user_id_1")
+            except OperationFailure:
+                pass
+        indexes = [
+            (self.keywords, [("user_id", ASCENDING), ("guild_id", ASCENDING)], {"unique": True}),
+            (self.keywords, [("guild_id", ASCENDING)], {}),
+            (self.bookmarks, [("user_id", ASCENDING), ("guild_id", ASCENDING)], {"unique": True}),
+            (self.bookmarks, [("guild_id", ASCENDING)], {}),
+            (self.topics, [("user_id", ASCENDING), ("guild_id", ASCENDING)], {"unique": True}),
+            (self.topics, [("guild_id", ASCENDING)], {}),
+            (self.private_channels, [("user_id", ASCENDING)], {"unique": True}),
+            (self.settings, [("user_id", ASCENDING)], {"unique": True}),
+            (self.reminders, [("user_id", ASCENDING), ("label", ASCENDING)], {"unique": True}),
+            (self.reminders, [("reminder_time", ASCENDING)], {}),
+            (self.summaries, [("channel_id", ASCENDING), ("num_messages", ASCENDING)], {"unique": True}),
+        ]
+        for collection, keys, options in indexes:
+            try:
+                await collection.create_index(keys, **options)
+            except OperationFailure as e:
+                print(f"Could not create index {keys} on {collection.name}: {e}")
+
+    async def migrate_ids(self, batch_size=1000):
+        """Converts user, guild, channel and bookmarked ids stored as strings (like the bot used to) to ints.
+
+        Int ids take less space in Mongo and in the subscription cache, and Discord ids always fit in 64 bits.
+        A keyword/topic/bookmark document whose int twin already exists is merged into it. For the other
+        collections the int document wins and the string one is deleted. Once done, a marker in the migrations
+        collection makes later calls return right away. It's safe to run in several processes at once.
+
+        :return: How many documents were converted.
+        """
+        if await self.migrations.find_one({"_id": "int_ids"}):
+            return 0
+        converted = 0
+        for collection, field in ((self.keywords, "keywords"), (self.topics, "topics"), (self.bookmarks, "bookmarks")):
+            query = {"$or": [{"user_id": {"$type": "string"}}, {"guild_id": {"$type": "string"}}, {"bookmarks": {"$type": "string"}}]}
+            async for batch in collection.find_batches(query, None, batch_size):
+                # converting in place is one write per document by _id, only documents that already have an
+                # int twin (the unique index refuses the update) get merged into it
+                operations = [UpdateOne({"_id": doc["_id"]}, {"$set": _int_ids(doc)}) for doc in batch]
+                try:
+                    await collection.bulk_write(operations, ordered=False)
+                except BulkWriteError as e:
+                    errors = e.details["writeErrors"]
+                    if any(error["code"] != DUPLICATE_KEY for error in errors):
+                        raise
+                    merges = []
+                    for error in errors:
+                        doc = batch[error["index"]]
+                        doc.update(_int_ids(doc))
+                        key = {"user_id": doc["user_id"], "guild_id": doc.get("guild_id")}
+                        merges.append(UpdateOne(key, {"$addToSet": {field: {"$each": doc.get(field, [])}}}))
+                        merges.append(DeleteOne({"_id": doc["_id"]}))
+                    await collection.bulk_write(merges, ordered=True)
+                converted += len(batch)
+        for collection in (self.reminders, self.private_channels, self.settings):
+            query = {"$or": [{"user_id": {"$type": "string"}}, {"channel_id": {"$type": "string"}}]}
+            async for batch in collection.find_batches(query, {"user_id": 1, "channel_id": 1}, batch_size):
+                operations = []
+                for doc in batch:
+                    operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": _int_ids(doc)}))
+                try:
+                    await collection.bulk_write(operations, ordered=False)
+                except BulkWriteError as e:
+                    # the int version of this document already exists
+                    duplicates = [batch[error["index"]]["_id"] for error in e.details["writeErrors"] if error["code"] == DUPLICATE_KEY]
+                    if len(duplicates) < len(e.details["writeErrors"]):
+                        raise
+                    await collection.delete_many({"_id": {"$in": duplicates}})
+                converted += len(batch)
+        await self.migrations.update_one({"_id": "int_ids"}, {"$set": {"completed_at": datetime.now(timezone.utc)}}, upsert=True)
+        return converted
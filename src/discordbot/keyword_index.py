@@ -0,0 +1,316 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+
+class KeywordTable:
+    """Gives every distinct keyword an int id, so each string is stored once however many users track it.
+
+    Ids are never reused (a keyword nobody tracks anymore keeps its id), which keeps them valid in every
+    partition and array that refers to them. There are far fewer distinct keywords than subscriptions.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._strings = []
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __getitem__(self, keyword_id):
+        return self._strings[keyword_id]
+
+    def intern(self, keyword):
+        """:return: The id of `keyword`, giving it a new one if it's the first time we see it."""
+        keyword_id = self._ids.get(keyword)
+        if keyword_id is None:
+            keyword_id = self._ids[keyword] = len(self._strings)
+            self._strings.append(keyword)
+        return keyword_id
+
+    def get(self, keyword):
+        """:return: The id of `keyword`, or None if nobody ever tracked it."""
+        return self._ids.get(keyword)
+
+
+# a transition is stored under (state << _SHIFT | code point), every code point fits in 21 bits
+_SHIFT = 21
+_CODE_MASK = (1 << _SHIFT) - 1
+
+
+class Automaton:
+    """An Aho-Corasick automaton over a fixed set of keywords, built once and never changed afterwards.
+
+    Because nothing writes to it after it's built, it can be built in another thread while the old one keeps
+    serving searches, and then swapped in. The transitions of every node live in one flat dict and the failure
+    links in an array, which takes about half the memory of a dict per node.
+
+    :param table: The KeywordTable the keyword ids come from.
+    :param pattern_ids: Ids of the lowered keywords to match.
+    """
+
+    __slots__ = ("pattern_ids", "_members", "_goto", "_fail", "_outputs")
+
+    def __init__(self, table=None, pattern_ids=()):
+        pattern_ids = list(pattern_ids)
+        self.pattern_ids = array('I', pattern_ids)
+        self._members = bytearray(max(self.pattern_ids, default=-1) + 1)
+        goto = {}
+        terminal = {}
+        states = 1
+        # the ids from the list (not read back from the array), so the automaton shares those int objects
+        for pattern_id in pattern_ids:
+            self._members[pattern_id] = 1
+            state = 0
+            for code in map(ord, table[pattern_id]):
+                key = state << _SHIFT | code
+                next_state = goto.get(key)
+                if next_state is None:
+                    next_state = goto[key] = states
+                    states += 1
+                state = next_state
+            terminal[state] = pattern_id
+
+        # breadth first so the failure link of a node is always computed before its children
+        children = [[] for _ in range(states)]
+        for key, child in goto.items():
+            children[key >> _SHIFT].append((key & _CODE_MASK, child))
+        fail = array('I', bytes(4 * states))
+        # state -> id of the keyword ending there, or a tuple of ids when keywords ending at a suffix of it end
+        # there too (rare, so most states store a plain int). only states where keywords end are in here
+        outputs = dict(terminal)
+        queue = deque(child for _, child in children[0])
+        while queue:
+            state = queue.popleft()
+            for code, child in children[state]:
+                link = fail[state]
+                while link and (link << _SHIFT | code) not in goto:
+                    link = fail[link]
+                fail[child] = link = goto.get(link << _SHIFT | code, 0)
+                inherited = outputs.get(link)
+                if inherited is not None:
+                    own = outputs.get(child)
+                    if own is None:
+                        outputs[child] = inherited
+                    else:
+                        outputs[child] = (own,) + (inherited if type(inherited) is tuple else (inherited,))
+                queue.append(child)
+        self._goto, self._fail, self._outputs = goto, fail, outputs
+
+    def __contains__(self, pattern_id):
+        return pattern_id < len(self._members) and self._members[pattern_id] == 1
+
+    def search(self, text):
+        """:return: The set of ids of the keywords found in `text` (which has to be lowered already)."""
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        found = set()
+        state = 0
+        for code in map(ord, text):
+            while True:
+                next_state = goto.get(state << _SHIFT | code)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            output = outputs.get(state)
+            if output is not None:
+                if type(output) is tuple:
+                    found.update(output)
+                else:
+                    found.add(output)
+        return found
+
+
+class KeywordIndex:
+    """Aho-Corasick automaton over every tracked keyword, so one pass over a message finds all of them.
+
+    Keywords are matched case-insensitively as substrings (same as the old `keyword.lower() in content.lower()`
+    loop), and every keyword maps back to the users subscribed to it.
+
+    Building the automaton takes time proportional to all the keywords, so it isn't rebuilt on every change.
+    Keywords added since it was built wait in a small pending list that's checked with a plain `in`, and
+    keywords nobody tracks anymore stay in it but are skipped. Once `needs_rebuild` says there are too many of
+    either, the owner builds a new Automaton from `pattern_ids()` (off the event loop, the SubscriptionCache
+    uses an executor) and swaps it in with `install`, which also drops the nodes of the untracked keywords.
+
+    Keywords are stored as ids from a KeywordTable and each keyword's subscribers as a sorted array of user ids,
+    which takes a fraction of the memory of a dict per keyword, or as just the user id for keywords with a single
+    subscriber (most of them). How each user typed the keyword is only kept (in a parallel array, or as a single
+    id) for keywords someone typed differently from the lowered form.
+
+    :param table: The KeywordTable to intern keywords in, shared by every index of a SubscriptionCache.
+    :param max_pending: How many keywords can wait outside the automaton before it should be rebuilt.
+    """
+
+    def __init__(self, table=None, max_pending=64):
+        self.table = table if table is not None else KeywordTable()
+        self.max_pending = max_pending
+        self._automaton = Automaton()
+        # id -> lowered keyword, for keywords added since the automaton was built
+        self._pending = {}
+        # how many keywords in the automaton nobody tracks anymore
+        self._untracked = 0
+        # id of the lowered keyword -> sorted user ids, and for some keywords the ids of the keyword as each user typed it
+        self._subscribers = {}
+        self._spellings = {}
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def __contains__(self, keyword):
+        return self.table.get(keyword.lower()) in self._subscribers
+
+    @property
+    def needs_rebuild(self):
+        """True once enough keywords were added or removed since the automaton was built to build a new one."""
+        return (len(self._pending) > self.max_pending
+                or self._untracked > max(self.max_pending, len(self._subscribers) // 4))
+
+    def pattern_ids(self):
+        """:return: A list of the ids of every tracked (lowered) keyword, to build an Automaton from."""
+        return list(self._subscribers)
+
+    def install(self, automaton):
+        """Swaps in an automaton built from an earlier `pattern_ids()`.
+
+        Keywords added since then stay pending, and the ones removed since then count as untracked.
+        """
+        self._automaton = automaton
+        self._pending = {pattern_id: pattern for pattern_id, pattern in self._pending.items() if pattern_id not in automaton}
+        self._untracked = sum(1 for pattern_id in automaton.pattern_ids if pattern_id not in self._subscribers)
+
+    def rebuild(self):
+        """Builds the automaton from scratch, right here. Fine while loading, too slow for a message handler."""
+        self.install(Automaton(self.table, self.pattern_ids()))
+
+    def add(self, user_id, keyword):
+        """Subscribes a user to a keyword.
+
+        :param user_id: The user who wants to be notified (an int).
+        :param keyword: The keyword to track.
+        """
+        pattern = keyword.lower()
+        if not pattern:
+            return
+        pattern_id = self.table.intern(pattern)
+        spelling_id = self.table.intern(keyword)
+        users = self._subscribers.get(pattern_id)
+        if users is None:
+            # most keywords have a single subscriber, stored as a plain int (and so is their spelling)
+            self._subscribers[pattern_id] = user_id
+            if spelling_id != pattern_id:
+                self._spellings[pattern_id] = spelling_id
+            if pattern_id in self._automaton:
+                self._untracked -= 1
+            else:
+                self._pending[pattern_id] = pattern
+            return
+        if type(users) is int:
+            if users == user_id:
+                if spelling_id != pattern_id:
+                    self._spellings[pattern_id] = spelling_id
+                else:
+                    self._spellings.pop(pattern_id, None)
+                return
+            users = self._subscribers[pattern_id] = array('Q', [users])
+            spelling = self._spellings.get(pattern_id)
+            if spelling is not None:
+                self._spellings[pattern_id] = array('I', [spelling])
+        # users loaded in id order land at the end, so building a popular keyword's array doesn't shift anything
+        position = bisect_left(users, user_id)
+        subscribed = position < len(users) and users[position] == user_id
+        if not subscribed:
+            users.insert(position, user_id)
+        spellings = self._spellings.get(pattern_id)
+        if spellings is not None:
+            if subscribed:
+                spellings[position] = spelling_id
+            else:
+                spellings.insert(position, spelling_id)
+        elif spelling_id != pattern_id:
+            spellings = self._spellings[pattern_id] = array('I', [pattern_id]) * len(users)
+            spellings[position] = spelling_id
+
+    def remove(self, user_id, keyword):
+        """Unsubscribes a user from a keyword.
+
+        A keyword nobody tracks anymore stays in the automaton (and is skipped) until the next rebuild.
+
+        :param user_id: The user who no longer wants notifications.
+        :param keyword: The keyword to stop tracking.
+        """
+        pattern_id = self.table.get(keyword.lower())
+        users = self._subscribers.get(pattern_id)
+        if users is None:
+            return
+        if type(users) is int:
+            if users != user_id:
+                return
+        else:
+            position = bisect_left(users, user_id)
+            if position == len(users) or users[position] != user_id:
+                return
+            del users[position]
+            spellings = self._spellings.get(pattern_id)
+            if spellings is not None:
+                del spellings[position]
+        if type(users) is int or not users:
+            del self._subscribers[pattern_id]
+            self._spellings.pop(pattern_id, None)
+            if pattern_id in self._automaton:
+                self._untracked += 1
+            else:
+                del self._pending[pattern_id]
+
+    def remove_user(self, user_id):
+        """Drops every subscription of a user."""
+        for pattern_id in [p for p, users in self._subscribers.items()
+                           if (users == user_id if type(users) is int else user_id in users)]:
+            self.remove(user_id, self.table[pattern_id])
+
+    def clear(self):
+        self.__init__(self.table, self.max_pending)
+
+    def search(self, text):
+        """Finds every tracked keyword that shows up in the text.
+
+        :param text: The message content. It's lowered once here, callers don't need to.
+        :return: A set of the lowered keywords found in the text.
+        """
+        return {self.table[pattern_id] for pattern_id in self._search_ids(text) if pattern_id in self._subscribers}
+
+    def _search_ids(self, text):
+        if not self._subscribers:
+            return set()
+        text = text.lower()
+        found = self._automaton.search(text)
+        for pattern_id, pattern in self._pending.items():
+            if pattern in text:
+                found.add(pattern_id)
+        return found
+
+    def match(self, text):
+        """Finds who should be notified about a message.
+
+        :param text: The message content.
+        :return: A dict of user_id -> list of the matched keywords (as each user typed them).
+        """
+        matches = {}
+        strings = self.table
+        for pattern_id in self._search_ids(text):
+            users = self._subscribers.get(pattern_id)
+            if users is None:
+                continue
+            spellings = self._spellings.get(pattern_id)
+            if type(users) is int:
+                matches.setdefault(users, []).append(strings[pattern_id if spellings is None else spellings])
+            elif spellings is None:
+                keyword = strings[pattern_id]
+                for user_id in users:
+                    matches.setdefault(user_id, []).append(keyword)
+            else:
+                for user_id, spelling_id in zip(users, spellings):
+                    matches.setdefault(user_id, []).append(strings[spelling_id])
+        return matches
@@ -0,0 +1,113 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from metrics import registry
+
+OPENAI_SECONDS = registry.histogram("openai_request_seconds", "Time OpenAI requests took, not counting the wait for a slot")
+OPENAI_WAIT_SECONDS = registry.histogram("openai_wait_seconds", "Time OpenAI requests waited for a free slot")
+
+
+class LLMClient:
+    """Async front for the (blocking) OpenAI client.
+
+    Requests run on their own thread pool so the event loop (and the gateway heartbeat) keeps going while we
+    wait for the model. A global limit and a per-guild limit keep one busy server from using every slot.
+    A request that times out keeps its slot until its thread is actually done, so timed out requests can't
+    fill the thread pool behind the limits' back.
+
+    :param model: The chat model to use.
+    :param max_concurrency: Most requests in flight across the whole bot.
+    :param per_guild: Most requests in flight for one guild.
+    :param timeout: Seconds to wait for one request before giving up.
+    """
+
+    def __init__(self, model="gpt-3.5-turbo", max_concurrency=4, per_guild=2, timeout=60.0):
+        self.model = model
+        self.per_guild = per_guild
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="openai")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._guild_semaphores = {}
+        # requests waiting for a slot, and requests currently talking to the API
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.timeouts = 0
+
+    def _create(self, prompt, text):
+        response = openai.ChatCompletion.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": text}
+            ],
+            temperature=0.5,
+            max_tokens=1024,
+            top_p=1.0,
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+            # a thread can't be cancelled, so the HTTP request itself has to give up too
+            request_timeout=self.timeout
+        )
+        return response.choices[0].message['content']
+
+    async def complete(self, prompt, text, guild_id=None):
+        """Asks the chat model to do `prompt` on `text`.
+
+        :param guild_id: The guild the request is for, so it counts against that guild's limit.
+        :return: The model's answer.
+        :raises asyncio.TimeoutError: If the model didn't answer within the timeout.
+        """
+        guild_semaphore = self._guild_semaphores.get(guild_id)
+        if guild_semaphore is None:
+            guild_semaphore = self._guild_semaphores[guild_id] = asyncio.Semaphore(self.per_guild)
+
+        self.waiting += 1
+        queued_at = time.perf_counter()
+        try:
+            await guild_semaphore.acquire()
+            try:
+                await self._semaphore.acquire()
+            except BaseException:
+                guild_semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+        started = time.perf_counter()
+        OPENAI_WAIT_SECONDS.observe(started - queued_at)
+
+        self.in_flight += 1
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, self._create, prompt, text)
+
+        def finished(future):
+            if not future.cancelled():
+                # a request we stopped waiting for may still fail, that's expected and nobody's listening
+                future.exception()
+            self.in_flight -= 1
+            OPENAI_SECONDS.observe(time.perf_counter() - started)
+            self._semaphore.release()
+            guild_semaphore.release()
+
+        try:
+            # shielded, so timing out leaves the future running and `finished` only runs once the thread is done
+            answer = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            self.completed += 1
+            return answer
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            future.add_done_callback(finished)
+
+    def stats(self):
+        """:return: A dict with the queue depth and request counters."""
+        return {
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+        }
@@ -0,0 +1,958 @@
+"""Offline load test and benchmarks for the bot, no Discord server or MongoDB needed.
+
+The pipeline benchmarks import bot.py with MongoDB swapped for an in-memory stand-in and DMs going to a stub
+sender, then drive the real handlers with fake messages. Each benchmark prints its throughput, latency
+percentiles and memory use, so runs can be compared before and after a change.
+
+Examples:
+    python loadtest.py                                  # every benchmark with the default workload
+    python loadtest.py pipeline --users 5000 --keywords 20 --messages 50000 --rate 2000
+    python loadtest.py reminders --reminders 100000
+    python loadtest.py keyword-index dispatcher message-buffer timeparse
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import pickle
+import random
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pymongo
+from pymongo import DeleteOne, ReturnDocument
+
+
+# in-memory MongoDB stand-in
+
+BSON_TYPES = {"string": str, "int": int, "long": int}
+
+
+def _matches(doc, filter):
+    for key, condition in filter.items():
+        if key == "$or":
+            if not any(_matches(doc, option) for option in condition):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            for op, operand in condition.items():
+                if op == "$in":
+                    if not (value in operand or (isinstance(value, list) and any(v in operand for v in value))):
+                        return False
+                elif op == "$lt" and not (value is not None and value < operand):
+                    return False
+                elif op == "$lte" and not (value is not None and value <= operand):
+                    return False
+                elif op == "$gt" and not (value is not None and value > operand):
+                    return False
+                elif op == "$gte" and not (value is not None and value >= operand):
+                    return False
+                elif op == "$type":
+                    # like Mongo, an array matches if any of its elements has the type
+                    values = value if isinstance(value, list) else [value]
+                    if not any(isinstance(v, BSON_TYPES[operand]) and not isinstance(v, bool) for v in values):
+                        return False
+        elif isinstance(value, list) and not isinstance(condition, list):
+            if condition not in value:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    included = [key for key, on in projection.items() if on and key != "_id"]
+    if included:
+        result = {key: doc[key] for key in included if key in doc}
+        if projection.get("_id", 1):
+            result["_id"] = doc["_id"]
+        return result
+    return {key: value for key, value in doc.items() if projection.get(key, 1)}
+
+
+class MemoryCursor:
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    def __iter__(self):
+        return self._docs
+
+    def __next__(self):
+        return next(self._docs)
+
+    def close(self):
+        pass
+
+
+class MemoryCollection:
+    """Just enough of a pymongo collection for the bot: the filters, updates and options it actually uses.
+
+    Indexes are accepted and ignored (unique ones aren't enforced), which is fine for a benchmark.
+    With `copy_on_read`, every read returns new objects like a real driver decoding BSON does, so memory
+    benchmarks see the strings and ids the bot ends up keeping.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name):
+        self.name = name
+        self._docs = {}
+        self.copy_on_read = False
+
+    def _find(self, filter):
+        if filter and len(filter) == 1 and "_id" in filter and not isinstance(filter["_id"], dict):
+            doc = self._docs.get(filter["_id"])
+            return [doc] if doc is not None else []
+        return [doc for doc in self._docs.values() if _matches(doc, filter or {})]
+
+    def find(self, filter=None, projection=None, batch_size=None, sort=None):
+        found = self._find(filter)
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        docs = (_project(doc, projection) for doc in found)
+        if self.copy_on_read:
+            docs = (pickle.loads(pickle.dumps(doc)) for doc in docs)
+        return MemoryCursor(docs)
+
+    def find_one(self, filter=None, projection=None):
+        docs = self._find(filter)
+        return _project(docs[0], projection) if docs else None
+
+    def count_documents(self, filter):
+        return len(self._find(filter))
+
+    def insert_one(self, doc):
+        doc.setdefault("_id", next(self._ids))
+        self._docs[doc["_id"]] = doc
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    def insert_many(self, docs):
+        return SimpleNamespace(inserted_ids=[self.insert_one(doc).inserted_id for doc in docs])
+
+    def _apply(self, doc, update, inserting):
+        for field, value in update.get("$set", {}).items():
+            doc[field] = value
+        if inserting:
+            for field, value in update.get("$setOnInsert", {}).items():
+                doc[field] = value
+        for field, value in update.get("$addToSet", {}).items():
+            values = doc.setdefault(field, [])
+            for item in value["$each"] if isinstance(value, dict) else [value]:
+                if item not in values:
+                    values.append(item)
+        for field, value in update.get("$pull", {}).items():
+            removed = value["$in"] if isinstance(value, dict) else [value]
+            doc[field] = [item for item in doc.get(field, []) if item not in removed]
+
+    def _upsert(self, filter, update):
+        doc = {key: value for key, value in filter.items() if not key.startswith("$") and not isinstance(value, dict)}
+        self._apply(doc, update, inserting=True)
+        return self.insert_one(doc).inserted_id
+
+    def update_one(self, filter, update, upsert=False):
+        docs = self._find(filter)[:1]
+        for doc in docs:
+            self._apply(doc, update, inserting=False)
+        upserted_id = self._upsert(filter, update) if upsert and not docs else None
+        return SimpleNamespace(matched_count=len(docs), modified_count=len(docs), upserted_id=upserted_id)
+
+    def update_many(self, filter, update, upsert=False):
+        docs = self._find(filter)
+        for doc in docs:
+            self._apply(doc, update, inserting=False)
+        return SimpleNamespace(matched_count=len(docs), modified_count=len(docs), upserted_id=None)
+
+    def find_one_and_update(self, filter, update, projection=None, upsert=False, return_document=ReturnDocument.BEFORE):
+        docs = self._find(filter)[:1]
+        if not docs:
+            if not upsert:
+                return None
+            doc = self._docs[self._upsert(filter, update)]
+            return _project(doc, projection) if return_document == ReturnDocument.AFTER else None
+        before = _project(docs[0], projection)
+        before = {key: list(value) if isinstance(value, list) else value for key, value in before.items()}
+        self._apply(docs[0], update, inserting=False)
+        return _project(docs[0], projection) if return_document == ReturnDocument.AFTER else before
+
+    def delete_one(self, filter):
+        docs = self._find(filter)[:1]
+        for doc in docs:
+            del self._docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=len(docs))
+
+    def delete_many(self, filter):
+        docs = self._find(filter)
+        for doc in docs:
+            del self._docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=len(docs))
+
+    def bulk_write(self, operations, ordered=True):
+        upserted_ids = {}
+        for index, operation in enumerate(operations):
+            if isinstance(operation, DeleteOne):
+                self.delete_one(operation._filter)
+            else:
+                result = self.update_one(operation._filter, operation._doc, upsert=operation._upsert)
+                if result.upserted_id is not None:
+                    upserted_ids[index] = result.upserted_id
+        return SimpleNamespace(upserted_ids=upserted_ids)
+
+    def create_index(self, *args, **kwargs):
+        return None
+
+    def drop_index(self, *args, **kwargs):
+        return None
+
+
+class MemoryDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = MemoryCollection(name)
+        return collection
+
+
+class MemoryClient(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+    def __missing__(self, name):
+        database = self[name] = MemoryDatabase()
+        return database
+
+
+# fakes for the Discord side
+
+class FakeUser:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.bot = False
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return self.id
+
+
+class FakeChannel:
+    def __init__(self, id, name, guild=None):
+        self.id = id
+        self.name = name
+        self.guild = guild
+
+    async def history(self, limit=None, before=None, after=None, oldest_first=None):
+        # there's nothing older than what the bot saw during the benchmark
+        return
+        yield
+
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeMessage:
+    _ids = itertools.count(1 << 40)
+
+    def __init__(self, author, channel, content):
+        self.id = next(self._ids)
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.created_at = datetime.now(timezone.utc)
+        self.jump_url = f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{self.id}"
+        # commands.Context reads this, nothing uses it for plain messages
+        self._state = None
+
+
+class StubDMChannel:
+    def __init__(self, sink, user_id):
+        self.sink = sink
+        self.user_id = user_id
+
+    async def send(self, content=None, embed=None):
+        if self.sink.delay:
+            await asyncio.sleep(self.sink.delay)
+        self.sink.sent += 1
+
+
+class StubUsers:
+    """Stands in for notifications.UserCache: every recipient gets a DM channel that just counts sends.
+
+    :param delay: Seconds each send takes, to simulate Discord's latency.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = 0
+
+    async def get_dm_channel(self, user_id):
+        return StubDMChannel(self, user_id)
+
+    def forget(self, user_id):
+        pass
+
+
+class FakeDiscordAPI:
+    """A local stand-in for the parts of Discord's HTTP API the DM dispatcher uses, for discord.py's real HTTPClient.
+
+    A share of the message sends is answered with a 429 (with Retry-After, which discord.py waits out and retries
+    on its own), a 503 (which discord.py raises right away, so the dispatcher's backoff retries it) or a 403 for
+    users who don't accept DMs.
+
+    :param rng: The random.Random deciding which requests fail.
+    :param rate_limited: Share of sends answered with a 429.
+    :param server_errors: Share of sends answered with a 503.
+    :param refused: Share of users whose DMs are refused with a 403.
+    :param retry_after: Seconds the 429s ask the client to wait.
+    """
+
+    CHANNEL_OFFSET = 10 ** 16
+
+    def __init__(self, rng, rate_limited=0.1, server_errors=0.02, refused=0.01, retry_after=0.05):
+        self.rng = rng
+        self.rate_limited = rate_limited
+        self.server_errors = server_errors
+        self.refused = refused
+        self.retry_after = retry_after
+        self.requests = 0
+        self.delivered = 0
+        self.statuses = {}
+        self._runner = None
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id):
+        return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "global_name": None}
+
+    def _respond(self, status, body, **headers):
+        from aiohttp import web
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        # discord.py only parses the body when the content type is exactly this
+        return web.Response(body=json.dumps(body).encode(), status=status, headers={"Content-Type": "application/json", **headers})
+
+    async def get_me(self, request):
+        self.requests += 1
+        return self._respond(200, {**self.user(1), "bot": True})
+
+    async def get_user(self, request):
+        self.requests += 1
+        return self._respond(200, self.user(int(request.match_info["user_id"])))
+
+    async def create_dm(self, request):
+        self.requests += 1
+        user_id = int((await request.json())["recipient_id"])
+        return self._respond(200, {"id": str(user_id + self.CHANNEL_OFFSET), "type": 1, "last_message_id": None,
+                                   "recipients": [self.user(user_id)]})
+
+    async def send_message(self, request):
+        self.requests += 1
+        channel_id = int(request.match_info["channel_id"])
+        payload = await request.json()
+        user_id = channel_id - self.CHANNEL_OFFSET
+        if random.Random(user_id).random() < self.refused:
+            return self._respond(403, {"message": "Cannot send messages to this user", "code": 50007})
+        roll = self.rng.random()
+        if roll < self.rate_limited:
+            return self._respond(429, {"message": "You are being rate limited.", "retry_after": self.retry_after,
+                                       "global": False},
+                                 **{"Retry-After": str(self.retry_after), "Via": "1.1 google", "X-RateLimit-Scope": "user"})
+        if roll < self.rate_limited + self.server_errors:
+            return self._respond(503, {"message": "Service Unavailable", "code": 0})
+        self.delivered += 1
+        return self._respond(200, {
+            "id": str(next(self._message_ids)), "channel_id": str(channel_id), "author": self.user(1),
+            "content": payload.get("content") or "", "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None,
+            "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+            "embeds": payload.get("embeds") or [], "pinned": False, "type": 0,
+        }, **{"X-RateLimit-Bucket": "dm", "X-RateLimit-Limit": "5", "X-RateLimit-Remaining": "4",
+              "X-RateLimit-Reset-After": "1"})
+
+    async def start(self):
+        """Serves the API on a free local port.
+
+        :return: The base URL to point discord.py's `Route.BASE` at.
+        """
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get("/api/v10/users/@me", self.get_me)
+        app.router.add_post("/api/v10/users/@me/channels", self.create_dm)
+        app.router.add_get("/api/v10/users/{user_id}", self.get_user)
+        app.router.add_post("/api/v10/channels/{channel_id}/messages", self.send_message)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}/api/v10"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+# helpers
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def format_latency(seconds):
+    return f"{seconds * 1e6:.0f}us" if seconds < 1e-3 else f"{seconds * 1e3:.2f}ms"
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux (bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def report(name, count, elapsed, latencies=None, **extra):
+    line = f"{name}: {count} in {elapsed:.2f}s = {count / elapsed:,.0f}/s"
+    if latencies:
+        line += f", p50 {format_latency(percentile(latencies, 0.5))}, p99 {format_latency(percentile(latencies, 0.99))}"
+    for key, value in extra.items():
+        line += f", {key.replace('_', ' ')} {value}"
+    print(line)
+
+
+def vocabulary(size, rng):
+    return [f"w{index}{rng.choice('abcdefghij')}" for index in range(size)]
+
+
+def measure_memory(build):
+    """Runs `build()` and returns its result with the memory it allocated (and kept), in MB."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current / (1024 * 1024)
+
+
+async def measure_memory_async(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = await build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current / (1024 * 1024)
+
+
+# the bot itself
+
+def import_bot(send_delay):
+    """Imports bot.py with an in-memory database and a stub DM sender instead of the real ones."""
+    pymongo.MongoClient = MemoryClient
+    import bot
+    bot.bot._connection.user = FakeUser(1, "prioritize-bot")
+    bot.notifier.users = StubUsers(send_delay)
+    return bot
+
+
+# snowflake-sized ids, so ids stored as strings take as much memory as real ones would
+GUILD_ID_BASE = 3 * 10 ** 17
+USER_ID_BASE = 10 ** 17
+AUTHOR_ID_BASE = 2 * 10 ** 17
+
+
+def seed_subscriptions(db, args, rng, words, legacy=False):
+    """Fills the database with `users` users who track `keywords` keywords and `bookmarks` authors each.
+
+    :param legacy: Store the ids as strings, like the bot did before ids were ints.
+    """
+    to_id = str if legacy else int
+    guild_ids = [GUILD_ID_BASE + index for index in range(args.guilds)]
+    keyword_docs, bookmark_docs = [], []
+    for user in range(args.users):
+        user_id = to_id(USER_ID_BASE + user)
+        guild_id = to_id(guild_ids[user % len(guild_ids)])
+        keyword_docs.append({"user_id": user_id, "guild_id": guild_id, "keywords": rng.sample(words, args.keywords)})
+        if args.bookmarks:
+            authors = rng.sample(range(args.authors), min(args.bookmarks, args.authors))
+            bookmark_docs.append({"user_id": user_id, "guild_id": guild_id, "bookmarks": [to_id(AUTHOR_ID_BASE + a) for a in authors]})
+    db["keywords"].insert_many(keyword_docs)
+    if bookmark_docs:
+        db["bookmarks"].insert_many(bookmark_docs)
+    return guild_ids
+
+
+async def bench_pipeline(args):
+    """on_message end to end: the message buffer, the pipeline's keyword and bookmark matching and queueing DMs."""
+    from pipeline import QUEUE_LAG
+    bot = import_bot(args.send_delay)
+    rng = random.Random(args.seed)
+    words = vocabulary(args.vocabulary, rng)
+    guild_ids = seed_subscriptions(bot.db, args, rng, words)
+    bot.notifier.start()
+    bot.pipeline.workers = args.pipeline_workers
+    bot.pipeline.max_queue = args.pipeline_queue
+    bot.pipeline.start()
+
+    started = time.perf_counter()
+    _, cache_mb = await measure_memory_async(lambda: bot.subscriptions.load(guild_ids))
+    stats = bot.subscriptions.stats()
+    report("load subscriptions", stats["keywords"] + stats["bookmarks"], time.perf_counter() - started, cache_memory=f"{cache_mb:.1f}MB")
+
+    guilds = [FakeGuild(guild_id) for guild_id in guild_ids]
+    channels = [FakeChannel(10 ** 5 + index, f"channel-{index}", guilds[index % len(guilds)]) for index in range(args.channels)]
+    authors = [FakeUser(AUTHOR_ID_BASE + index, f"author-{index}") for index in range(args.authors)]
+    messages = [
+        FakeMessage(rng.choice(authors), rng.choice(channels), " ".join(rng.choice(words) for _ in range(args.words)))
+        for _ in range(args.messages)
+    ]
+
+    latencies = []
+
+    async def handle(message, due):
+        await bot.on_message(message)
+        # counted from when the message was due, so falling behind the rate shows up as latency
+        latencies.append(time.perf_counter() - due)
+
+    started = time.perf_counter()
+    tasks = []
+    for index, message in enumerate(messages):
+        due = started + index / args.rate if args.rate else time.perf_counter()
+        if args.rate:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(handle(message, due)))
+        else:
+            await handle(message, due)
+            # the gateway reads the next event off the socket in between, which lets the workers run
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    report("on_message", len(messages), elapsed, latencies, peak_rss=f"{peak_rss_mb():.0f}MB")
+
+    await bot.pipeline.join()
+    elapsed = time.perf_counter() - started
+    pipeline = bot.pipeline
+    report("pipeline", pipeline.processed, elapsed, None,
+           queue_lag_p50=format_latency(QUEUE_LAG.quantile(0.5, "message")),
+           queue_lag_p99=format_latency(QUEUE_LAG.quantile(0.99, "message")),
+           average_batch=f"{pipeline.processed / max(1, pipeline.batches):.1f}", dropped=pipeline.dropped)
+
+    started = time.perf_counter()
+    await bot.notifier.queue.join()
+    print(f"DMs: {bot.notifier.users.sent} sent, the queue drained {time.perf_counter() - started:.2f}s after the last message, "
+          f"{bot.notifier.dropped} dropped")
+
+
+async def bench_reminders(args):
+    """The reminder scheduler: load `reminders` reminders that are all due and deliver them."""
+    bot = import_bot(args.send_delay)
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+    docs = [
+        {"user_id": USER_ID_BASE + rng.randrange(args.users), "label": f"reminder {index}",
+         "reminder_time": now - timedelta(seconds=rng.uniform(0, 60))}
+        for index in range(args.reminders)
+    ]
+    bot.db["reminders"].insert_many(docs)
+    bot.notifier.start()
+
+    started = time.perf_counter()
+    _, heap_mb = await measure_memory_async(bot.reminder_scheduler.load)
+    report("load reminders", len(bot.reminder_scheduler), time.perf_counter() - started, heap_memory=f"{heap_mb:.1f}MB")
+
+    started = time.perf_counter()
+    task = asyncio.ensure_future(bot.reminder_scheduler.run())
+    reminders = bot.db["reminders"]
+    # sent reminders are deleted in batches, so everything is done once the collection is empty
+    while reminders.count_documents({}):
+        await asyncio.sleep(0.05)
+        await bot.reminder_scheduler.flush()
+    elapsed = time.perf_counter() - started
+    task.cancel()
+    report("reminders delivered", bot.notifier.users.sent, elapsed)
+
+
+async def bench_keyword_index(args):
+    """The Aho-Corasick keyword index on its own at 10k and 100k keywords, against the loop it replaced."""
+    from keyword_index import KeywordIndex
+    rng = random.Random(args.seed)
+    for size in (10000, 100000):
+        words = vocabulary(size * 2, rng)
+        keywords = rng.sample(words, size)
+        user_keywords = {}
+        for number, keyword in enumerate(keywords):
+            user_keywords.setdefault(USER_ID_BASE + number % args.users, set()).add(keyword)
+
+        def build():
+            index = KeywordIndex()
+            for number, keyword in enumerate(keywords):
+                index.add(USER_ID_BASE + number % args.users, keyword)
+            index.rebuild()
+            return index
+
+        started = time.perf_counter()
+        index, memory = measure_memory(build)
+        report(f"keyword index build ({size} keywords)", size, time.perf_counter() - started, memory=f"{memory:.1f}MB")
+        texts = [" ".join(rng.choice(words) for _ in range(args.words)) for _ in range(10000)]
+        latencies = []
+        started = time.perf_counter()
+        for text in texts:
+            began = time.perf_counter()
+            index.match(text)
+            latencies.append(time.perf_counter() - began)
+        elapsed = time.perf_counter() - started
+        report(f"keyword index match ({size} keywords)", len(texts), elapsed, latencies)
+
+        # keywords added or removed later don't rebuild the automaton, they're matched next to it until the
+        # pending ones are rebuilt into a new automaton (which the cache does in an executor)
+        latencies = []
+        started = time.perf_counter()
+        for number, text in enumerate(texts[:index.max_pending]):
+            began = time.perf_counter()
+            index.add(USER_ID_BASE + number, f"new{number}")
+            index.remove(USER_ID_BASE + number % args.users, keywords[number])
+            index.match(text)
+            latencies.append(time.perf_counter() - began)
+        report(f"keyword index add + remove + match ({size} keywords)", len(latencies), time.perf_counter() - started,
+               latencies)
+        started = time.perf_counter()
+        index.rebuild()
+        report(f"keyword index rebuild, off the event loop ({size} keywords)", size, time.perf_counter() - started)
+
+        # the loop on_message used to run, every keyword of every user against the message. it's a lot slower,
+        # so it only gets a sample of the messages
+        sample = texts[:max(1, len(texts) * 1000 // size)]
+        latencies = []
+        started = time.perf_counter()
+        for text in sample:
+            began = time.perf_counter()
+            matches = {}
+            for user_id, keywords in user_keywords.items():
+                for keyword in keywords:
+                    if keyword.lower() in text.lower():
+                        matches.setdefault(user_id, []).append(keyword)
+            latencies.append(time.perf_counter() - began)
+        baseline = time.perf_counter() - started
+        report(f"keyword loop match ({size} keywords)", len(sample), baseline, latencies,
+               speedup=f"{baseline / len(sample) / (elapsed / len(texts)):.0f}x")
+
+
+def load_legacy_layout(db):
+    """Loads keywords and bookmarks into the layout the cache used before ids were ints, for comparison.
+
+    String ids, a set of keyword strings per user, a dict of user -> spelling per keyword and sets of ids for
+    bookmarks, plus the same Aho-Corasick automaton per guild the cache builds now.
+    """
+    from keyword_index import Automaton, KeywordTable
+    partitions = {}
+
+    def partition(guild_id):
+        if guild_id not in partitions:
+            partitions[guild_id] = [{}, {}, {}, {}, None]
+        return partitions[guild_id]
+
+    for doc in db["keywords"].find({}, {"_id": 0}):
+        keywords, subscribers, _, _, _ = partition(doc.get("guild_id"))
+        for keyword in doc["keywords"]:
+            keywords.setdefault(doc["user_id"], set()).add(keyword)
+            subscribers.setdefault(keyword.lower(), {})[doc["user_id"]] = keyword
+    for doc in db["bookmarks"].find({}, {"_id": 0}):
+        _, _, bookmarks, bookmark_subscribers, _ = partition(doc.get("guild_id"))
+        for bookmark in doc["bookmarks"]:
+            bookmarks.setdefault(doc["user_id"], set()).add(bookmark)
+            bookmark_subscribers.setdefault(bookmark, set()).add(doc["user_id"])
+    for layout in partitions.values():
+        table = KeywordTable()
+        layout[4] = Automaton(table, [table.intern(pattern) for pattern in layout[1]])
+    return partitions
+
+
+async def bench_memory(args):
+    """Memory per subscription: string ids in sets and dicts (before) against int ids in arrays (after).
+
+    Seeds string-id documents like the bot used to write, measures the old layout, migrates the documents
+    with Repository.migrate_ids and measures the SubscriptionCache loading the same data.
+    """
+    from cache import SubscriptionCache
+    from database import Repository
+    rng = random.Random(args.seed)
+    words = vocabulary(args.vocabulary, rng)
+    db = MemoryDatabase()
+    seed_subscriptions(db, args, rng, words, legacy=True)
+    for name in ("keywords", "bookmarks"):
+        db[name].copy_on_read = True
+    count = args.users * (args.keywords + min(args.bookmarks, args.authors))
+
+    started = time.perf_counter()
+    _, before = measure_memory(lambda: load_legacy_layout(db))
+    report("string ids, sets and dicts (before)", count, time.perf_counter() - started,
+           memory=f"{before:.1f}MB", per_subscription=f"{before * 1024 * 1024 / count:.0f} bytes")
+
+    repository = Repository(db)
+    started = time.perf_counter()
+    converted = await repository.migrate_ids()
+    report("migrate string ids to ints", converted, time.perf_counter() - started)
+
+    cache = SubscriptionCache(repository)
+    started = time.perf_counter()
+    _, after = await measure_memory_async(lambda: cache.load())
+    report("int ids, interned keywords and arrays (after)", count, time.perf_counter() - started,
+           memory=f"{after:.1f}MB", per_subscription=f"{after * 1024 * 1024 / count:.0f} bytes",
+           distinct_keywords=len(cache.keyword_table))
+    repository.executor.shutdown(wait=False)
+
+
+async def bench_topics(args):
+    """Topic matching on its own at 10k and 100k topics, one message per matrix multiply and in micro-batches.
+
+    Latencies are per message: in a batch every message waits for the whole batch to be scored, so that's what
+    each of them is counted with (on top of that they wait for the batch to fill up, which depends on traffic).
+    """
+    from topics import HashingVectorizer, TopicIndex
+    rng = random.Random(args.seed)
+    words = vocabulary(args.vocabulary, rng)
+    vectorizer = HashingVectorizer()
+    texts = [" ".join(rng.choice(words) for _ in range(args.words)) for _ in range(2000)]
+    # most chat messages are a lot shorter, and touch fewer of the vector's dimensions
+    short_texts = [" ".join(rng.choice(words) for _ in range(5)) for _ in range(2000)]
+    for size in (10000, 100000):
+        topics = [" ".join(rng.sample(words, rng.randint(1, 3))) for _ in range(size)]
+
+        def build():
+            index = TopicIndex(vectorizer, threshold=0.4)
+            for number, topic in enumerate(topics):
+                index.add(USER_ID_BASE + number % args.users, topic)
+            return index
+
+        started = time.perf_counter()
+        index, memory = measure_memory(build)
+        report(f"topic index build ({size} topics)", size, time.perf_counter() - started, memory=f"{memory:.1f}MB")
+
+        for name, messages in ((f"{args.words} words", texts), ("5 words", short_texts)):
+            latencies = []
+            started = time.perf_counter()
+            for text in messages:
+                began = time.perf_counter()
+                index.match(vectorizer.transform([text]))
+                latencies.append(time.perf_counter() - began)
+            report(f"topic match, one message at a time ({size} topics, {name})", len(messages),
+                   time.perf_counter() - started, latencies)
+
+        for batch_size in (16, 64):
+            latencies = []
+            started = time.perf_counter()
+            for offset in range(0, len(texts), batch_size):
+                batch = texts[offset:offset + batch_size]
+                began = time.perf_counter()
+                index.match(vectorizer.transform(batch))
+                latencies.extend([time.perf_counter() - began] * len(batch))
+            report(f"topic match, batches of {batch_size} ({size} topics, {args.words} words)", len(texts),
+                   time.perf_counter() - started, latencies)
+
+
+async def bench_dispatcher(args):
+    """The DM queue against discord.py's real HTTP client, talking to a local fake of Discord's API.
+
+    Recipients are looked up and their DM channels opened through notifications.UserCache, and the fake API rate
+    limits, fails or refuses a share of the sends (see FakeDiscordAPI), so this covers the dispatcher's retries and
+    backoff as well as discord.py's own 429 handling.
+    """
+    import discord
+    from notifications import NotificationDispatcher, UserCache
+    rng = random.Random(args.seed)
+    api = FakeDiscordAPI(rng, rate_limited=args.rate_limited, server_errors=args.server_errors)
+    base = discord.http.Route.BASE
+    discord.http.Route.BASE = await api.start()
+    client = discord.Client(intents=discord.Intents.none())
+    try:
+        await client.http.static_login("fake-token")
+        notifier = NotificationDispatcher(UserCache(client), workers=args.notify_workers, max_queue=args.dms + 1,
+                                          base_delay=0.05)
+        notifier.start()
+        latencies = []
+
+        async def send(user_id):
+            began = time.perf_counter()
+            try:
+                await notifier.send(user_id, "notification")
+            except discord.HTTPException:
+                pass
+            latencies.append(time.perf_counter() - began)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(USER_ID_BASE + rng.randrange(args.users)) for _ in range(args.dms)))
+        elapsed = time.perf_counter() - started
+        for task in notifier._tasks:
+            task.cancel()
+    finally:
+        await client.http.close()
+        await api.stop()
+        discord.http.Route.BASE = base
+    statuses = ", ".join(f"{status}: {count}" for status, count in sorted(api.statuses.items()))
+    report(f"dispatcher ({args.notify_workers} workers, fake Discord API)", args.dms, elapsed, latencies,
+           delivered=api.delivered, failed=notifier.failed, requests=api.requests, responses=f"({statuses})")
+
+
+async def bench_message_buffer(args):
+    """The message buffer on its own: recording, memory per message and serving history from memory."""
+    from message_buffer import MessageBuffer
+    rng = random.Random(args.seed)
+    words = vocabulary(args.vocabulary, rng)
+    guild = FakeGuild(1000)
+    channels = [FakeChannel(10 ** 5 + index, f"channel-{index}", guild) for index in range(args.channels)]
+    author = FakeUser(2 * 10 ** 6, "author")
+    buffer = MessageBuffer()
+    latencies = []
+
+    def record():
+        # the messages are made in here so their text counts, and only what the buffer keeps is left at the end
+        for _ in range(args.messages):
+            message = FakeMessage(author, rng.choice(channels), " ".join(rng.choice(words) for _ in range(args.words)))
+            began = time.perf_counter()
+            buffer.record(message)
+            latencies.append(time.perf_counter() - began)
+
+    _, memory = measure_memory(record)
+    report("message buffer record", args.messages, sum(latencies), latencies, memory=f"{memory:.1f}MB",
+           estimated=f"{buffer.size / (1024 * 1024):.1f}MB", per_message=f"{memory * 1024 * 1024 / max(buffer.count, 1):.0f}B")
+
+    latencies = []
+    started = time.perf_counter()
+    for channel in channels:
+        began = time.perf_counter()
+        async for _ in buffer.history(channel, buffer.per_channel):
+            pass
+        latencies.append(time.perf_counter() - began)
+    report("message buffer history", len(channels), time.perf_counter() - started, latencies)
+
+
+def import_time(module):
+    """Seconds a fresh interpreter takes to import `module` (from this directory)."""
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout) if result.returncode == 0 else float("nan")
+
+
+async def bench_timeparse(args):
+    """Reminder time parsing: the cached fast path against dateparser, and what importing each costs at startup."""
+    from timeparse import TimeParser, compile_expression
+    print(f"cold import: timeparse {import_time('timeparse') * 1000:.0f}ms, dateparser {import_time('dateparser') * 1000:.0f}ms")
+    rng = random.Random(args.seed)
+    parser = TimeParser()
+    common = ["in 1 hour", "in 30 minutes", "tomorrow 9am", "5:30pm", "in 2 days", "2030-01-01 12:00", "tonight", "1h30m"]
+    timezones = ["America/Los_Angeles", "Europe/Berlin", "Asia/Tokyo"]
+
+    texts = [rng.choice(common) for _ in range(args.parses)]
+    latencies = []
+    started = time.perf_counter()
+    for text in texts:
+        began = time.perf_counter()
+        parser.parse_fast(text, rng.choice(timezones))
+        latencies.append(time.perf_counter() - began)
+    report("fast path (cached expressions)", len(texts), time.perf_counter() - started, latencies)
+
+    compile_expression.cache_clear()
+    texts = [f"in {index} minutes" if index % 2 else f"2030-01-{index % 28 + 1:02d} {index % 24}:{index % 60:02d}" for index in range(args.parses)]
+    latencies = []
+    started = time.perf_counter()
+    for text in texts:
+        began = time.perf_counter()
+        parser.parse_fast(text)
+        latencies.append(time.perf_counter() - began)
+    report("fast path (new expressions)", len(texts), time.perf_counter() - started, latencies)
+
+    parser.parse_fallback("warm up")
+    count = max(1, args.parses // 50)
+    texts = [f"march {index % 28 + 1} 2030 {index % 12 + 1}pm" for index in range(count)]
+    latencies = []
+    started = time.perf_counter()
+    for text in texts:
+        began = time.perf_counter()
+        parser.parse_fallback(text, rng.choice(timezones))
+        latencies.append(time.perf_counter() - began)
+    report("dateparser fallback", len(texts), time.perf_counter() - started, latencies)
+
+    import dateparser
+    texts = [rng.choice(common) for _ in range(count)]
+    latencies = []
+    started = time.perf_counter()
+    for text in texts:
+        began = time.perf_counter()
+        dateparser.parse(text, settings={'TIMEZONE': rng.choice(timezones)})
+        latencies.append(time.perf_counter() - began)
+    report("dateparser on the common forms (before)", len(texts), time.perf_counter() - started, latencies)
+
+
+BENCHMARKS = {
+    "pipeline": bench_pipeline,
+    "reminders": bench_reminders,
+    "keyword-index": bench_keyword_index,
+    "topics": bench_topics,
+    "memory": bench_memory,
+    "dispatcher": bench_dispatcher,
+    "message-buffer": bench_message_buffer,
+    "timeparse": bench_timeparse,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test and benchmarks for the bot.")
+    parser.add_argument("benchmarks", nargs="*", help=f"Which benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--users", type=int, default=2000, help="Users with subscriptions")
+    parser.add_argument("--keywords", type=int, default=10, help="Keywords per user")
+    parser.add_argument("--bookmarks", type=int, default=2, help="Bookmarked authors per user")
+    parser.add_argument("--guilds", type=int, default=10, help="Guilds the users are spread over")
+    parser.add_argument("--channels", type=int, default=50, help="Channels messages are spread over")
+    parser.add_argument("--authors", type=int, default=500, help="Different message authors")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="Distinct words messages and keywords are made of")
+    parser.add_argument("--words", type=int, default=20, help="Words per message")
+    parser.add_argument("--messages", type=int, default=20000, help="Messages to send through the pipeline")
+    parser.add_argument("--rate", type=float, default=0, help="Messages per second to send at (default 0 = as fast as possible)")
+    parser.add_argument("--reminders", type=int, default=20000, help="Reminders to deliver")
+    parser.add_argument("--parses", type=int, default=20000, help="Time expressions to parse")
+    parser.add_argument("--send-delay", type=float, default=0.0, help="Seconds each stub DM send takes")
+    parser.add_argument("--notify-workers", type=int, default=8, help="Workers for the dispatcher benchmark")
+    parser.add_argument("--dms", type=int, default=2000, help="DMs the dispatcher benchmark sends")
+    parser.add_argument("--rate-limited", type=float, default=0.1, help="Share of DM sends the fake Discord API answers with a 429")
+    parser.add_argument("--server-errors", type=float, default=0.02, help="Share of DM sends the fake Discord API answers with a 503")
+    parser.add_argument("--pipeline-workers", type=int, default=4, help="Workers matching messages in the pipeline benchmark")
+    parser.add_argument("--pipeline-queue", type=int, default=10000, help="Messages the pipeline holds before dropping some")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, so runs are comparable")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    return args
+
+
+async def main(args):
+    for name in args.benchmarks:
+        print(f"== {name}")
+        await BENCHMARKS[name](args)
+    # stop the notifier workers and whatever else is still waiting
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    # bot.py's objects are bound to the default loop (like discord.py's), so run on that one
+    asyncio.get_event_loop().run_until_complete(main(arguments))
@@ -0,0 +1,142 @@
+from collections import OrderedDict, deque
+
+import discord
+
+
+class CachedMessage:
+    """The parts of a discord.Message we need for summaries, without holding on to the whole object."""
+
+    __slots__ = ("id", "author_id", "author_name", "created_at", "content")
+
+    # rough per-record cost besides the strings themselves (the object, its slots, the int ids and the deque slot)
+    OVERHEAD = 160
+
+    def __init__(self, id, author_id, author_name, created_at, content):
+        self.id = id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.created_at = created_at
+        self.content = content
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.id, message.author.id, message.author.display_name, message.created_at.timestamp(), message.content)
+
+    def size(self):
+        return self.OVERHEAD + len(self.content) + len(self.author_name)
+
+
+class MessageBuffer:
+    """Ring buffer of the latest messages of every channel the bot sees, so /summarize rarely needs the API.
+
+    on_message records every message here. Each channel keeps at most `per_channel` messages, and once the
+    whole buffer goes over `max_bytes`, the oldest messages of the least recently active channels go first.
+    A channel's buffer is always an unbroken run of its newest messages, older ones come from `channel.history`.
+
+    :param per_channel: Most messages kept per channel.
+    :param max_bytes: Rough memory budget for all channels together.
+    """
+
+    def __init__(self, per_channel=2000, max_bytes=64 * 1024 * 1024):
+        self.per_channel = per_channel
+        self.max_bytes = max_bytes
+        # channel id -> deque of CachedMessage (oldest first), least recently active channel first
+        self._channels = OrderedDict()
+        self.size = 0
+        self.count = 0
+        self.hits = 0
+        self.fetched = 0
+
+    def record(self, message):
+        """Adds a message the bot just received."""
+        channel_id = message.channel.id
+        messages = self._channels.get(channel_id)
+        if messages is None:
+            messages = self._channels[channel_id] = deque()
+        else:
+            self._channels.move_to_end(channel_id)
+        cached = CachedMessage.from_message(message)
+        messages.append(cached)
+        self.size += cached.size()
+        self.count += 1
+        if len(messages) > self.per_channel:
+            self._drop_oldest(channel_id)
+        while self.size > self.max_bytes and self._channels:
+            self._drop_oldest(next(iter(self._channels)))
+
+    def _drop_oldest(self, channel_id):
+        messages = self._channels[channel_id]
+        dropped = messages.popleft()
+        self.size -= dropped.size()
+        self.count -= 1
+        if not messages:
+            del self._channels[channel_id]
+
+    def edit(self, channel_id, message_id, content):
+        """Updates a buffered message after it was edited."""
+        for cached in reversed(self._channels.get(channel_id, ())):
+            if cached.id == message_id:
+                self.size += len(content) - len(cached.content)
+                cached.content = content
+                return
+            if cached.id < message_id:
+                return
+
+    def discard(self, channel_id, message_id):
+        """Removes a buffered message after it was deleted."""
+        messages = self._channels.get(channel_id)
+        if not messages:
+            return
+        for index in range(len(messages) - 1, -1, -1):
+            cached = messages[index]
+            if cached.id == message_id:
+                del messages[index]
+                self.size -= cached.size()
+                self.count -= 1
+                if not messages:
+                    del self._channels[channel_id]
+                return
+            if cached.id < message_id:
+                return
+
+    def clear(self):
+        """Forgets everything, e.g. after a reconnect where we might have missed messages."""
+        self._channels.clear()
+        self.size = 0
+        self.count = 0
+
+    async def history(self, channel, limit, after_id=None):
+        """Yields a channel's latest messages as CachedMessage, newest first, like `channel.history()` would.
+
+        Buffered messages come first; whatever the buffer doesn't cover is fetched from the API.
+
+        :param channel: The discord.TextChannel.
+        :param limit: Most messages to yield.
+        :param after_id: Only yield messages newer than this id.
+        """
+        messages = self._channels.get(channel.id, ())
+        oldest_id = None
+        # take a snapshot, new messages can come in while the caller is busy with these
+        for cached in reversed(list(messages)):
+            if limit <= 0 or (after_id is not None and cached.id <= after_id):
+                return
+            oldest_id = cached.id
+            limit -= 1
+            self.hits += 1
+            yield cached
+        if limit <= 0:
+            return
+        before = discord.Object(id=oldest_id) if oldest_id is not None else None
+        after = discord.Object(id=after_id) if after_id is not None else None
+        async for message in channel.history(limit=limit, before=before, after=after, oldest_first=False):
+            self.fetched += 1
+            yield CachedMessage.from_message(message)
+
+    def stats(self):
+        return {
+            "channels": len(self._channels),
+            "messages": self.count,
+            "bytes": self.size,
+            "served_from_buffer": self.hits,
+            "fetched_from_api": self.fetched,
+        }
@@ -0,0 +1,245 @@
+import asyncio
+import bisect
+import time
+
+# latency buckets in seconds, from a dict lookup to a slow OpenAI request
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A number that only goes up, optionally split by labels. `inc` is a dict update, cheap enough for hot paths."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        for label_values, value in self._values.items():
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """Counts observations (e.g. latencies in seconds) into buckets, optionally split by labels.
+
+    `observe` is a bisect and a few list updates, so it's fine to call for every message.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (the last one is +Inf), sum, count]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *label_values):
+        """Context manager observing how long its block took."""
+        return _Timer(self, label_values)
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return series[2] if series else 0
+
+    def quantile(self, q, *label_values):
+        """Estimates a quantile (e.g. 0.99) from the buckets, like Prometheus' histogram_quantile.
+
+        :return: The estimate in the histogram's unit, or None if nothing was observed.
+        """
+        series = self._series.get(label_values)
+        if not series or not series[2]:
+            return None
+        rank = q * series[2]
+        seen = 0
+        for index, count in enumerate(series[0]):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        for label_values, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                yield self.name + "_bucket", _format_labels(self.labels, label_values, le), cumulative
+            yield self.name + "_sum", _format_labels(self.labels, label_values), total
+            yield self.name + "_count", _format_labels(self.labels, label_values), count
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class CallbackMetric:
+    """A gauge (or counter) whose value is read from a function when scraped, so it costs nothing in between.
+
+    :param read: Returns a number, or a dict of label values tuple -> number.
+    """
+
+    def __init__(self, name, help, read, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+        try:
+            values = self.read()
+        except Exception as e:
+            print(f"Error reading metric {self.name}: {e}")
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Registry:
+    """Every metric the bot exports, rendered in the Prometheus text format by `render`."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read, labels=(), kind="gauge"):
+        """Registers a value read from `read()` when scraped. Registering a name again replaces the function."""
+        metric = self._metrics.get(name)
+        if isinstance(metric, CallbackMetric):
+            metric.read = read
+            return metric
+        return self._register(CallbackMetric(name, help, read, labels, kind))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# the one registry the bot's modules put their metrics in
+registry = Registry()
+
+
+class MetricsServer:
+    """Tiny HTTP server answering GET /metrics with `registry.render()`, for Prometheus to scrape.
+
+    It only binds to localhost by default; put a proxy in front of it (or set the host) to scrape from elsewhere.
+
+    :param registry: The Registry to serve.
+    :param port: Port to listen on.
+    :param host: Address to bind to.
+    """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self._server = None
+
+    async def start(self):
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5.0)
+            # skip the headers, we don't need any of them
+            while (await asyncio.wait_for(reader.readline(), 5.0)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def monitor_event_loop(histogram, interval=0.5):
+    """Background task measuring event loop lag: how much later than asked for a sleep wakes up.
+
+    Anything that blocks the loop (slow sync code in a handler) shows up here as lag.
+    """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, time.perf_counter() - started - interval))
@@ -0,0 +1,310 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+import discord
+
+from cache import TTLCache
+from metrics import registry
+
+DISCORD_SECONDS = registry.histogram("discord_api_seconds", "Time Discord API calls made for notifications took", ("call",))
+DISCORD_ERRORS = registry.counter("discord_api_errors_total", "Discord API calls made for notifications that failed", ("call", "status"))
+NOTIFICATION_DELAY = registry.histogram("notification_delay_seconds", "Time from queueing a DM until it was sent")
+
+
+class UserCache:
+    """Resolves user ids to users and DM channels without calling the API every time.
+
+    Users come from discord.py's own cache (`bot.get_user`) when it has them, otherwise from an LRU of users
+    we fetched before. DM channels are opened once and kept the same way, so steady-state sends don't need any
+    lookup request at all.
+
+    :param bot: The bot, used for `get_user`/`fetch_user`.
+    :param max_size: How many users (and DM channels) to remember.
+    :param ttl: How long (in seconds) a fetched user or channel is trusted.
+    """
+
+    def __init__(self, bot, max_size=10000, ttl=3600.0):
+        self.bot = bot
+        self._users = TTLCache(max_size, ttl)
+        self._channels = TTLCache(max_size, ttl)
+        self.user_hits = 0
+        self.user_misses = 0
+        self.channel_hits = 0
+        self.channel_misses = 0
+
+    async def get_user(self, user_id):
+        user_id = int(user_id)
+        user = self.bot.get_user(user_id) or self._users.get(user_id)
+        if user is not None:
+            self.user_hits += 1
+            return user
+        self.user_misses += 1
+        with DISCORD_SECONDS.time("fetch_user"):
+            user = await self.bot.fetch_user(user_id)
+        self._users.put(user_id, user)
+        return user
+
+    async def get_dm_channel(self, user_id):
+        user_id = int(user_id)
+        channel = self._channels.get(user_id)
+        if channel is not None:
+            self.channel_hits += 1
+            return channel
+        user = await self.get_user(user_id)
+        channel = user.dm_channel
+        if channel is None:
+            self.channel_misses += 1
+            with DISCORD_SECONDS.time("create_dm"):
+                channel = await user.create_dm()
+        else:
+            self.channel_hits += 1
+        self._channels.put(user_id, channel)
+        return channel
+
+    def forget(self, user_id):
+        """Drops what we know about a user, e.g. after Discord told us they no longer exist."""
+        self._users.pop(int(user_id))
+        self._channels.pop(int(user_id))
+
+    def stats(self):
+        """:return: A dict with the hit/miss counters and cache sizes."""
+        return {
+            "user_hits": self.user_hits,
+            "user_misses": self.user_misses,
+            "channel_hits": self.channel_hits,
+            "channel_misses": self.channel_misses,
+            "cached_users": len(self._users),
+            "cached_channels": len(self._channels),
+        }
+
+
+class NotificationDispatcher:
+    """Sends DMs from a bounded queue with a pool of worker tasks, so handlers only enqueue and move on.
+
+    discord.py already waits out the per-route rate limit buckets, on top of that we:
+    - only ever have one send in flight per recipient (a DM channel is its own bucket, and it keeps their order),
+    - retry 429s and 5xx errors with exponential backoff,
+    - skip recipients who refuse DMs (discord.Forbidden) for a while instead of hammering them.
+
+    :param users: The UserCache used to find each recipient's DM channel.
+    :param workers: How many DMs can be sent at once.
+    :param max_queue: Notifications waiting beyond this are dropped.
+    :param max_retries: How many times a failed send is retried.
+    :param base_delay: First backoff delay in seconds, doubled on each retry.
+    :param forbidden_ttl: How long (in seconds) to skip users who don't accept DMs from us.
+    :param max_forbidden: How many of those users to remember, the least recently refused are forgotten first.
+    """
+
+    def __init__(self, users, workers=8, max_queue=10000, max_retries=3, base_delay=1.0, forbidden_ttl=3600.0,
+                 max_forbidden=10000):
+        self.users = users
+        self.workers = workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._tasks = []
+        # recipient id -> jobs waiting for the send currently in flight to that recipient
+        self._in_flight = {}
+        # recipients we don't try to DM until their entry expires
+        self._forbidden = TTLCache(max_forbidden, forbidden_ttl)
+
+    def start(self):
+        """Starts the worker tasks. Calling it again is a no-op."""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def notify(self, user_id, content=None, embed=None):
+        """Queues a DM without waiting for it to be sent.
+
+        :return: False if the queue was full and the notification got dropped.
+        """
+        try:
+            self.queue.put_nowait((int(user_id), content, embed, None, time.monotonic()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"Notification queue full, dropped DM to {user_id}")
+            return False
+        return True
+
+    async def send(self, user_id, content=None, embed=None):
+        """Queues a DM and waits until it's been sent.
+
+        :return: True once sent, False if the user doesn't accept DMs from us (or doesn't exist).
+        :raises discord.HTTPException: If sending still failed after every retry.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((int(user_id), content, embed, future, time.monotonic()))
+        return await future
+
+    async def join(self):
+        """Waits until every queued DM has been sent (or given up on)."""
+        await self.queue.join()
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            user_id = job[0]
+            waiting = self._in_flight.get(user_id)
+            if waiting is not None:
+                # another worker is talking to this recipient, it'll send this one right after (and mark it done)
+                waiting.append(job)
+                continue
+            waiting = self._in_flight[user_id] = deque([job])
+            try:
+                while waiting:
+                    try:
+                        await self._deliver(*waiting.popleft())
+                    finally:
+                        self.queue.task_done()
+            finally:
+                del self._in_flight[user_id]
+
+    async def _deliver(self, user_id, content, embed, future, queued_at):
+        try:
+            result = await self._send_with_retries(user_id, content, embed)
+        except Exception as e:
+            self.failed += 1
+            print(f"Error sending DM to {user_id}: {e}")
+            if future is not None and not future.done():
+                future.set_exception(e)
+            return
+        if result:
+            self.sent += 1
+            NOTIFICATION_DELAY.observe(time.monotonic() - queued_at)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def _send_with_retries(self, user_id, content, embed):
+        if self._forbidden.get(user_id):
+            return False
+
+        attempt = 0
+        while True:
+            try:
+                channel = await self.users.get_dm_channel(user_id)
+                with DISCORD_SECONDS.time("send_dm"):
+                    await channel.send(content, embed=embed)
+                return True
+            except discord.Forbidden:
+                self._forbidden.put(user_id, True)
+                return False
+            except discord.NotFound:
+                self.users.forget(user_id)
+                return False
+            except discord.HTTPException as e:
+                DISCORD_ERRORS.inc("send_dm", e.status)
+                if attempt >= self.max_retries or not (e.status == 429 or e.status >= 500):
+                    raise
+            # exponential backoff with a bit of jitter so retries don't line up
+            delay = self.base_delay * (2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            attempt += 1
+
+
+class DigestBuffer:
+    """Collects notifications for users in digest mode and sends them as one embed per window.
+
+    A message that matches several of a user's keywords (or a keyword and a bookmark) only shows up once in
+    their digest, with every reason listed. A digest too long for one embed is sent as several DMs.
+
+    :param notifier: The NotificationDispatcher used to send the digests.
+    :param window: How long (in seconds) to collect before sending a user's digest.
+    :param max_items: A digest is sent right away once it has this many messages.
+    """
+
+    # keep each digest well inside Discord's embed limits (25 fields, 1024 characters per field)
+    MAX_CONTENT_LENGTH = 300
+    # Discord rejects an embed with more than 6000 characters in total (title, field names and values together)
+    MAX_EMBED_LENGTH = 6000
+
+    def __init__(self, notifier, window=300.0, max_items=10):
+        self.notifier = notifier
+        self.window = window
+        self.max_items = min(max_items, 25)
+        # user id -> {message id: entry}, in the order the messages came in
+        self._pending = {}
+        self._timers = {}
+        self.flushed = 0
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._pending.values())
+
+    def add(self, user_id, message_id, reason, author, channel, content, jump_url=None):
+        """Adds a matched message to a user's digest.
+
+        :param user_id: The subscriber.
+        :param message_id: Used to merge several matches of the same message.
+        :param reason: Why they're notified, e.g. 'keyword "foo"'.
+        """
+        entries = self._pending.get(user_id)
+        if entries is None:
+            entries = self._pending[user_id] = {}
+            self._timers[user_id] = asyncio.get_running_loop().call_later(self.window, self.flush, user_id)
+        entry = entries.get(message_id)
+        if entry is None:
+            entries[message_id] = {
+                "reasons": [reason],
+                "author": author,
+                "channel": channel,
+                "content": content,
+                "jump_url": jump_url,
+            }
+        elif reason not in entry["reasons"]:
+            entry["reasons"].append(reason)
+        if len(entries) >= self.max_items:
+            self.flush(user_id)
+
+    def flush(self, user_id):
+        """Sends a user's digest now (if they have anything waiting)."""
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        entries = self._pending.pop(user_id, None)
+        if not entries:
+            return
+        for embed in self._build_embeds(entries.values()):
+            self.notifier.notify(user_id, embed=embed)
+        self.flushed += 1
+
+    def flush_all(self):
+        """Sends every digest now, e.g. before shutting down."""
+        for user_id in list(self._pending):
+            self.flush(user_id)
+
+    def _build_embeds(self, entries):
+        """:return: The embeds for a digest, as many as it takes to keep each one under MAX_EMBED_LENGTH."""
+        fields = []
+        for entry in entries:
+            content = entry["content"]
+            if len(content) > self.MAX_CONTENT_LENGTH:
+                content = content[:self.MAX_CONTENT_LENGTH - 1] + "…"
+            if entry["jump_url"]:
+                content = f"{content}\n[Jump to message]({entry['jump_url']})"
+            name = f"{entry['author']} in #{entry['channel']} ({', '.join(entry['reasons'])})"[:256]
+            fields.append((name, content or "(no text)"))
+        title = "1 new message" if len(fields) == 1 else f"{len(fields)} new messages"
+
+        # leave room for the title (and the part number that goes with it)
+        budget = self.MAX_EMBED_LENGTH - len(title) - 32
+        parts, length = [[]], 0
+        for name, value in fields:
+            if parts[-1] and length + len(name) + len(value) > budget:
+                parts.append([])
+                length = 0
+            parts[-1].append((name, value))
+            length += len(name) + len(value)
+
+        embeds = []
+        for number, part in enumerate(parts, 1):
+            suffix = f" ({number}/{len(parts)})" if len(parts) > 1 else ""
+            embed = discord.Embed(title=f"Your digest: {title}{suffix}", color=discord.Color.purple())
+            for name, value in part:
+                embed.add_field(name=name, value=value, inline=False)
+            embeds.append(embed)
+        return embeds
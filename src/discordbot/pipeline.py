@@ -0,0 +1,194 @@
+import asyncio
+import inspect
+import time
+from collections import deque
+
+from metrics import registry
+
+QUEUE_LAG = registry.histogram("pipeline_queue_lag_seconds", "Time messages waited in the pipeline before a worker took them", ("kind",))
+BATCH_SECONDS = registry.histogram("pipeline_batch_seconds", "Time matching one batch of messages took")
+BATCH_SIZE = registry.histogram("pipeline_batch_size", "Messages matched together", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+DROPPED = registry.counter("pipeline_dropped_total", "Messages dropped because the pipeline was full", ("kind",))
+
+DROP_POLICIES = ("oldest", "newest")
+
+
+class MessageEvent:
+    """The few fields of a discord.Message that notifications need, so queued messages stay small."""
+
+    __slots__ = ("message_id", "guild_id", "channel_name", "author_id", "author_name", "content", "jump_url", "queued_at")
+
+    def __init__(self, message_id, guild_id, channel_name, author_id, author_name, content, jump_url, queued_at=None):
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.channel_name = channel_name
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.jump_url = jump_url
+        self.queued_at = time.monotonic() if queued_at is None else queued_at
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.id, message.guild.id, message.channel.name, message.author.id,
+                   message.author.display_name, message.content, message.jump_url)
+
+
+class MessagePipeline:
+    """Takes incoming messages off the gateway handler and processes them with a pool of worker tasks.
+
+    `on_message` only appends to one of two bounded queues and returns:
+    - commands are started first, as their own tasks (up to `max_commands` at once, so a slow /summarize
+      never holds up notifications),
+    - everything else is matched in micro-batches: a worker takes every message waiting (up to `max_batch`),
+      so under load one batch pays for the per-batch work (like scoring topics) instead of every message.
+
+    When the notification queue is full, the `drop` policy decides what goes: the "oldest" waiting message
+    (the default, notifications about fresh messages are worth more) or the "newest" one.
+
+    :param process_command: Coroutine function `process_command(message)` running a command.
+    :param process_batch: Function (or coroutine function) `process_batch(events)` matching a list of MessageEvents.
+    :param workers: How many worker tasks take messages off the queues.
+    :param max_queue: Most messages (and, separately, commands) waiting before some are dropped.
+    :param max_batch: Most messages matched together.
+    :param max_commands: Most commands running at once.
+    :param drop: "oldest" or "newest".
+    """
+
+    def __init__(self, process_command, process_batch, workers=4, max_queue=10000, max_batch=64, max_commands=32,
+                 drop="oldest"):
+        if drop not in DROP_POLICIES:
+            raise ValueError(f"drop must be one of {', '.join(DROP_POLICIES)}, not {drop!r}")
+        self.process_command = process_command
+        self.process_batch = process_batch
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.max_commands = max_commands
+        self.drop = drop
+        # (message, queued_at) waiting to be run as commands
+        self._commands = deque()
+        self._events = deque()
+        self._running_commands = set()
+        self._busy = 0
+        # futures of workers waiting for work, a new message wakes just one of them
+        self._sleeping = deque()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+        self.processed = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._commands) + len(self._events)
+
+    def start(self):
+        """Starts the worker tasks. Calling it again is a no-op."""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def submit_command(self, message):
+        """Queues a message to run as a command.
+
+        :return: False if too many commands were waiting and it got dropped.
+        """
+        if len(self._commands) >= self.max_queue:
+            self.dropped += 1
+            DROPPED.inc("command")
+            print(f"Command queue full, dropped message {message.id}")
+            return False
+        self._commands.append((message, time.monotonic()))
+        self._notify()
+        return True
+
+    def submit(self, event):
+        """Queues a MessageEvent for keyword, topic and bookmark matching.
+
+        :return: False if the queue was full and a message (this one or the oldest waiting) got dropped.
+        """
+        if len(self._events) >= self.max_queue:
+            self.dropped += 1
+            DROPPED.inc("message")
+            if self.drop == "newest":
+                return False
+            self._events.popleft()
+            self._events.append(event)
+            return False
+        self._events.append(event)
+        self._notify()
+        return True
+
+    async def join(self):
+        """Waits until every queued message has been processed and every started command finished."""
+        while len(self) or self._busy or self._running_commands:
+            self._idle.clear()
+            await self._idle.wait()
+
+    def _notify(self):
+        self._idle.clear()
+        self._wake_one()
+
+    def _wake_one(self):
+        while self._sleeping:
+            waiter = self._sleeping.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _check_idle(self):
+        if not len(self) and not self._busy and not self._running_commands:
+            self._idle.set()
+
+    async def _worker(self):
+        while True:
+            if self._commands and len(self._running_commands) < self.max_commands:
+                message, queued_at = self._commands.popleft()
+                QUEUE_LAG.observe(time.monotonic() - queued_at, "command")
+                task = asyncio.ensure_future(self._run_command(message))
+                self._running_commands.add(task)
+                task.add_done_callback(self._command_done)
+                continue
+            if self._events:
+                batch = [self._events.popleft() for _ in range(min(self.max_batch, len(self._events)))]
+                await self._process(batch)
+                # matching is plain CPU work, give the gateway a turn before the next batch
+                await asyncio.sleep(0)
+                continue
+            self._check_idle()
+            waiter = asyncio.get_running_loop().create_future()
+            self._sleeping.append(waiter)
+            await waiter
+
+    async def _run_command(self, message):
+        try:
+            await self.process_command(message)
+        except Exception as e:
+            print(f"Error processing command {message.content!r}: {e}")
+
+    def _command_done(self, task):
+        self._running_commands.discard(task)
+        # a command slot opened up, a worker may be waiting to start the next one
+        if self._commands:
+            self._wake_one()
+        self._check_idle()
+
+    async def _process(self, batch):
+        self._busy += 1
+        now = time.monotonic()
+        for event in batch:
+            QUEUE_LAG.observe(now - event.queued_at, "message")
+        BATCH_SIZE.observe(len(batch))
+        started = time.perf_counter()
+        try:
+            result = self.process_batch(batch)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            print(f"Error processing {len(batch)} messages: {e}")
+        finally:
+            BATCH_SECONDS.observe(time.perf_counter() - started)
+            self._busy -= 1
+            self.batches += 1
+            self.processed += len(batch)
@@ -0,0 +1,246 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime, timezone
+
+
+def to_timestamp(reminder_time):
+    """Converts a reminder time from Mongo to epoch seconds (naive datetimes from pymongo are UTC)."""
+    if reminder_time.tzinfo is None:
+        reminder_time = reminder_time.replace(tzinfo=timezone.utc)
+    return reminder_time.timestamp()
+
+
+class ReminderScheduler:
+    """Keeps every pending reminder in a min-heap and sleeps until exactly the next one is due.
+
+    Instead of polling Mongo every minute, reminders are loaded once at startup and `schedule`/`cancel`
+    keep the heap up to date (waking the loop up if the earliest deadline changed).
+    Sent reminders are deleted from Mongo in batches.
+
+    With a `lease`, several bot processes can share one database: only the process holding the lease delivers
+    reminders. It loads them all when it's elected and then looks for reminders other processes added every
+    `sync_interval` seconds. Each reminder is claimed with an atomic find_one_and_update before it's sent,
+    so even during a handover between leaders a reminder is sent at most once. A claim older than the lease's
+    ttl belongs to a process that died or lost the lease before deleting the reminder, so the leader takes it
+    over: the reminder goes out late (or, if that process died right after sending it, twice) instead of never.
+
+    :param reminders: The reminders AsyncCollection.
+    :param send: Coroutine function `send(user_id, label)` that delivers one reminder.
+    :param clock: Returns the current time in epoch seconds, swap it out to test with a fake clock.
+    :param flush_interval: Longest time (in seconds) a sent reminder waits before being deleted from Mongo.
+    :param batch_size: Deletes are flushed right away once this many are waiting.
+    :param retry_delay: How long to wait before retrying a reminder that failed to send.
+    :param lease: Optional coordination.Lease, reminders are only delivered while we hold it.
+    :param sync_interval: How often (in seconds) the leader picks up reminders added by other processes.
+    """
+
+    def __init__(self, reminders, send, clock=time.time, flush_interval=5.0, batch_size=100, retry_delay=60.0,
+                 lease=None, sync_interval=10.0):
+        self.reminders = reminders
+        self.send = send
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.sync_interval = sync_interval
+        # heap entries are [timestamp, sequence, reminder_id, user_id, label]
+        self._heap = []
+        # (user_id, label) -> the live heap entry, anything else in the heap is a cancelled leftover
+        self._pending = {}
+        self._sequence = 0
+        self._wakeup = asyncio.Event()
+        self._sent_ids = []
+        self._first_sent_at = None
+        self._next_sync = None
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _claimable(self):
+        """:return: The filter for reminders we may deliver (and claim)."""
+        if self.lease is None:
+            return {"claimed_by": None}
+        # reminders claimed by someone else were (or are being) sent already, unless the claim went stale
+        stale = datetime.fromtimestamp(self.clock() - self.lease.ttl, timezone.utc)
+        return {"$or": [{"claimed_by": {"$in": [None, self.lease.owner]}}, {"claimed_at": {"$lt": stale}}]}
+
+    async def load(self):
+        """Replaces the heap with every reminder stored in Mongo."""
+        heap, pending = [], {}
+        # sent, but the delete didn't go through yet
+        sent_ids = set(self._sent_ids)
+        async for batch in self.reminders.find_batches(self._claimable(), {"user_id": 1, "label": 1, "reminder_time": 1}):
+            for doc in batch:
+                if doc["_id"] in sent_ids:
+                    continue
+                self._sequence += 1
+                entry = [to_timestamp(doc["reminder_time"]), self._sequence, doc["_id"], doc["user_id"], doc["label"]]
+                heap.append(entry)
+                pending[(doc["user_id"], doc["label"])] = entry
+        # keep whatever got scheduled while we were loading
+        for entry in self._heap:
+            key = (entry[3], entry[4])
+            if self._pending.get(key) is entry and key not in pending:
+                heap.append(entry)
+                pending[key] = entry
+        heapq.heapify(heap)
+        self._heap, self._pending = heap, pending
+        self._wakeup.set()
+
+    def schedule(self, reminder_id, user_id, label, reminder_time):
+        """Adds a reminder, replacing any pending one with the same label for that user.
+
+        :param reminder_id: The reminder's Mongo _id, used to delete it once sent.
+        :param reminder_time: A datetime, or epoch seconds.
+        """
+        if not isinstance(reminder_time, (int, float)):
+            reminder_time = to_timestamp(reminder_time)
+        self._sequence += 1
+        entry = [reminder_time, self._sequence, reminder_id, user_id, label]
+        self._pending[(user_id, label)] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def cancel(self, user_id, label):
+        """Cancels a pending reminder. Its heap entry is skipped when it comes up instead of being searched for."""
+        entry = self._pending.pop((user_id, label), None)
+        if entry is not None and self._heap and self._heap[0] is entry:
+            self._wakeup.set()
+
+    def next_due(self):
+        """:return: The epoch time of the earliest pending reminder, or None if there's nothing pending."""
+        self._drop_cancelled()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """Removes and returns the reminders that are due.
+
+        :param now: Epoch seconds, defaults to the scheduler's clock.
+        :return: A list of (reminder_id, user_id, label) tuples, earliest first.
+        """
+        if now is None:
+            now = self.clock()
+        due = []
+        while True:
+            self._drop_cancelled()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            _, _, reminder_id, user_id, label = heapq.heappop(self._heap)
+            del self._pending[(user_id, label)]
+            due.append((reminder_id, user_id, label))
+
+    def _drop_cancelled(self):
+        heap = self._heap
+        while heap and self._pending.get((heap[0][3], heap[0][4])) is not heap[0]:
+            heapq.heappop(heap)
+
+    async def run(self):
+        """Background task delivering reminders as they come due. Runs forever."""
+        while True:
+            # _next_sync is only set once we loaded the reminders as leader (the lease may be ours already)
+            if self.lease is not None and (not self.lease.held or self._next_sync is None):
+                await self._wait_for_lease()
+                continue
+            self._wakeup.clear()
+            timeout = self._seconds_until_next_action()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if self.lease is not None and not self.lease.held:
+                continue
+            due = self.pop_due()
+            if due:
+                await asyncio.gather(*(self._deliver(*reminder) for reminder in due))
+            await self._flush_if_needed()
+            if self._next_sync is not None and self.clock() >= self._next_sync:
+                await self.sync()
+
+    async def _wait_for_lease(self):
+        # whoever holds the lease delivers every reminder, ours included
+        await self.flush()
+        self._heap, self._pending = [], {}
+        self._next_sync = None
+        await self.lease.wait_elected()
+        try:
+            await self.load()
+        except Exception as e:
+            print(f"Error loading reminders after becoming leader: {e}")
+            self._heap, self._pending = [], {}
+            await asyncio.sleep(self.retry_delay)
+            return
+        self._next_sync = self.clock() + self.sync_interval
+
+    async def sync(self):
+        """Schedules reminders that other processes added and that are due before the next sync."""
+        self._next_sync = self.clock() + self.sync_interval
+        horizon = datetime.fromtimestamp(self.clock() + 2 * self.sync_interval, timezone.utc)
+        try:
+            async for batch in self.reminders.find_batches({"reminder_time": {"$lte": horizon}, **self._claimable()},
+                                                           {"user_id": 1, "label": 1, "reminder_time": 1}):
+                for doc in batch:
+                    entry = self._pending.get((doc["user_id"], doc["label"]))
+                    if (entry is None or entry[2] != doc["_id"]) and doc["_id"] not in self._sent_ids:
+                        self.schedule(doc["_id"], doc["user_id"], doc["label"], doc["reminder_time"])
+        except Exception as e:
+            print(f"Error syncing reminders: {e}")
+
+    def _seconds_until_next_action(self):
+        now = self.clock()
+        deadlines = []
+        next_due = self.next_due()
+        if next_due is not None:
+            deadlines.append(next_due)
+        if self._sent_ids:
+            deadlines.append(self._first_sent_at + self.flush_interval)
+        if self._next_sync is not None:
+            deadlines.append(self._next_sync)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - now)
+
+    async def _claim(self, reminder_id):
+        # only one process gets to flip claimed_by, and a reminder someone deleted meanwhile can't be claimed
+        doc = await self.reminders.find_one_and_update(
+            {"_id": reminder_id, **self._claimable()},
+            {"$set": {"claimed_by": self.lease.owner, "claimed_at": datetime.fromtimestamp(self.clock(), timezone.utc)}},
+            projection={"_id": 1}
+        )
+        return doc is not None
+
+    async def _deliver(self, reminder_id, user_id, label):
+        try:
+            if self.lease is not None and not await self._claim(reminder_id):
+                self.skipped += 1
+                return
+            await self.send(user_id, label)
+        except Exception as e:
+            print(f"Error sending reminder '{label}' to {user_id}, retrying in {self.retry_delay}s: {e}")
+            self.schedule(reminder_id, user_id, label, self.clock() + self.retry_delay)
+            return
+        if not self._sent_ids:
+            self._first_sent_at = self.clock()
+        self._sent_ids.append(reminder_id)
+
+    async def _flush_if_needed(self):
+        if not self._sent_ids:
+            return
+        if len(self._sent_ids) >= self.batch_size or self.clock() >= self._first_sent_at + self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        """Deletes every sent reminder from Mongo in one round trip."""
+        sent_ids, self._sent_ids = self._sent_ids, []
+        if not sent_ids:
+            return
+        try:
+            await self.reminders.delete_many({"_id": {"$in": sent_ids}})
+        except Exception as e:
+            print(f"Error deleting sent reminders: {e}")
+            self._sent_ids = sent_ids + self._sent_ids
+            self._first_sent_at = self.clock()
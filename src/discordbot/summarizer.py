@@ -0,0 +1,234 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from cache import TTLCache
+
+CHUNK_PROMPT = "Summarize the following messages:"
+REDUCE_PROMPT = "The following are summaries of consecutive parts of a conversation. Combine them into one summary:"
+FOLD_PROMPT = "The first part is a summary of a conversation, the rest are newer messages from it. Update the summary to include them:"
+
+# Discord's limit for a single message
+MESSAGE_LIMIT = 2000
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about 4 characters per token for English), good enough for budgeting chunks."""
+    return len(text) // 4 + 1
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """Splits text into pieces Discord will accept, preferring to break at newlines."""
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+class Summarizer:
+    """Map-reduce summaries that work for any number of messages.
+
+    Messages are streamed from the history iterator and cut into chunks that fit a token budget.
+    Each chunk is summarized as soon as it's full (a few at a time), then the partial summaries
+    are combined, in more rounds if they don't fit in one request either.
+
+    :param complete: Coroutine function `complete(prompt, text, guild_id=None)` returning the LLM's answer.
+    :param chunk_tokens: Token budget for the text sent with each request.
+    :param max_concurrency: How many chunk summaries may be requested at once.
+    :param ignore: Optional predicate, messages it returns True for are left out of summaries.
+    """
+
+    def __init__(self, complete, chunk_tokens=3000, max_concurrency=4, ignore=None):
+        self.complete = complete
+        self.chunk_tokens = chunk_tokens
+        self.max_concurrency = max_concurrency
+        self.ignore = ignore
+
+    async def summarize(self, history, progress=None, guild_id=None, previous=None, limit=None):
+        """Summarizes the messages coming out of `history`.
+
+        :param history: Async iterator of message_buffer.CachedMessage, newest first (like `channel.history()`).
+        :param progress: Optional coroutine function called with a short status string as work goes on.
+        :param guild_id: Passed on to `complete`, so requests count against the guild's limit.
+        :param previous: A summary of the messages right before `history`, the new messages get folded into it.
+        :param limit: The most messages `history` yields. If it yields that many, there may be messages missing
+                      between them and `previous`, so `previous` is left out and the summary starts from scratch.
+        :return: A (summary, newest message id) tuple. The summary is None if there was nothing to summarize,
+                 the id is None if `history` was empty.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        status = {"read": 0, "chunks": 0, "done": 0}
+        tasks = []
+
+        async def report(force=False):
+            if progress is not None:
+                await progress(f"Read {status['read']} messages, summarized {status['done']}/{status['chunks']} parts...", force)
+
+        async def summarize_chunk(lines):
+            async with semaphore:
+                # history is newest first, the model should read the conversation in order
+                summary = await self.complete(CHUNK_PROMPT, "\n".join(reversed(lines)), guild_id=guild_id)
+            status["done"] += 1
+            await report()
+            return summary
+
+        lines, used = [], 0
+        newest_id = None
+        fetched = 0
+        async for message in history:
+            fetched += 1
+            if newest_id is None:
+                newest_id = message.id
+            if not message.content or (self.ignore is not None and self.ignore(message)):
+                continue
+            line = f"{message.author_name}: {message.content}"
+            cost = estimate_tokens(line)
+            if lines and used + cost > self.chunk_tokens:
+                tasks.append(asyncio.ensure_future(summarize_chunk(lines)))
+                status["chunks"] += 1
+                lines, used = [], 0
+            # a single giant message still has to fit in one request
+            if cost > self.chunk_tokens:
+                line = line[:self.chunk_tokens * 4]
+                cost = self.chunk_tokens
+            lines.append(line)
+            used += cost
+            status["read"] += 1
+            if status["read"] % 100 == 0:
+                await report()
+        if limit is not None and fetched >= limit:
+            previous = None
+        if previous is not None and not tasks:
+            if not lines:
+                return previous, newest_id
+            # few enough new messages for one request: fold them straight into the previous summary
+            await report(force=True)
+            async with semaphore:
+                text = "\n".join([previous, ""] + lines[::-1])
+                return await self.complete(FOLD_PROMPT, text, guild_id=guild_id), newest_id
+        if lines:
+            tasks.append(asyncio.ensure_future(summarize_chunk(lines)))
+            status["chunks"] += 1
+        if not tasks:
+            return None, newest_id
+        await report(force=True)
+
+        try:
+            summaries = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        # chunks were cut newest first, put them back in chronological order
+        summaries.reverse()
+        if previous is not None:
+            summaries.insert(0, previous)
+        return await self._reduce(summaries, semaphore, progress, guild_id), newest_id
+
+    async def _reduce(self, summaries, semaphore, progress, guild_id):
+        while len(summaries) > 1:
+            if progress is not None:
+                await progress(f"Combining {len(summaries)} partial summaries...", True)
+            groups, group, used = [], [], 0
+            for summary in summaries:
+                cost = estimate_tokens(summary)
+                if group and used + cost > self.chunk_tokens:
+                    groups.append(group)
+                    group, used = [], 0
+                group.append(summary)
+                used += cost
+            groups.append(group)
+            if len(groups) == len(summaries):
+                # every summary is as big as the budget on its own, pair them up so we still make progress
+                groups = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+
+            async def combine(group):
+                if len(group) == 1:
+                    return group[0]
+                async with semaphore:
+                    return await self.complete(REDUCE_PROMPT, "\n\n".join(group), guild_id=guild_id)
+
+            summaries = list(await asyncio.gather(*(combine(group) for group in groups)))
+        return summaries[0]
+
+
+class SummaryCache:
+    """Remembers recent summaries per (channel, number of messages) so repeated requests are cheap.
+
+    Entries remember the id of the newest message they cover. If nothing was posted since, the summary is
+    reused as is, otherwise only the newer messages need to be fetched and folded in.
+    Entries live in a bounded LRU with a TTL, and optionally in Mongo so they survive restarts.
+
+    :param max_entries: How many summaries to keep in memory.
+    :param ttl: How long (in seconds) a summary can be reused or extended.
+    :param collection: Optional AsyncCollection to persist summaries in.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600.0, collection=None):
+        self.ttl = ttl
+        self.collection = collection
+        self._entries = TTLCache(max_entries, ttl)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, channel_id, num_messages):
+        """:return: A dict with `summary`, `last_message_id` and `created_at`, or None."""
+        key = (channel_id, num_messages)
+        entry = self._entries.get(key)
+        if entry is None and self.collection is not None:
+            entry = await self.collection.find_one(
+                {"channel_id": channel_id, "num_messages": num_messages},
+                {"_id": 0, "summary": 1, "last_message_id": 1, "created_at": 1}
+            )
+            if entry is not None:
+                age = (datetime.now(timezone.utc) - entry["created_at"]).total_seconds()
+                if age >= self.ttl:
+                    entry = None
+                else:
+                    self._entries.put(key, entry, ttl=self.ttl - age)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def put(self, channel_id, num_messages, summary, last_message_id, created_at=None):
+        """Stores a summary covering the messages up to `last_message_id`.
+
+        :param created_at: When the summary was first made, kept when it's only extended so the TTL still applies.
+        """
+        entry = {
+            "summary": summary,
+            "last_message_id": last_message_id,
+            "created_at": created_at or datetime.now(timezone.utc),
+        }
+        age = (datetime.now(timezone.utc) - entry["created_at"]).total_seconds()
+        self._entries.put((channel_id, num_messages), entry, ttl=max(0.0, self.ttl - age))
+        if self.collection is not None:
+            await self.collection.update_one(
+                {"channel_id": channel_id, "num_messages": num_messages},
+                {"$set": entry},
+                upsert=True
+            )
+
+
+class ProgressMessage:
+    """Shows progress by editing one Discord message, at most once every `interval` seconds."""
+
+    def __init__(self, message, interval=1.5):
+        self.message = message
+        self.interval = interval
+        self._last_edit = 0.0
+
+    async def update(self, text, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_edit < self.interval:
+            return
+        self._last_edit = now
+        await self.message.edit(content=text)
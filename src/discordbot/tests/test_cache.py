@@ -0,0 +1,95 @@
+import asyncio
+from datetime import datetime, timezone
+
+import mongomock
+
+from cache import SubscriptionCache
+from database import Repository
+
+GUILD_ID = 300
+
+
+def with_cache(test):
+    async def main():
+        repository = Repository(mongomock.MongoClient()["test"])
+        cache = SubscriptionCache(repository)
+        await cache.load([GUILD_ID])
+        try:
+            await test(cache)
+        finally:
+            repository.executor.shutdown()
+
+    asyncio.run(main())
+
+
+def test_keywords_from_the_guild_and_global_partitions_match_once():
+    async def test(cache):
+        await cache.add_keyword(1, None, "Foo")
+        await cache.add_keyword(1, GUILD_ID, "foo")
+        await cache.add_keyword(1, None, "bar")
+        await cache.add_keyword(2, None, "foo")
+        matches = cache.match_keywords("FOO and bar", GUILD_ID)
+        # the guild's spelling wins
+        assert matches == {1: ["foo", "bar"], 2: ["foo"]}
+
+    with_cache(test)
+
+
+def test_different_spellings_in_one_partition_match_once():
+    async def test(cache):
+        await cache.add_keyword(1, GUILD_ID, "Foo")
+        await cache.add_keyword(1, GUILD_ID, "foo")
+        assert cache.match_keywords("foo", GUILD_ID) == {1: ["foo"]}
+        await cache.remove_keyword(1, GUILD_ID, "foo")
+        assert cache.match_keywords("foo", GUILD_ID) == {1: ["Foo"]}
+
+    with_cache(test)
+
+
+def test_reminders_can_be_added_again_once_another_process_deleted_them():
+    async def test(cache):
+        assert await cache.add_reminder(1, "standup", datetime(2030, 1, 1, tzinfo=timezone.utc)) is not None
+        assert await cache.add_reminder(1, "standup", datetime(2030, 1, 2, tzinfo=timezone.utc)) is None
+        # the leader sent it and deleted it, this process's cache still lists it
+        cache.repository.reminders.collection.delete_many({})
+        assert "standup" in cache.reminders_for(1)
+        assert await cache.add_reminder(1, "standup", datetime(2030, 1, 3, tzinfo=timezone.utc)) is not None
+        assert cache.reminders_for(1)["standup"] == datetime(2030, 1, 3, tzinfo=timezone.utc)
+
+        cache.repository.reminders.collection.delete_many({})
+        added = await cache.add_reminders(1, [("standup", datetime(2030, 1, 4, tzinfo=timezone.utc)),
+                                              ("retro", datetime(2030, 1, 5, tzinfo=timezone.utc))])
+        assert sorted(label for _, label, _ in added) == ["retro", "standup"]
+
+    with_cache(test)
+
+
+def test_keyword_automaton_is_rebuilt_in_the_background():
+    async def test(cache):
+        await cache.add_keywords(1, GUILD_ID, [f"key{number}x" for number in range(100)])
+        index = cache.guilds[GUILD_ID].keyword_index
+        # matched straight away, before the new automaton is built
+        assert index.needs_rebuild
+        assert cache.match_keywords("key42x", GUILD_ID) == {1: ["key42x"]}
+        await asyncio.wait_for(asyncio.gather(*cache._index_builds.values()), timeout=5)
+        assert not index.needs_rebuild and not index._pending
+        assert cache.match_keywords("key42x", GUILD_ID) == {1: ["key42x"]}
+
+    with_cache(test)
+
+
+def test_bookmarks_with_one_or_more_subscribers():
+    async def test(cache):
+        assert await cache.add_bookmark(1, GUILD_ID, 50)
+        assert list(cache.bookmark_subscribers_for(50, GUILD_ID)) == [1]
+        assert await cache.add_bookmark(2, GUILD_ID, 50)
+        assert await cache.add_bookmark(2, None, 60)
+        assert sorted(cache.bookmark_subscribers_for(50, GUILD_ID)) == [1, 2]
+        assert cache.bookmarks_for(2, GUILD_ID) == {50, 60}
+        assert cache.stats()["bookmarks"] == 3
+        assert await cache.remove_bookmark(1, GUILD_ID, 50)
+        assert list(cache.bookmark_subscribers_for(50, GUILD_ID)) == [2]
+        assert await cache.remove_bookmark(2, GUILD_ID, 50)
+        assert list(cache.bookmark_subscribers_for(50, GUILD_ID)) == []
+
+    with_cache(test)
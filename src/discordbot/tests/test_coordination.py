@@ -0,0 +1,161 @@
+import asyncio
+from datetime import datetime, timezone
+
+import mongomock
+
+from coordination import Lease
+from database import Repository
+from scheduler import ReminderScheduler
+
+START = 1700000000.0
+TTL = 30.0
+
+
+class FakeClock:
+    def __init__(self, now=START):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Process:
+    """One bot process: its own lease and reminder scheduler, on the database every process shares."""
+
+    def __init__(self, name, repository, clock, sent):
+        self.name = name
+        self.lease = Lease(repository.leases, "reminders", owner=name, ttl=TTL, renew_interval=TTL / 3, clock=clock)
+
+        async def send(user_id, label):
+            sent.append((self.name, user_id, label))
+
+        # tiny (fake) intervals, so the loop never sleeps long in real time
+        self.scheduler = ReminderScheduler(repository.reminders, send, clock=clock, flush_interval=0,
+                                           lease=self.lease, sync_interval=0.01)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.scheduler.run())
+
+    def stop(self):
+        self.task.cancel()
+
+
+def add_reminder(repository, user_id, label, timestamp, **fields):
+    reminder = {"user_id": user_id, "label": label, "reminder_time": datetime.fromtimestamp(timestamp, timezone.utc)}
+    return repository.reminders.collection.insert_one({**reminder, **fields}).inserted_id
+
+
+async def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+def with_processes(test):
+    async def main():
+        repository = Repository(mongomock.MongoClient()["test"])
+        clock = FakeClock()
+        sent = []
+        processes = [Process(name, repository, clock, sent) for name in ("a", "b")]
+        try:
+            await test(repository, clock, sent, *processes)
+        finally:
+            for process in processes:
+                if process.task is not None:
+                    process.stop()
+            repository.executor.shutdown()
+
+    asyncio.run(main())
+
+
+def test_one_leader_until_the_lease_expires():
+    async def test(repository, clock, sent, a, b):
+        assert await a.lease.acquire()
+        assert not await b.lease.acquire()
+        # renewing keeps it
+        clock.now += TTL - 1
+        assert await a.lease.acquire()
+        clock.now += TTL - 1
+        assert not await b.lease.acquire()
+        assert a.lease.held and not b.lease.held
+
+        # a stops renewing (it died), b takes over once the lease expired
+        clock.now += TTL + 1
+        assert not a.lease.held
+        assert await b.lease.acquire()
+        assert not await a.lease.acquire()
+        assert b.lease.held and b.lease.elections == 1
+
+    with_processes(test)
+
+
+def test_each_reminder_is_sent_once_across_a_handover():
+    async def test(repository, clock, sent, a, b):
+        for number in range(10):
+            add_reminder(repository, number, "now", START - 1)
+            add_reminder(repository, number, "later", START + 60)
+        assert await a.lease.acquire()
+        assert not await b.lease.acquire()
+        a.start()
+        b.start()
+        await wait_until(lambda: len(sent) == 10)
+
+        # a dies, b becomes leader once a's lease expired, by then the later reminders are due too
+        a.stop()
+        clock.now = START + TTL + 61
+        assert await b.lease.acquire()
+        await wait_until(lambda: len(sent) == 20)
+        await wait_until(lambda: repository.reminders.collection.count_documents({}) == 0)
+
+        assert sorted((name, label) for name, _, label in sent) == [("a", "now")] * 10 + [("b", "later")] * 10
+        assert len({(user_id, label) for _, user_id, label in sent}) == 20
+
+    with_processes(test)
+
+
+def test_an_old_leader_cant_send_what_the_new_one_claimed():
+    async def test(repository, clock, sent, a, b):
+        add_reminder(repository, 1, "due", START - 1)
+        assert await a.lease.acquire()
+        await a.scheduler.load()
+
+        # a stalls without renewing (nothing sent yet), b takes over and sends the reminder
+        clock.now += TTL + 1
+        assert await b.lease.acquire()
+        b.start()
+        await wait_until(lambda: len(sent) == 1)
+
+        # a wakes up with its old view of the reminders: its claim fails
+        for reminder in a.scheduler.pop_due():
+            await a.scheduler._deliver(*reminder)
+        assert sent == [("b", 1, "due")]
+        assert a.scheduler.skipped == 1
+
+    with_processes(test)
+
+
+def test_stale_claims_are_taken_over():
+    async def test(repository, clock, sent, a, b):
+        # a claimed this one and died before sending (or deleting) it
+        add_reminder(repository, 1, "orphan", START - 1, claimed_by="a",
+                     claimed_at=datetime.fromtimestamp(START, timezone.utc))
+        # and a claim that's still fresh when b takes over is left alone
+        add_reminder(repository, 2, "fresh", START - 1, claimed_by="a",
+                     claimed_at=datetime.fromtimestamp(START + TTL, timezone.utc))
+        clock.now = START + TTL + 1
+        assert await b.lease.acquire()
+        b.start()
+        await wait_until(lambda: len(sent) == 1)
+        await wait_until(lambda: repository.reminders.collection.count_documents({"label": "orphan"}) == 0)
+        assert sent == [("b", 1, "orphan")]
+
+        # once that claim went stale too, b sends it
+        clock.now = START + 2 * TTL + 1
+        assert await b.lease.acquire()
+        await wait_until(lambda: len(sent) == 2)
+        assert sent[1] == ("b", 2, "fresh")
+
+    with_processes(test)
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+
+import mongomock
+
+from database import Repository
+
+
+class SlowCollection:
+    """A mongomock collection whose find_one blocks its thread until released, like a slow Mongo round trip."""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def find_one(self, *args, **kwargs):
+        self.started.set()
+        assert self.release.wait(timeout=5), "find_one was never released"
+        return self._collection.find_one(*args, **kwargs)
+
+
+def test_loop_keeps_serving_events_while_a_mongo_call_is_slow():
+    async def main():
+        repository = Repository(mongomock.MongoClient()["test"])
+        repository.keywords.collection.insert_one({"user_id": 1, "keywords": ["deploy"]})
+        slow = SlowCollection(repository.keywords.collection)
+        repository.keywords.collection = slow
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        ticking = asyncio.ensure_future(ticker())
+        lookup = asyncio.ensure_future(repository.keywords.find_one({"user_id": 1}))
+        # wait (without blocking the loop) until the worker thread is stuck inside find_one
+        while not slow.started.is_set():
+            await asyncio.sleep(0.001)
+        ticks_while_blocked = ticks
+        for _ in range(100):
+            await asyncio.sleep(0)
+        assert not lookup.done()
+        assert ticks >= ticks_while_blocked + 100
+
+        slow.release.set()
+        doc = await asyncio.wait_for(lookup, timeout=5)
+        assert doc["keywords"] == ["deploy"]
+        ticking.cancel()
+        repository.executor.shutdown()
+
+    asyncio.run(main())
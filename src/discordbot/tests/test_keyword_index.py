@@ -0,0 +1,63 @@
+import random
+
+from keyword_index import KeywordIndex
+
+
+def naive_match(subscriptions, text):
+    matches = {}
+    for user_id, keyword in subscriptions:
+        if keyword.lower() in text.lower():
+            matches.setdefault(user_id, []).append(keyword)
+    return {user_id: sorted(keywords) for user_id, keywords in matches.items()}
+
+
+def sorted_matches(index, text):
+    return {user_id: sorted(keywords) for user_id, keywords in index.match(text).items()}
+
+
+def test_matches_the_old_loop_through_adds_removes_and_rebuilds():
+    rng = random.Random(1)
+    # a small alphabet, so keywords overlap and are suffixes of each other a lot
+    words = ["".join(rng.choice("abcd") for _ in range(rng.randint(1, 5))) for _ in range(300)]
+    index = KeywordIndex(max_pending=8)
+    subscriptions = set()
+    texts = ["".join(rng.choice("abcd ") for _ in range(60)) for _ in range(50)]
+    for step in range(600):
+        if rng.random() < 0.3 and subscriptions:
+            user_id, keyword = rng.choice(sorted(subscriptions))
+            index.remove(user_id, keyword)
+            subscriptions.discard((user_id, keyword))
+        else:
+            user_id, keyword = rng.randrange(20), rng.choice(words)
+            index.add(user_id, keyword)
+            subscriptions.add((user_id, keyword))
+        if index.needs_rebuild:
+            index.rebuild()
+        if step % 50 == 0:
+            for text in texts:
+                assert sorted_matches(index, text) == naive_match(subscriptions, text)
+
+
+def test_new_keywords_match_before_the_automaton_is_rebuilt():
+    index = KeywordIndex()
+    index.add(1, "deploy")
+    index.rebuild()
+    index.add(2, "Release")
+    assert not index.needs_rebuild
+    assert sorted_matches(index, "the release is deployed") == {1: ["deploy"], 2: ["Release"]}
+    index.remove(1, "deploy")
+    assert index.search("the release is deployed") == {"release"}
+
+
+def test_rebuilding_drops_untracked_keywords():
+    index = KeywordIndex(max_pending=4)
+    for number in range(100):
+        index.add(number, f"keyword{number}")
+    index.rebuild()
+    for number in range(60):
+        index.remove(number, f"keyword{number}")
+    assert index.needs_rebuild
+    index.rebuild()
+    assert len(index._automaton.pattern_ids) == 40
+    assert not index.needs_rebuild
+    assert sorted_matches(index, "keyword5 keyword75") == {75: ["keyword75"]}
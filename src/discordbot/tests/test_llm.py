@@ -0,0 +1,68 @@
+import asyncio
+import threading
+
+import openai
+
+from llm import LLMClient
+
+
+class BlockingClient(LLMClient):
+    """An LLMClient whose requests block their thread until `release` is set."""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.release = threading.Event()
+        self.calls = 0
+
+    def _create(self, prompt, text):
+        self.calls += 1
+        self.release.wait(timeout=5)
+        return f"summary of {text}"
+
+
+def test_timed_out_requests_keep_their_slot_until_the_thread_is_done():
+    async def main():
+        client = BlockingClient(max_concurrency=1, per_guild=1, timeout=0.05)
+        try:
+            await client.complete("summarize", "first")
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("the first request should have timed out")
+        assert client.timeouts == 1
+        # its thread is still busy, so it still counts and still holds the only slot
+        assert client.stats()["in_flight"] == 1
+
+        client.timeout = 5
+        second = asyncio.ensure_future(client.complete("summarize", "second"))
+        await asyncio.sleep(0.05)
+        assert client.calls == 1 and client.waiting == 1
+
+        client.release.set()
+        assert await asyncio.wait_for(second, timeout=5) == "summary of second"
+        assert client.stats() == {"waiting": 0, "in_flight": 0, "completed": 1, "timeouts": 1}
+        client.executor.shutdown()
+
+    asyncio.run(main())
+
+
+def test_requests_pass_the_timeout_to_openai(monkeypatch):
+    calls = []
+
+    class Response:
+        choices = [type("Choice", (), {"message": {"content": "ok"}})]
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return Response()
+
+    monkeypatch.setattr(openai, "ChatCompletion", type("ChatCompletion", (), {"create": staticmethod(create)}), raising=False)
+
+    async def main():
+        client = LLMClient(timeout=12.5)
+        answer = await client.complete("summarize", "text")
+        client.executor.shutdown()
+        return answer
+
+    assert asyncio.run(main()) == "ok"
+    assert calls[0]["request_timeout"] == 12.5
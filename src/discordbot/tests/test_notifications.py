@@ -0,0 +1,188 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+from notifications import DigestBuffer, NotificationDispatcher
+
+
+def http_error(cls, status):
+    return cls(SimpleNamespace(status=status, reason="stub"), f"stub {status}")
+
+
+class StubChannel:
+    """A DM channel whose sends fail with the given errors, in order, and then succeed."""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.attempts = 0
+        self.sent = []
+
+    async def send(self, content=None, embed=None):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(content)
+
+
+class StubUsers:
+    def __init__(self, channel):
+        self.channel = channel
+        self.forgotten = []
+
+    async def get_dm_channel(self, user_id):
+        return self.channel
+
+    def forget(self, user_id):
+        self.forgotten.append(user_id)
+
+
+def send_through_dispatcher(channel, *contents, **options):
+    """Sends each content to user 1 through a dispatcher and returns (results, dispatcher, users)."""
+    async def main():
+        users = StubUsers(channel)
+        dispatcher = NotificationDispatcher(users, workers=2, base_delay=0.001, **options)
+        dispatcher.start()
+        results = []
+        for content in contents:
+            try:
+                results.append(await asyncio.wait_for(dispatcher.send(1, content), timeout=5))
+            except discord.HTTPException as e:
+                results.append(e)
+        return results, dispatcher, users
+
+    return asyncio.run(main())
+
+
+def test_rate_limits_and_server_errors_are_retried():
+    channel = StubChannel([http_error(discord.HTTPException, 429), http_error(discord.HTTPException, 502)])
+    results, dispatcher, _ = send_through_dispatcher(channel, "hello")
+    assert results == [True]
+    assert channel.attempts == 3
+    assert channel.sent == ["hello"]
+    assert dispatcher.sent == 1 and dispatcher.failed == 0
+
+
+def test_gives_up_after_max_retries():
+    channel = StubChannel([http_error(discord.HTTPException, 500) for _ in range(10)])
+    results, dispatcher, _ = send_through_dispatcher(channel, "hello", max_retries=3)
+    assert isinstance(results[0], discord.HTTPException) and results[0].status == 500
+    assert channel.attempts == 4
+    assert dispatcher.failed == 1
+
+
+def test_client_errors_are_not_retried():
+    channel = StubChannel([http_error(discord.HTTPException, 400)])
+    results, dispatcher, _ = send_through_dispatcher(channel, "too long")
+    assert isinstance(results[0], discord.HTTPException) and results[0].status == 400
+    assert channel.attempts == 1
+    assert dispatcher.failed == 1
+
+
+def test_users_refusing_dms_are_skipped_for_a_while():
+    channel = StubChannel([http_error(discord.Forbidden, 403)])
+    results, dispatcher, _ = send_through_dispatcher(channel, "first", "second")
+    assert results == [False, False]
+    # the second DM never reached Discord
+    assert channel.attempts == 1
+    assert dispatcher.sent == 0 and dispatcher.failed == 0
+
+
+def test_refused_users_are_tried_again_after_forbidden_ttl():
+    channel = StubChannel([http_error(discord.Forbidden, 403)])
+    results, _, _ = send_through_dispatcher(channel, "first", "second", forbidden_ttl=0)
+    assert results == [False, True]
+    assert channel.attempts == 2
+
+
+def test_only_max_forbidden_refusals_are_remembered():
+    async def main():
+        channel = StubChannel([http_error(discord.Forbidden, 403) for _ in range(100)])
+        dispatcher = NotificationDispatcher(StubUsers(channel), workers=4, base_delay=0.001, max_forbidden=10)
+        dispatcher.start()
+        results = [await dispatcher.send(user_id, "hello") for user_id in range(100)]
+        return results, dispatcher
+
+    results, dispatcher = asyncio.run(main())
+    assert results == [False] * 100
+    assert len(dispatcher._forbidden) == 10
+
+
+def test_unknown_users_are_forgotten():
+    channel = StubChannel([http_error(discord.NotFound, 404)])
+    results, _, users = send_through_dispatcher(channel, "hello")
+    assert results == [False]
+    assert users.forgotten == [1]
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_dms_to_one_user_stay_in_order_across_retries(status):
+    async def main():
+        channel = StubChannel([http_error(discord.HTTPException, status)])
+        dispatcher = NotificationDispatcher(StubUsers(channel), workers=4, base_delay=0.001)
+        dispatcher.start()
+        for number in range(4):
+            dispatcher.notify(1, f"message {number}")
+        # DMs to one user go out one after the other, so once the last one is sent every one before it is
+        await asyncio.wait_for(dispatcher.send(1, "message 4"), timeout=5)
+        return channel
+
+    channel = asyncio.run(main())
+    assert channel.sent == [f"message {number}" for number in range(5)]
+
+
+def test_join_waits_for_dms_queued_behind_a_send_in_flight():
+    async def main():
+        channel = StubChannel([http_error(discord.HTTPException, 429)])
+        dispatcher = NotificationDispatcher(StubUsers(channel), workers=4, base_delay=0.01)
+        dispatcher.start()
+        for number in range(5):
+            dispatcher.notify(1, f"message {number}")
+        await asyncio.wait_for(dispatcher.join(), timeout=5)
+        return channel
+
+    assert len(asyncio.run(main()).sent) == 5
+
+
+class RecordingNotifier:
+    def __init__(self):
+        self.sent = []
+
+    def notify(self, user_id, content=None, embed=None):
+        self.sent.append((user_id, embed))
+
+
+def fill_digest(digest, user_id, count):
+    for number in range(count):
+        digest.add(user_id, number, 'keyword "' + "k" * 100 + '"', "a" * 100, "c" * 100, "x" * 1000,
+                   f"https://discord.com/channels/1/2/{number}")
+
+
+def test_long_digests_are_split_to_fit_discords_embed_limit():
+    async def main():
+        notifier = RecordingNotifier()
+        digest = DigestBuffer(notifier, window=60, max_items=25)
+        fill_digest(digest, 1, 25)
+        return notifier.sent
+
+    sent = asyncio.run(main())
+    assert len(sent) > 1
+    assert all(len(embed) <= DigestBuffer.MAX_EMBED_LENGTH for _, embed in sent)
+    assert sum(len(embed.fields) for _, embed in sent) == 25
+    assert sent[0][1].title == f"Your digest: 25 new messages (1/{len(sent)})"
+
+
+def test_flush_all_sends_every_pending_digest():
+    async def main():
+        notifier = RecordingNotifier()
+        digest = DigestBuffer(notifier, window=60, max_items=10)
+        fill_digest(digest, 1, 2)
+        fill_digest(digest, 2, 1)
+        digest.flush_all()
+        return notifier.sent, len(digest)
+
+    sent, pending = asyncio.run(main())
+    assert sorted((user_id, len(embed.fields)) for user_id, embed in sent) == [(1, 2), (2, 1)]
+    assert sent[0][1].title == "Your digest: 2 new messages"
+    assert pending == 0
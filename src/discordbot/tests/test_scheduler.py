@@ -0,0 +1,134 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+
+from database import Repository
+from scheduler import ReminderScheduler
+
+START = 1700000000.0
+
+
+class FakeClock:
+    def __init__(self, now=START):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+async def no_send(user_id, label):
+    pass
+
+
+def test_due_to_the_second_with_100k_pending():
+    clock = FakeClock()
+    scheduler = ReminderScheduler(None, no_send, clock=clock)
+    rng = random.Random(1)
+    deadlines = {}
+    for number in range(100000):
+        deadline = START + rng.uniform(0, 3 * 3600)
+        deadlines[number] = deadline
+        scheduler.schedule(number, number, "label", deadline)
+    assert len(scheduler) == 100000
+
+    delivered = {}
+    while len(scheduler):
+        clock.now += 1
+        for reminder_id, _, _ in scheduler.pop_due():
+            delivered[reminder_id] = clock.now
+    assert delivered.keys() == deadlines.keys()
+    # never early, and never more than the one second the fake clock steps by late
+    assert all(0 <= delivered[number] - deadline < 1 for number, deadline in deadlines.items())
+
+
+def test_pop_due_in_deadline_order():
+    scheduler = ReminderScheduler(None, no_send, clock=FakeClock())
+    scheduler.schedule(1, 10, "later", START + 20)
+    scheduler.schedule(2, 10, "sooner", START + 10)
+    scheduler.schedule(3, 11, "not yet", START + 60)
+    assert scheduler.next_due() == START + 10
+    assert scheduler.pop_due(now=START + 9) == []
+    assert scheduler.pop_due(now=START + 30) == [(2, 10, "sooner"), (1, 10, "later")]
+    assert scheduler.next_due() == START + 60
+
+
+def test_cancelled_entries_are_skipped():
+    scheduler = ReminderScheduler(None, no_send, clock=FakeClock())
+    scheduler.schedule(1, 10, "a", START + 10)
+    scheduler.schedule(2, 10, "b", START + 20)
+    scheduler.schedule(3, 11, "a", START + 30)
+    scheduler.cancel(10, "a")
+    # rescheduling a label replaces the old entry, which then gets skipped too
+    scheduler.schedule(4, 11, "a", START + 40)
+    assert len(scheduler) == 2
+    assert scheduler.next_due() == START + 20
+    assert scheduler.pop_due(now=START + 100) == [(2, 10, "b"), (4, 11, "a")]
+    assert scheduler.next_due() is None
+
+
+def test_wakes_up_early_for_a_new_earliest_deadline():
+    async def main():
+        clock = FakeClock()
+        sent = []
+        delivered = asyncio.Event()
+
+        async def send(user_id, label):
+            sent.append((user_id, label))
+            delivered.set()
+
+        scheduler = ReminderScheduler(None, send, clock=clock)
+        # the loop sleeps for an hour (in real time too, the timeout comes from the fake clock)
+        scheduler.schedule(1, 10, "in an hour", START + 3600)
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0.01)
+        assert sent == []
+
+        scheduler.schedule(2, 11, "now", START)
+        await asyncio.wait_for(delivered.wait(), timeout=1)
+        assert sent == [(11, "now")]
+        assert scheduler.next_due() == START + 3600
+        task.cancel()
+
+    asyncio.run(main())
+
+
+def test_flush_deletes_sent_reminders_in_one_delete_many():
+    async def main():
+        repository = Repository(mongomock.MongoClient()["test"])
+        due = datetime.fromtimestamp(START, timezone.utc)
+        for number in range(5):
+            repository.reminders.collection.insert_one({"user_id": number, "label": "due", "reminder_time": due})
+        repository.reminders.collection.insert_one(
+            {"user_id": 99, "label": "later", "reminder_time": due + timedelta(hours=1)})
+        deletes = []
+        delete_many = repository.reminders.delete_many
+
+        async def counting_delete_many(*args, **kwargs):
+            deletes.append(args[0])
+            return await delete_many(*args, **kwargs)
+
+        repository.reminders.delete_many = counting_delete_many
+        sent = []
+
+        async def send(user_id, label):
+            sent.append(user_id)
+
+        scheduler = ReminderScheduler(repository.reminders, send, clock=FakeClock(START), flush_interval=0)
+        await scheduler.load()
+        task = asyncio.ensure_future(scheduler.run())
+        for _ in range(100):
+            if deletes:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+        assert sorted(sent) == [0, 1, 2, 3, 4]
+        assert len(deletes) == 1
+        assert len(deletes[0]["_id"]["$in"]) == 5
+        remaining = list(repository.reminders.collection.find())
+        assert [doc["label"] for doc in remaining] == ["later"]
+        repository.executor.shutdown()
+
+    asyncio.run(main())
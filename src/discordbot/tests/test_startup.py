@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+
+import mongomock
+import pymongo
+
+from coordination import Lease
+from notifications import DigestBuffer, NotificationDispatcher
+
+
+def import_bot(monkeypatch):
+    """Imports bot.py with mongomock in place of MongoDB (without connecting to Discord)."""
+    monkeypatch.setattr(pymongo, "MongoClient", mongomock.MongoClient)
+    import bot
+    bot.bot._connection.user = SimpleNamespace(id=1, name="prioritize-bot")
+    return bot
+
+
+class StubUsers:
+    """Stands in for the UserCache, every user's DM channel just counts what's sent to it."""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def get_dm_channel(self, user_id):
+        return self
+
+    async def send(self, content=None, embed=None):
+        self.sent += 1
+
+
+def test_repeated_on_ready_loads_and_starts_tasks_once(monkeypatch):
+    bot = import_bot(monkeypatch)
+
+    async def main():
+        bot.bot.loop = asyncio.get_running_loop()
+        loads = []
+        load = bot.subscriptions.load
+
+        async def counting_load(*args, **kwargs):
+            loads.append(args)
+            # give the other on_ready calls a chance to run while this one is still loading
+            await asyncio.sleep(0.01)
+            return await load(*args, **kwargs)
+
+        monkeypatch.setattr(bot.subscriptions, "load", counting_load)
+        before = asyncio.all_tasks()
+        try:
+            # a reconnect storm: several on_ready at once, then another one later
+            await asyncio.gather(*(bot.on_ready() for _ in range(3)))
+            started = asyncio.all_tasks() - before
+            await bot.on_ready()
+            assert asyncio.all_tasks() - before == started
+
+            assert len(loads) == 1
+            assert bot.startup_complete
+            assert bot.reminder_scheduler_task in started
+            assert len(bot.background_tasks) == 1
+            assert len(bot.notifier._tasks) == bot.notifier.workers
+            assert len(bot.pipeline._tasks) == bot.pipeline.workers
+            # the scheduler, the event loop monitor, the DM workers and the pipeline workers
+            assert len(started) == 2 + bot.notifier.workers + bot.pipeline.workers
+        finally:
+            for task in asyncio.all_tasks() - before:
+                task.cancel()
+
+    asyncio.run(main())
+
+
+def test_close_sends_pending_digests_and_releases_the_reminders_lease(monkeypatch):
+    bot = import_bot(monkeypatch)
+
+    async def main():
+        lease = Lease(bot.repository.leases, "reminders", owner="closing")
+        successor = Lease(bot.repository.leases, "reminders", owner="successor")
+        monkeypatch.setattr(bot, "reminder_lease", lease)
+        disconnected = []
+
+        async def discord_close():
+            disconnected.append(True)
+
+        monkeypatch.setattr(bot, "discord_close", discord_close)
+        # fresh ones, the bot's were started on another test's event loop
+        notifier = NotificationDispatcher(StubUsers())
+        monkeypatch.setattr(bot, "notifier", notifier)
+        monkeypatch.setattr(bot, "digests", DigestBuffer(notifier))
+        notifier.start()
+        assert await lease.acquire()
+        assert not await successor.acquire()
+        bot.digests.add(1, 1, 'keyword "deploy"', "someone", "general", "we deploy today")
+
+        await bot.bot.close()
+        assert notifier.users.sent == 1
+        assert len(bot.digests) == 0
+        assert not lease.held
+        # no need to wait for the lease to expire
+        assert await successor.acquire()
+        assert disconnected == [True]
+
+    asyncio.run(main())
@@ -0,0 +1,37 @@
+import asyncio
+from types import SimpleNamespace
+
+from summarizer import FOLD_PROMPT, Summarizer
+
+
+async def history(messages):
+    for message_id, content in messages:
+        yield SimpleNamespace(id=message_id, author_name="someone", content=content)
+
+
+def summarize(messages, **options):
+    prompts = []
+
+    async def complete(prompt, text, guild_id=None):
+        prompts.append((prompt, text))
+        return f"summary {len(prompts)}"
+
+    async def main():
+        return await Summarizer(complete).summarize(history(messages), **options)
+
+    return asyncio.run(main()), prompts
+
+
+def test_few_new_messages_are_folded_into_the_previous_summary():
+    (summary, newest_id), prompts = summarize([(3, "newer"), (2, "new")], previous="old summary", limit=5)
+    assert newest_id == 3
+    assert [prompt for prompt, _ in prompts] == [FOLD_PROMPT]
+    assert prompts[0][1].startswith("old summary")
+
+
+def test_previous_summary_is_dropped_when_the_new_messages_fill_the_limit():
+    # as many new messages as asked for: older ones may be missing, the old summary isn't next to these anymore
+    (summary, newest_id), prompts = summarize([(3, "newer"), (2, "new")], previous="old summary", limit=2)
+    assert newest_id == 3
+    assert all("old summary" not in text for _, text in prompts)
+    assert FOLD_PROMPT not in [prompt for prompt, _ in prompts]
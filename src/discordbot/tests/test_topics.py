@@ -0,0 +1,48 @@
+import random
+
+from topics import HashingVectorizer, TopicIndex
+
+
+def normalized(matches):
+    return {user_id: sorted(topics) for user_id, topics in matches.items()}
+
+
+def brute_force(vectorizer, topics, text, threshold):
+    vector = vectorizer.transform_one(text)
+    matches = {}
+    for user_id, topic in topics:
+        if vectorizer.transform_one(topic) @ vector >= threshold:
+            matches.setdefault(user_id, []).append(topic)
+    return normalized(matches)
+
+
+def test_scores_are_the_same_for_short_and_long_messages():
+    rng = random.Random(1)
+    words = [f"w{number}" for number in range(200)]
+    vectorizer = HashingVectorizer()
+    index = TopicIndex(vectorizer, threshold=0.3)
+    topics = list(dict.fromkeys((number % 50, " ".join(rng.sample(words, rng.randint(1, 3)))) for number in range(1000)))
+    for user_id, topic in topics:
+        index.add(user_id, topic)
+    # remove some, so columns get moved around
+    for user_id, topic in topics[::7]:
+        index.remove(user_id, topic)
+    topics = [key for key in topics if key in index]
+
+    # short messages only read the dimensions they touch, long ones the whole matrix
+    texts = [" ".join(rng.sample(words, length)) for length in (1, 2, 5, 40) for _ in range(10)]
+    results = index.match(vectorizer.transform(texts))
+    for text, result in zip(texts, results):
+        assert normalized(result) == brute_force(vectorizer, topics, text, 0.3)
+        assert result == index.match(vectorizer.transform([text]))[0]
+    assert any(results)
+
+
+def test_growing_keeps_every_topic():
+    vectorizer = HashingVectorizer()
+    index = TopicIndex(vectorizer, threshold=0.9)
+    for number in range(100):
+        index.add(number, f"topic{number}")
+    assert len(index) == 100
+    assert index.match(vectorizer.transform(["topic42"]))[0] == {42: ["topic42"]}
+    assert index.match(vectorizer.transform(["nothing"]))[0] == {}
@@ -0,0 +1,196 @@
+import asyncio
+import functools
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytz
+
+DEFAULT_TIMEZONE = "America/Los_Angeles"
+
+UNIT_SECONDS = {
+    "s": 1, "sec": 1, "secs": 1, "second": 1, "seconds": 1,
+    "m": 60, "min": 60, "mins": 60, "minute": 60, "minutes": 60,
+    "h": 3600, "hr": 3600, "hrs": 3600, "hour": 3600, "hours": 3600,
+    "d": 86400, "day": 86400, "days": 86400,
+    "w": 604800, "wk": 604800, "wks": 604800, "week": 604800, "weeks": 604800,
+}
+
+_NUMBER = r"\d+(?:\.\d+)?|an?|one|half an?"
+_DURATION_PART = re.compile(rf"\s*(?:and\s+|,\s*)?({_NUMBER})\s*({'|'.join(sorted(UNIT_SECONDS, key=len, reverse=True))})(?![a-z])")
+_RELATIVE = re.compile(r"^(?:in\s+)?(?P<duration>.+?)(?:\s+from\s+now)?$")
+_CLOCK = r"(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<meridiem>am|pm)?|(?P<named>noon|midnight)"
+_DAY_AND_TIME = (
+    re.compile(rf"^(?P<day>today|tonight|tomorrow)(?:\s+(?:at\s+)?(?:{_CLOCK}))?$"),
+    re.compile(rf"^(?:at\s+)?(?:{_CLOCK})(?:\s+(?P<day>today|tonight|tomorrow))?$"),
+)
+_ISO = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})[ t](\d{1,2}):(\d{2})(?::(\d{2}))?$")
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    """:return: The pytz timezone for a name like "Europe/Berlin" (any capitalization), or None if there's no such zone."""
+    canonical = _timezone_names().get(name.strip().lower())
+    return pytz.timezone(canonical) if canonical else None
+
+
+@functools.lru_cache(maxsize=1)
+def _timezone_names():
+    return {name.lower(): name for name in pytz.all_timezones}
+
+
+def _number(text):
+    if text in ("a", "an", "one"):
+        return 1.0
+    if text.startswith("half"):
+        return 0.5
+    return float(text)
+
+
+def _clock(match):
+    """:return: (hour, minute) from the _CLOCK groups of a match, None if there's no time, False if it's not a valid time."""
+    if match.group("named"):
+        return (12, 0) if match.group("named") == "noon" else (0, 0)
+    if match.group("hour") is None:
+        return None
+    hour, minute = int(match.group("hour")), int(match.group("minute") or 0)
+    meridiem = match.group("meridiem")
+    # a bare number like "9" is too ambiguous, leave it to dateparser
+    if meridiem is None and match.group("minute") is None:
+        return False
+    if meridiem is not None:
+        if not 1 <= hour <= 12:
+            return False
+        hour = hour % 12 + (12 if meridiem == "pm" else 0)
+    if hour > 23 or minute > 59:
+        return False
+    return hour, minute
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_expression(text):
+    """Turns a normalized time expression into a plan that doesn't depend on the current time.
+
+    Plans are cached, so the regexes only run once per distinct expression:
+    - ("delta", seconds) for "in 2 hours", "90 minutes from now", "1h30m"
+    - ("day", days from today or None for the next occurrence, hour, minute) for "tomorrow 9am", "5:30pm"
+    - ("absolute", year, month, day, hour, minute, second) for "2023-01-01 12:00"
+
+    :return: The plan, or None if the fast path doesn't understand the expression.
+    """
+    match = _ISO.match(text)
+    if match:
+        return ("absolute",) + tuple(int(part or 0) for part in match.groups())
+
+    for pattern in _DAY_AND_TIME:
+        match = pattern.match(text)
+        if not match:
+            continue
+        clock = _clock(match)
+        if clock is False:
+            return None
+        day = match.group("day")
+        if clock is None:
+            # "tonight" alone means this evening, "today"/"tomorrow" alone are too vague
+            if day != "tonight":
+                return None
+            clock = (20, 0)
+        elif day == "tonight" and clock[0] < 12 and match.group("meridiem") is None:
+            clock = (clock[0] + 12, clock[1])
+        return ("day", {"today": 0, "tonight": 0, "tomorrow": 1, None: None}[day]) + clock
+
+    match = _RELATIVE.match(text)
+    if match:
+        duration, seconds, end = match.group("duration"), 0.0, 0
+        for part in _DURATION_PART.finditer(duration):
+            if part.start() != end:
+                return None
+            seconds += _number(part.group(1)) * UNIT_SECONDS[part.group(2)]
+            end = part.end()
+        if end and end == len(duration):
+            return ("delta", seconds)
+    return None
+
+
+def apply_plan(plan, now, tz):
+    """:return: The aware datetime (in `tz`) a compiled plan stands for, relative to `now` (an aware datetime)."""
+    kind = plan[0]
+    if kind == "delta":
+        # add in UTC so "in 24 hours" is 24 real hours even across a DST change
+        return (now.astimezone(timezone.utc) + timedelta(seconds=plan[1])).astimezone(tz)
+    if kind == "absolute":
+        return tz.localize(datetime(*plan[1:]))
+    _, days, hour, minute = plan
+    local_now = now.astimezone(tz)
+    date = local_now.date() + timedelta(days=days or 0)
+    target = tz.localize(datetime(date.year, date.month, date.day, hour, minute))
+    if days is None and target <= local_now:
+        # a time that already passed today means tomorrow
+        date += timedelta(days=1)
+        target = tz.localize(datetime(date.year, date.month, date.day, hour, minute))
+    return target
+
+
+class TimeParser:
+    """Parses reminder times like "in 1 hour", "tomorrow 9am" or "2023-01-01 12:00" in the user's timezone.
+
+    Common forms go through a few cached regexes (microseconds). Anything else falls back to dateparser,
+    which is only imported the first time it's needed and runs on a worker thread, since a single call
+    can take milliseconds. Fallback results are cached for a minute per (expression, timezone).
+
+    :param cache_size: How many fallback results to remember.
+    :param clock: Returns the current time in epoch seconds.
+    """
+
+    def __init__(self, cache_size=1024, clock=time.time):
+        self.clock = clock
+        self._fallback = functools.lru_cache(maxsize=cache_size)(self._parse_with_dateparser)
+        self.fast = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.lower().split())
+
+    def parse_fast(self, text, timezone_name=DEFAULT_TIMEZONE, now=None):
+        """:return: The aware datetime for `text`, or None if it needs the dateparser fallback (or is invalid)."""
+        tz = get_timezone(timezone_name) or get_timezone(DEFAULT_TIMEZONE)
+        plan = compile_expression(self.normalize(text))
+        if plan is None:
+            return None
+        if now is None:
+            now = datetime.fromtimestamp(self.clock(), timezone.utc)
+        try:
+            return apply_plan(plan, now, tz)
+        except (ValueError, OverflowError):
+            return None
+
+    def parse_fallback(self, text, timezone_name=DEFAULT_TIMEZONE):
+        """Parses `text` with dateparser (blocking). :return: The aware datetime, or None if it can't be parsed."""
+        # cached per minute: "next friday" means the same thing for the next few calls
+        minute = int(self.clock() // 60)
+        return self._fallback(self.normalize(text), timezone_name, minute)
+
+    def _parse_with_dateparser(self, text, timezone_name, minute):
+        import dateparser
+        tz = get_timezone(timezone_name) or get_timezone(DEFAULT_TIMEZONE)
+        now = datetime.fromtimestamp(self.clock(), tz).replace(tzinfo=None)
+        parsed = dateparser.parse(text, settings={
+            'TIMEZONE': tz.zone,
+            'RETURN_AS_TIMEZONE_AWARE': True,
+            'RELATIVE_BASE': now,
+        })
+        return parsed.astimezone(tz) if parsed is not None else None
+
+    async def parse(self, text, timezone_name=DEFAULT_TIMEZONE):
+        """Parses a reminder time in the given timezone without blocking the event loop.
+
+        :return: An aware datetime in that timezone, or None if the text isn't a time we understand.
+        """
+        result = self.parse_fast(text, timezone_name)
+        if result is not None:
+            self.fast += 1
+            return result
+        self.fallbacks += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.parse_fallback, text, timezone_name)